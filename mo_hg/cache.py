@@ -10,27 +10,53 @@
 from __future__ import division
 from __future__ import unicode_literals
 
+import hashlib
 import json
+import os
+import re
+import zlib
+from collections import OrderedDict, deque
+from io import BytesIO
+from time import time
 
 from flask import Response
-from mo_dots import coalesce
+from mo_dots import coalesce, Data, wrap
+from mo_files import File
 from mo_files.url import URL
 from mo_future import text_type, xrange
 from mo_json import value2json
 from mo_kwargs import override
 from mo_logs import Log
-from mo_threads import Lock, Signal, Queue, Thread, Till
+from mo_math.randoms import Random
+from mo_threads import Lock, Signal, Thread, Till
 from mo_times import Date, SECOND, MINUTE
 from pyLibrary.env import http
-from pyLibrary.sql.sqlite import Sqlite, quote_value, quote_list
 
+from mo_hg.cache_db import CacheDB
+from mo_hg.cache_keys import CacheKeys
 from mo_hg.rate_logger import RateLogger
+from mo_hg.scheduler import Scheduler, local_bucket, LANE_HEADER
 
 APP_NAME = "HG Cache"
 CONCURRENCY = 5
 AMORTIZATION_PERIOD = SECOND
 HG_REQUEST_PER_SECOND = 10
 CACHE_RETENTION = 10 * MINUTE
+CHUNK_SIZE = 64 * 1024  # BYTES READ FROM UPSTREAM, OR SENT TO THE CLIENT, AT A TIME
+COMPRESSION_LEVEL = 6
+MAX_BLOB_SIZE = 1024 * 1024  # GZIPPED BODIES BIGGER THAN THIS ARE KEPT IN files (IF CONFIGURED)
+IGNORED_REQUEST_HEADERS = ["host", "accept-encoding", "content-length", "connection", LANE_HEADER.lower()]
+IGNORED_RESPONSE_HEADERS = ["transfer-encoding", "content-encoding", "content-length", "connection"]
+MEMORY_BUDGET = 100 * 1024 * 1024  # BYTES OF BODIES KEPT IN MEMORY
+IN_FLIGHT_MEMORY = 16 * CHUNK_SIZE  # BYTES OF A SPILLED, ARRIVING BODY KEPT IN MEMORY FOR THE READERS KEEPING UP
+STATS_PATH = "__stats__"  # WHERE THE RELAY REPORTS Cache.status(); hg HAS NO PATH LIKE THIS
+LEASE_TIME = MINUTE  # LONGEST ONE PROCESS CAN HOLD BACK THE OTHERS FROM FETCHING A path
+LEASE_POLL = 0.1  # SECONDS BETWEEN CHECKS FOR A path ANOTHER PROCESS IS FETCHING
+MUTABLE_TTL = 30 * SECOND  # HOW LONG A RESPONSE THAT CAN CHANGE IS USED BEFORE ASKING UPSTREAM AGAIN
+CACHED_ENDPOINTS = ["/json-annotate/", "/json-info/", "/json-log/", "/json-rev/", "/rev/", "/raw-rev/", "/raw-file/", "/json-pushes", "/pushloghtml", "/file/"]
+MUTABLE_ENDPOINTS = ["/json-pushes", "/pushloghtml"]  # CHANGE WITH EVERY PUSH, EVEN IF THEY NAME A node
+FULL_NODE = re.compile(r"(?<![0-9a-fA-F])[0-9a-fA-F]{40}(?![0-9a-fA-F])")
+ON_DISK = object()  # InFlight.read_memory() GIVES THIS, IN PLACE OF A Signal FOR MORE, WHEN THE BYTES ARE ONLY IN THE FILE
 
 
 class Cache(object):
@@ -39,61 +65,76 @@ class Cache(object):
     """
 
     @override
-    def __init__(self, rate=None, amortization_period=None, source=None, database=None, kwargs=None):
+    def __init__(
+        self,
+        rate=None,
+        amortization_period=None,
+        source=None,
+        database=None,
+        files=None,
+        gzip_passthrough=True,
+        memory_budget=MEMORY_BUDGET,
+        disk_budget=None,
+        lanes=None,
+        shared=False,
+        kwargs=None
+    ):
+        """
+        :param files: DIRECTORY TO KEEP THE LARGE BODIES (DEFAULT IS TO KEEP ALL BODIES IN THE DATABASE)
+        :param gzip_passthrough: True TO STORE THE GZIPPED BODIES FROM UPSTREAM AS-IS; False TO ASK
+                                 UPSTREAM FOR UNCOMPRESSED BODIES, AND COMPRESS THEM HERE
+        :param memory_budget: BYTES OF BODIES TO KEEP IN MEMORY
+        :param disk_budget: BYTES OF BODIES TO KEEP IN THE DATABASE AND files (None FOR NO LIMIT)
+        :param lanes: LIST OF {"name", "weight", "rate", "paths"} TO SHARE THE rate (SEE scheduler.DEFAULT_LANES)
+        :param shared: True IF OTHER PROCESSES USE THE SAME database; THEY WILL SHARE THE rate, AND
+                       NOT FETCH THE SAME path AT THE SAME TIME (A REQUEST FOR A path ANOTHER
+                       PROCESS IS FETCHING IS SERVED ITS stale RESPONSE, IF ANY, OR WAITS ON ITS ready)
+        """
         self.amortization_period = coalesce(amortization_period, AMORTIZATION_PERIOD)
         self.rate = coalesce(rate, HG_REQUEST_PER_SECOND)
         self.cache_locker = Lock()
-        self.cache = {}  # MAP FROM url TO (ready, headers, response, timestamp) PAIR
+        self.cache = OrderedDict()  # MAP FROM url TO (ready, headers, body, timestamp) PAIR, LEAST RECENTLY USED FIRST
+                                    # body IS None WHILE QUEUED, InFlight WHILE ARRIVING, THEN Body
+        self.memory_budget = memory_budget
+        self.memory_bytes = 0  # BYTES OF BODIES IN self.cache
+        self.memory_evicted = Data(entries=0, bytes=0)
+        self.stats = Data(
+            memory=0,  # SERVED FROM self.cache
+            coalesced=0,  # WAITED FOR A REQUEST ALREADY MADE
+            database=0,  # SERVED FROM THE DATABASE
+            upstream=0,  # SENT UPSTREAM
+            peer_waits=0,  # WAITED FOR ANOTHER PROCESS TO FETCH IT
+            revalidated=0,  # CONDITIONAL REQUESTS SENT UPSTREAM
+            not_modified=0,  # CONDITIONAL REQUESTS ANSWERED WITH 304
+            failures=0,  # UPSTREAM REQUESTS THAT FAILED
+            bytes_served=0
+        )
         self.no_cache = {}  # VERY SHORT TERM CACHE
         self.workers = []
-        self.todo = Queue(APP_NAME+" todo")
-        self.requests = Queue(APP_NAME + " requests", max=int(self.rate * self.amortization_period.seconds))
         self.url = URL(source.url)
-        self.db = Sqlite(database)
+        self.files = File(files).abspath if files else None
+        self.gzip_passthrough = gzip_passthrough
+        self.db = CacheDB(budget=disk_budget, kwargs=database)
+        self.shared = shared
+        self.scheduler = Scheduler(
+            self.rate,
+            self.amortization_period.seconds,
+            lanes,
+            buckets=self.db.token_bucket if shared else local_bucket
+        )
+        self.keys = CacheKeys()
+        self.peer_locker = Lock("peer waits")
+        self.peer_waits = {}  # MAP FROM path TO (ready, method, headers, timestamp) FOR paths ANOTHER PROCESS IS FETCHING
         self.inbound_rate = RateLogger("Inbound")
         self.outbound_rate = RateLogger("hg.mo")
 
-        if not self.db.query("SELECT name FROM sqlite_master WHERE type='table'").data:
-            with self.db.transaction() as t:
-                t.execute(
-                    "CREATE TABLE cache ("
-                    "   path TEXT PRIMARY KEY, "
-                    "   headers TEXT, "
-                    "   response TEXT, "
-                    "   timestamp REAL "
-                    ")"
-                )
-
         self.threads = [
             Thread.run(APP_NAME+" worker" + text_type(i), self._worker)
             for i in range(CONCURRENCY)
         ]
-        self.limiter = Thread.run(APP_NAME+" limiter", self._rate_limiter)
         self.cleaner = Thread.run(APP_NAME+" cleaner", self._cache_cleaner)
-
-    def _rate_limiter(self, please_stop):
-        try:
-            max_requests = self.requests.max
-            recent_requests = []
-
-            while not please_stop:
-                now = Date.now()
-                too_old = now - self.amortization_period
-
-                recent_requests = [t for t in recent_requests if t > too_old]
-
-                num_recent = len(recent_requests)
-                if num_recent >= max_requests:
-                    space_free_at = recent_requests[0] + self.amortization_period
-                    (please_stop | Till(till=space_free_at.unix)).wait()
-                    continue
-                for _ in xrange(num_recent, max_requests):
-                    request = self.todo.pop()
-                    now = Date.now()
-                    recent_requests.append(now)
-                    self.requests.add(request)
-        except Exception as e:
-            Log.warning("failure", cause=e)
+        if shared:
+            self.peer_waiter = Thread.run(APP_NAME+" peer waiter", self._peer_waiter)
 
     def _cache_cleaner(self, please_stop):
         while not please_stop:
@@ -102,107 +143,718 @@ class Cache(object):
 
             remove = set()
             with self.cache_locker:
-                for path, (ready, headers, response, timestamp) in self.cache:
-                    if timestamp < too_old:
+                for path, (ready, headers, body, timestamp) in self.cache.items():
+                    if isinstance(body, Body) and timestamp < too_old:
                         remove.add(path)
                 for r in remove:
-                    del self.cache[r]
+                    self._forget(r)
             (please_stop | Till(seconds=CACHE_RETENTION.seconds / 2)).wait()
 
+    def freshness(self, path):
+        """
+        :return: SECONDS A RESPONSE FOR path CAN BE USED BEFORE IT MUST BE REVALIDATED,
+                 None IF IT NEVER CHANGES, ZERO IF IT IS NOT TO BE CACHED
+        """
+        if not any(k in path for k in CACHED_ENDPOINTS):
+            return 0
+        if any(k in path for k in MUTABLE_ENDPOINTS):
+            return MUTABLE_TTL.seconds
+        if FULL_NODE.search(path):
+            # A FULL node NAMES THE SAME CHANGESET FOREVER
+            return None
+        # tip, BRANCH NAMES, SHORT HASHES
+        return MUTABLE_TTL.seconds
+
     def please_cache(self, path):
         """
         :return: False if `path` is not to be cached
         """
-        if path.endswith("/tip"):
-            return False
-        if any(k in path for k in ["/json-annotate/", "/json-info/", "/json-log/", "/json-rev/", "/rev/", "/raw-rev/", "/raw-file/", "/json-pushes", "/pushloghtml", "/file/"]):
-            return True
+        return self.freshness(path) != 0
 
-        return False
+    def _expires(self, path, timestamp):
+        """
+        :return: UNIX TIME WHEN THE RESPONSE FOR path, RECEIVED AT timestamp, MUST BE REVALIDATED
+        """
+        ttl = self.freshness(path)
+        if ttl is None:
+            return None
+        return timestamp.unix + ttl
 
     def request(self, method, path, headers):
         now = Date.now()
+        path = self.keys.canonical(path)
         self.inbound_rate.add(now)
-        ready = Signal(path)
+        accept_gzip = "gzip" in coalesce(headers.get("Accept-Encoding"), "")
+
+        ready, pair, stale = self.lookup(path, now)
+        if pair is None:
+            found = self.fill(ready, method, path, headers, now, stale)
+            if found is not None:
+                self.stats.database += 1
+                return _response(found[0], found[1], accept_gzip, self.stats)
+            self.stats.upstream += 1
+        elif isinstance(pair[2], InFlight):
+            # JOINED A FETCH WHOSE BODY IS STILL ARRIVING
+            self.stats.coalesced += 1
+            return _response(pair[1], pair[2], accept_gzip, self.stats)
+        elif pair[2] is not None:
+            self.stats.memory += 1
+            return _response(pair[1], pair[2], accept_gzip, self.stats)
+        else:
+            self.stats.coalesced += 1
+
+        # REQUEST IS IN THE QUEUE, WAIT FOR THE RESPONSE TO START
+        ready.wait()
+        resp_headers, body = self.result(path)
+        return _response(resp_headers, body, accept_gzip, self.stats)
+
+    def warm(self, path, lane):
+        """
+        FETCH path INTO THE CACHE, THROUGH lane, IF IT IS NOT ALREADY HERE; DO NOT WAIT FOR IT
+        :return: True IF AN UPSTREAM REQUEST WAS QUEUED
+        """
+        now = Date.now()
+        path = self.keys.canonical(path)
+        ready, pair, stale = self.lookup(path, now)
+        if pair is not None:
+            return False
+        return self.fill(ready, "get", path, {LANE_HEADER: lane}, now, stale) is None
 
-        # TEST CACHE
+    def get(self, path, lane):
+        """
+        FETCH path, THROUGH lane, AND WAIT FOR IT
+        :return: (status, UNCOMPRESSED BODY)
+        """
+        now = Date.now()
+        path = self.keys.canonical(path)
+        ready, pair, stale = self.lookup(path, now)
+        if pair is None:
+            found = self.fill(ready, "get", path, {LANE_HEADER: lane}, now, stale)
+        elif pair[2] is not None:
+            found = pair[1], pair[2]
+        else:
+            found = None
+        if found is None:
+            ready.wait()
+            found = self.result(path)
+        headers, body = found
+        return body.status, b"".join(body.stream(False))
+
+    def lookup(self, path, now):
+        """
+        TEST THE MEMORY TIER; DOES NOT BLOCK
+        :return: (ready, pair, stale) WHERE pair IS THE MEMORY ENTRY FOR path, OR None IF THE
+                 CALLER MUST fill() IT; stale IS AN EXPIRED (headers, body) TO REVALIDATE
+        """
+        ready = Signal(path)
+        stale = None
         with self.cache_locker:
             pair = self.cache.get(path)
+            if pair is not None and isinstance(pair[2], Body):
+                if not pair[2].exists():
+                    # FILE WAS EVICTED FROM DISK
+                    self._forget(path)
+                    pair = None
+                elif pair[2].is_stale(now.unix):
+                    if pair[2].status == 200:
+                        stale = pair[1], pair[2]  # AN ERROR IS NOT REVALIDATED, ONLY ASKED FOR AGAIN
+                    self._forget(path)
+                    pair = None
             if pair is None:
                 self.cache[path] = (ready, None, None, now)
-
-
+            else:
+                # MOST RECENTLY USED GOES TO THE END
+                del self.cache[path]
+                self.cache[path] = pair
+                ready = pair[0]
         if pair is not None:
-            # REQUEST IS IN THE QUEUE ALREADY, WAIT
-            ready, headers, response, then = pair
-            if response is None:
-                ready.wait()
-                with self.cache_locker:
-                    ready, headers, response, timestamp = self.cache.get(path)
-            with self.db.transaction() as t:
-                t.execute("UPDATE cache SET timestamp=" + quote_value(now) + " WHERE path=" + quote_value(path) + " AND timestamp<" + quote_value(now))
-            return Response(
-                response,
-                status=200,
-                headers=json.loads(headers)
-            )
-
-        # TEST DB
-        db_response = self.db.query("SELECT headers, response FROM cache WHERE path=" + quote_value(path)).data
-        if db_response:
-            headers, response = db_response[0]
-            with self.db.transaction() as t:
-                t.execute("UPDATE cache SET timestamp=" + quote_value(now) + " WHERE path=" + quote_value(path) + " AND timestamp<" + quote_value(now))
-            with self.cache_locker:
-                self.cache[path] = (ready, headers, response.encode('latin1'), now)
-            ready.go()
+            self.db.touch(path, now.unix)
+        return ready, pair, stale
 
-            return Response(
-                response,
-                status=200,
-                headers=json.loads(headers)
-            )
+    def fill(self, ready, method, path, headers, now, stale):
+        """
+        TEST THE DATABASE, OR ELSE QUEUE THE UPSTREAM REQUEST; BLOCKS ONLY ON THE DATABASE
+        :return: (headers, body) FROM THE DATABASE, OR None IF QUEUED (WAIT FOR ready, THEN CALL result())
+        """
+        if stale is None:
+            found = self._from_db(path)
+            if found is not None:
+                if not found[1].is_stale(now.unix):
+                    return self._db_hit(ready, path, found, now)
+                stale = found
+
+        if self.shared and self.please_cache(path):
+            # ONLY ONE PROCESS FETCHES path; THE OTHERS WAIT FOR IT TO FILL THE DATABASE
+            leased = self.db.lease(path, LEASE_TIME.seconds)
+            found = self._from_db(path)  # MAYBE FILLED WHILE WE LOOKED ELSEWHERE
+            if found is not None and not found[1].is_stale(Date.now().unix):
+                if leased:
+                    self.db.release(path)
+                return self._db_hit(ready, path, found, now)
+            if found is not None:
+                stale = found
+            if not leased:
+                if stale is not None:
+                    # SERVE THE OLD RESPONSE WHILE THE OTHER PROCESS REVALIDATES IT
+                    return self._db_hit(ready, path, stale, now)
+                # THE _peer_waiter WILL SIGNAL ready
+                self.stats.peer_waits += 1
+                with self.peer_locker:
+                    self.peer_waits[path] = (ready, method, headers, now)
+                return None
+
+        # MAKE A NETWORK REQUEST (CONDITIONAL, IF WE HAVE A stale RESPONSE)
+        self.scheduler.add(self.scheduler.lane_for(path, headers), (ready, method, path, headers, now, stale))
+        return None
+
+    def _peer_waiter(self, please_stop):
+        """
+        ONE THREAD WATCHES ALL THE paths ANOTHER PROCESS IS FETCHING, SO NO
+        REQUEST THREAD IS HELD POLLING THE leases
+        EACH POLL IS ONE READ-ONLY QUERY FOR ALL THE paths; ONLY A path WHOSE
+        LEASE IS GONE (OR EXPIRED) IS WORTH A WRITE TRANSACTION TO TAKE IT
+        """
+        while not please_stop:
+            (please_stop | Till(seconds=LEASE_POLL)).wait()
+            with self.peer_locker:
+                waiting = list(self.peer_waits.items())
+            if not waiting:
+                continue
+            try:
+                now = Date.now().unix
+                expires, leased = self.db.peek([path for path, _ in waiting], now)
+            except Exception as e:
+                Log.warning("problem checking the leases", cause=e)
+                continue
+            for path, (ready, method, headers, timestamp) in waiting:
+                try:
+                    if path in expires and (expires[path] is None or expires[path] > now):
+                        found = self._from_db(path)
+                        if found is None:
+                            continue  # EVICTED ALREADY; WAIT FOR THE LEASE TO GO
+                        self._db_hit(ready, path, found, timestamp)
+                    elif path in leased:
+                        continue
+                    elif self.db.lease(path, LEASE_TIME.seconds):
+                        # THE OTHER PROCESS GAVE UP (OR DIED); FETCH IT OURSELVES
+                        found = self._from_db(path)  # MAYBE FILLED JUST BEFORE THE LEASE WENT
+                        if found is not None and not found[1].is_stale(Date.now().unix):
+                            self.db.release(path)
+                            self._db_hit(ready, path, found, timestamp)
+                        else:
+                            self.scheduler.add(self.scheduler.lane_for(path, headers), (ready, method, path, headers, timestamp, found))
+                    else:
+                        continue  # ANOTHER PROCESS TOOK THE LEASE FIRST
+                except Exception as e:
+                    Log.warning("problem waiting for {{path}}", path=path, cause=e)
+                    with self.cache_locker:
+                        self._forget(path)
+                    ready.go()
+                with self.peer_locker:
+                    self.peer_waits.pop(path, None)
+
+    def result(self, path):
+        """
+        :return: (headers, body) FOR path, ONCE ITS ready HAS GONE
+        """
+        with self.cache_locker:
+            pair = self.cache.get(path)
+        if pair is None or pair[2] is None:
+            Log.error("Upstream request for {{path}} failed", path=path)
+        return pair[1], pair[2]
 
-        # MAKE A NETWORK REQUEST
-        self.todo.add((ready, method, path, headers, now))
-        ready.wait()
+    def _from_db(self, path):
+        """
+        :return: (headers, body) FROM THE DATABASE, OR None
+        """
+        db_response = self.db.get(path)
+        if not db_response:
+            return None
+        headers, content, file, size, expires = db_response
+        if content is not None:
+            return headers, Body(content=content, size=size, expires=expires)
+        elif file and os.path.exists(file):
+            return headers, Body(file=file, size=size, expires=expires)
+        return None
+
+    def _db_hit(self, ready, path, found, now):
+        headers, body = found
+        self.db.touch(path, now.unix)
         with self.cache_locker:
-            ready, headers, response, timestamp = self.cache[path]
-        return Response(
-            response,
-            status=200,
-            headers=json.loads(headers)
-        )
+            self._remember(path, (ready, headers, body, now))
+        ready.go()
+        return found
 
     def _worker(self, please_stop):
         while not please_stop:
-            pair = self.requests.pop(till=please_stop)
+            pair = self.scheduler.pop(till=please_stop)
             if please_stop:
                 break
-            ready, method, path, req_headers, timestamp = pair
+            ready, method, path, req_headers, timestamp, stale = pair
 
+            writer = None
+            in_flight = None
             try:
                 url = self.url / path
-                self.outbound_rate.add(Date.now())
-                response = http.request(method, url, req_headers)
+                upstream_headers = self._upstream_headers(req_headers)
+                if stale is not None:
+                    upstream_headers.update(_conditional_headers(stale[0]))
+                    self.stats.revalidated += 1
+                start = time()
+                response = http.request(method, url, upstream_headers)
+                self.outbound_rate.add(Date.now(), time() - start)
+
+                if stale is not None and response.status_code == 304:
+                    # NOT CHANGED; ONLY THE HEADERS CAME OVER THE WIRE
+                    self.stats.not_modified += 1
+                    response.close()
+                    resp_headers, body = stale
+                    body.expires = self._expires(path, timestamp)
+                    if self.please_cache(path):
+                        self.db.refresh(path, body.expires)
+                    with self.cache_locker:
+                        self._remember(path, (ready, resp_headers, body, timestamp))
+                    continue
 
-                del response.headers['transfer-encoding']
-                resp_headers = value2json(response.headers)
-                resp_content = response.raw.read()
+                resp_headers = value2json({
+                    k: v
+                    for k, v in response.headers.items()
+                    if k.lower() not in IGNORED_RESPONSE_HEADERS
+                })
+                gzipped = response.headers.get('content-encoding') == "gzip"
+
+                # ONLY A SUCCESS IS WORTH KEEPING; AN ERROR IS SERVED TO THE WAITING CLIENTS, THEN FORGOTTEN
+                please_cache = response.status_code == 200 and self.please_cache(path)
+                in_flight = InFlight(response.status_code)
+                writer = BodyWriter(gzipped, self.files if please_cache else None, tee=in_flight.add)
+
+                # LET THE CLIENTS START READING
+                with self.cache_locker:
+                    self.cache[path] = (ready, resp_headers, in_flight, timestamp)
+                ready.go()
+
+                while True:
+                    data = response.raw.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    writer.write(data)
+                body = writer.close(self._file_for(path))
+                body.expires = self._expires(path, timestamp) if please_cache else timestamp.unix
+                body.status = response.status_code
+                writer = None
 
-                please_cache = self.please_cache(path)
                 if please_cache:
-                    with self.db.transaction() as t:
-                        t.execute("INSERT INTO cache (path, headers, response, timestamp) VALUES" + quote_list((path, resp_headers, resp_content.decode('latin1'), timestamp)))
+                    if body.content is not None:
+                        self.keys.learn(path, body.stream(False))
+                    self.db.put(path, resp_headers, body.content, body.file, body.size, timestamp.unix, body.expires)
                 with self.cache_locker:
-                    self.cache[path] = (ready, resp_headers, resp_content, timestamp)
+                    self._remember(path, (ready, resp_headers, body, timestamp))
+                in_flight.finish(body.file)
             except Exception as e:
                 Log.warning("problem with request to {{path}}", path=path, cause=e)
+                self.stats.failures += 1
+                if writer is not None:
+                    writer.abort()
+                if in_flight is not None:
+                    in_flight.fail(e)
                 with self.cache_locker:
-                    ready, headers, response = self.cache[path]
-                    del self.cache[path]
+                    self._forget(path)
             finally:
+                if self.shared and self.please_cache(path):
+                    try:
+                        self.db.release(path)
+                    except Exception as e:
+                        Log.warning("problem releasing {{path}}", path=path, cause=e)
                 ready.go()
 
+    def status(self):
+        """
+        :return: Data OF THE COUNTS, QUEUES AND RATES, FOR MONITORING
+        """
+        with self.cache_locker:
+            entries = len(self.cache)
+            in_flight = sum(1 for ready, headers, body, timestamp in self.cache.values() if not isinstance(body, Body))
+        db_entries, db_bytes = self.db.totals()  # THE WHOLE TABLE, INCLUDING WHAT OTHER PROCESSES ADDED
+        return wrap({
+            "requests": self.stats,
+            "queue": {lane.name: len(lane.queue) for lane in self.scheduler.lanes},
+            "in_flight": in_flight,
+            "memory": {
+                "entries": entries - in_flight,
+                "bytes": self.memory_bytes,
+                "budget": self.memory_budget,
+                "evicted": self.memory_evicted
+            },
+            "database": {
+                "entries": db_entries,
+                "bytes": db_bytes,
+                "budget": self.db.budget,
+                "evicted": self.db.evicted,
+                "write_wait": self.db.write_wait.snapshot()
+            },
+            "inbound": self.inbound_rate.snapshot(),
+            "upstream": self.outbound_rate.snapshot()
+        })
+
+    def _remember(self, path, pair):
+        """
+        PUT pair IN THE MEMORY TIER, AND EVICT THE LEAST RECENTLY USED BODIES
+        OVER THE memory_budget
+        ASSUME LOCKED
+        """
+        self._forget(path)
+        self.cache[path] = pair
+        self.memory_bytes += _memory_size(pair)
+        if self.memory_bytes <= self.memory_budget:
+            return
+        excess = self.memory_bytes - self.memory_budget
+        victims = []
+        for p, old in self.cache.items():
+            if excess <= 0:
+                break
+            if not isinstance(old[2], Body) or p == path:
+                continue  # IN FLIGHT, OR JUST ADDED
+            victims.append(p)
+            excess -= _memory_size(old)
+        for p in victims:
+            size = _memory_size(self.cache.pop(p))
+            self.memory_bytes -= size
+            self.memory_evicted.entries += 1
+            self.memory_evicted.bytes += size
+
+    def _forget(self, path):
+        # ASSUME LOCKED
+        pair = self.cache.pop(path, None)
+        if pair is not None:
+            self.memory_bytes -= _memory_size(pair)
+
+    def _upstream_headers(self, headers):
+        output = {
+            k: v
+            for k, v in headers.items()
+            if k.lower() not in IGNORED_REQUEST_HEADERS
+        }
+        output[str("Accept-Encoding")] = str("gzip") if self.gzip_passthrough else str("identity")
+        return output
+
+    def _file_for(self, path):
+        return body_file(self.files, path)
+
+
+def body_file(files, path):
+    """
+    :return: FILENAME, IN THE files DIRECTORY, FOR A LARGE BODY OF path
+    """
+    if not files:
+        return None
+    name = hashlib.sha1(path.encode("utf8")).hexdigest()
+    return os.path.join(files, name[:2], name + ".gz")
+
+
+class Body(object):
+    """
+    A GZIPPED RESPONSE BODY, HELD IN MEMORY (content) OR ON DISK (file)
+    """
+
+    __slots__ = ["content", "file", "size", "expires", "status"]
+
+    def __init__(self, content=None, file=None, size=None, expires=None, status=200):
+        """
+        :param expires: UNIX TIME WHEN THE BODY MUST BE REVALIDATED (None FOR NEVER)
+        :param status: THE UPSTREAM STATUS CODE (ONLY 200 IS KEPT IN THE DATABASE)
+        """
+        self.content = content
+        self.file = file
+        if size is None:
+            size = len(content) if content is not None else os.path.getsize(file)
+        self.size = size
+        self.expires = expires
+        self.status = status
+
+    def exists(self):
+        return self.content is not None or os.path.exists(self.file)
+
+    def is_stale(self, now):
+        return self.expires is not None and self.expires <= now
+
+    def chunks(self):
+        """
+        :return: GENERATOR OF THE GZIPPED BYTES
+        """
+        if self.content is not None:
+            content = self.content
+            for i in xrange(0, len(content), CHUNK_SIZE):
+                yield content[i:i + CHUNK_SIZE]
+        else:
+            with open(self.file, "rb") as f:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield data
+
+    def stream(self, gzipped=True):
+        """
+        :param gzipped: False TO GET THE UNCOMPRESSED BYTES
+        :return: GENERATOR OF BYTES
+        """
+        if gzipped:
+            return self.chunks()
+        return _gunzip(self.chunks())
+
+
+class InFlight(object):
+    """
+    A GZIPPED BODY THAT IS STILL ARRIVING FROM UPSTREAM
+    ANY NUMBER OF CLIENTS CAN READ THE BYTES AS THEY ARE ADDED.  ONCE THE BODY
+    IS SPILLED TO A FILE, ONLY THE LATEST IN_FLIGHT_MEMORY BYTES ARE KEPT; A
+    READER FURTHER BEHIND READS FROM THE FILE
+    """
+
+    size = None  # NOT KNOWN UNTIL THE END
+
+    def __init__(self, status=200):
+        """
+        :param status: THE UPSTREAM STATUS CODE
+        """
+        self.status = status
+        self.locker = Lock("in flight")
+        self.chunks = deque()  # (offset, chunk) STILL IN MEMORY
+        self.received = 0  # BYTES ADDED SO FAR
+        self.file = None  # WHERE THE BYTES ARE SPILLED, IF THEY ARE
+        self.more = Signal()  # REPLACED EVERY TIME A CHUNK IS ADDED
+        self.done = False
+        self.failure = None
+
+    def exists(self):
+        return True
+
+    def add(self, chunk, file=None):
+        """
+        :param file: THE FILE THAT ALREADY HAS ALL THE BYTES, INCLUDING chunk (None IF NOT SPILLED)
+        """
+        with self.locker:
+            self.chunks.append((self.received, chunk))
+            self.received += len(chunk)
+            if file:
+                self.file = file
+                while len(self.chunks) > 1 and self.received - self.chunks[1][0] >= IN_FLIGHT_MEMORY:
+                    self.chunks.popleft()
+            more, self.more = self.more, Signal()
+        more.go()
+
+    def finish(self, file=None):
+        """
+        :param file: WHERE THE SPILLED BYTES ARE NOW (THE FILE IS RENAMED AT THE END)
+        """
+        with self.locker:
+            self.done = True
+            if file:
+                self.file = file
+        self.more.go()
+
+    def fail(self, cause):
+        with self.locker:
+            self.failure = cause
+            self.done = True
+        self.more.go()
+
+    def read_memory(self, offset):
+        """
+        LIKE read(), BUT NEVER BLOCKS
+        :return: SAME AS read(), OR (None, ON_DISK) IF THE BYTES AT offset ARE ONLY IN THE FILE
+        """
+        with self.locker:
+            if self.chunks and offset < self.chunks[0][0]:
+                return None, ON_DISK
+            for start, chunk in self.chunks:
+                if offset < start + len(chunk):
+                    return chunk[offset - start:], None
+            if self.failure is not None:
+                Log.error("Upstream failed while sending", cause=self.failure)
+            if self.done:
+                return None, None
+            return None, self.more
+
+    def read(self, offset):
+        """
+        :param offset: NUMBER OF BYTES ALREADY READ
+        :return: (BYTES AT offset, None), OR (None, Signal FOR MORE), OR (None, None) AT THE END
+        """
+        while True:
+            chunk, more = self.read_memory(offset)
+            if more is not ON_DISK:
+                return chunk, more
+            with self.locker:
+                file = self.file
+            # NO LONGER IN MEMORY
+            try:
+                with open(file, "rb") as f:
+                    f.seek(offset)
+                    return f.read(CHUNK_SIZE), None
+            except (IOError, OSError) as e:
+                with self.locker:
+                    if self.failure is not None:
+                        Log.error("Upstream failed while sending", cause=self.failure)
+                    if self.file != file:
+                        continue  # RENAMED WHILE WE LOOKED; TRY THE NEW NAME
+                    if self.done:
+                        Log.error("Can not read {{file}}", file=file, cause=e)
+                    more = self.more
+                more.wait()  # RENAMED, BUT NOT YET GIVEN TO finish()
+
+    def chunks_from_start(self):
+        offset = 0
+        while True:
+            chunk, more = self.read(offset)
+            if chunk is not None:
+                offset += len(chunk)
+                yield chunk
+            elif more is None:
+                return
+            else:
+                more.wait()
+
+    def stream(self, gzipped=True):
+        if gzipped:
+            return self.chunks_from_start()
+        return _gunzip(self.chunks_from_start())
+
+
+class BodyWriter(object):
+    """
+    GZIP THE UPSTREAM BYTES (UNLESS THEY ARE ALREADY GZIPPED) AS THEY ARRIVE
+    BODIES BIGGER THAN MAX_BLOB_SIZE ARE SPILLED TO A FILE IN directory
+    """
+
+    def __init__(self, gzipped, directory=None, tee=None):
+        """
+        :param gzipped: True IF THE BYTES GIVEN TO write() ARE ALREADY GZIPPED
+        :param directory: WHERE TO PUT LARGE BODIES (None TO KEEP EVERYTHING IN MEMORY)
+        :param tee: FUNCTION(chunk, file) TO RECEIVE EACH GZIPPED CHUNK, AS IT IS WRITTEN, WITH THE
+                    (FLUSHED) FILE IT IS IN, IF THE BODY HAS BEEN SPILLED
+        """
+        self.compressor = None if gzipped else zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.tee = tee
+        self.directory = directory
+        self.buffer = BytesIO()
+        self.temp = None  # FILENAME OF THE SPILLED BODY
+        self.file = None  # OPEN FILE OF THE SPILLED BODY
+        self.size = 0
+
+    def write(self, data):
+        if self.compressor:
+            data = self.compressor.compress(data)
+        self._write(data)
+
+    def _write(self, data):
+        if not data:
+            return
+        self.size += len(data)
+        if self.file:
+            self.file.write(data)
+        else:
+            self.buffer.write(data)
+            if self.directory and self.size > MAX_BLOB_SIZE:
+                _makedirs(self.directory)
+                self.temp = os.path.join(self.directory, Random.hex(20) + ".tmp")
+                self.file = open(self.temp, "wb")
+                self.file.write(self.buffer.getvalue())
+                self.buffer = None
+        if self.tee:
+            if self.file:
+                self.file.flush()  # SO THE tee CAN READ IT BACK
+            self.tee(data, self.temp)
+
+    def close(self, filename):
+        """
+        :param filename: WHERE THE BODY WILL LIVE, IF IT WAS SPILLED
+        :return: Body
+        """
+        if self.compressor:
+            self._write(self.compressor.flush())
+        if not self.file:
+            return Body(content=self.buffer.getvalue(), size=self.size)
+
+        self.file.close()
+        self.file = None
+        _makedirs(os.path.dirname(filename))
+        os.rename(self.temp, filename)
+        return Body(file=filename, size=self.size)
+
+    def abort(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.temp and os.path.exists(self.temp):
+            os.remove(self.temp)
+
 
+def _memory_size(pair):
+    body = pair[2]
+    if not isinstance(body, Body) or body.content is None:
+        return 0
+    return body.size
+
+
+def response_headers(headers, body, accept_gzip):
+    """
+    :param headers: JSON OF THE STORED HEADERS
+    :return: HEADERS TO SEND TO THE CLIENT
+    """
+    headers = json.loads(headers)
+    headers[str("Vary")] = str("Accept-Encoding")
+    if accept_gzip:
+        headers[str("Content-Encoding")] = str("gzip")
+        if body.size is not None:
+            headers[str("Content-Length")] = text_type(body.size)
+    return headers
 
+
+def _response(headers, body, accept_gzip, stats):
+    return Response(
+        _counted(body.stream(accept_gzip), stats),
+        status=body.status,
+        headers=response_headers(headers, body, accept_gzip),
+        direct_passthrough=True
+    )
+
+
+def _counted(chunks, stats):
+    for c in chunks:
+        stats.bytes_served += len(c)
+        yield c
+
+
+def _conditional_headers(headers):
+    """
+    :param headers: JSON OF THE HEADERS OF THE stale RESPONSE
+    :return: HEADERS TO ASK UPSTREAM IF THAT RESPONSE HAS CHANGED
+    """
+    output = {}
+    for k, v in json.loads(headers).items():
+        k = k.lower()
+        if k == "etag":
+            output[str("If-None-Match")] = v
+        elif k == "last-modified":
+            output[str("If-Modified-Since")] = v
+    return output
+
+
+def _gunzip(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for c in chunks:
+        data = decompressor.decompress(c)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
@@ -0,0 +1,522 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+import os
+import socket
+import sqlite3
+import zlib
+from contextlib import contextmanager
+from time import time
+
+from mo_dots import Data
+from mo_files import File
+from mo_kwargs import override
+from mo_logs import Log
+from mo_threads import Lock, Thread, Till, Signal
+from mo_times import SECOND, MINUTE, Duration
+
+from mo_hg.metrics import Histogram
+
+DEBUG = False
+ACCESS_FLUSH_PERIOD = 5 * SECOND  # HOW OFTEN THE ACCESS TIMES ARE WRITTEN TO THE DATABASE
+BUSY_TIMEOUT = 30  # SECONDS TO WAIT FOR ANOTHER WRITER TO FINISH
+MAX_IDLE_CONNECTIONS = 10
+EVICT_PERIOD = MINUTE  # HOW OFTEN TO CHECK THE budget, IF NOT TRIGGERED SOONER
+EVICT_TO = 0.9  # FRACTION OF budget TO EVICT DOWN TO, SO WE DO NOT EVICT ON EVERY put()
+EVICT_BATCH = 100  # ENTRIES DELETED PER TRANSACTION
+VACUUM_PAGES = 1000  # PAGES RETURNED TO THE FILE SYSTEM PER incremental_vacuum
+MMAP_SIZE = 256 * 1024 * 1024  # BYTES OF THE DATABASE MAPPED INTO MEMORY; THE PAGES ARE SHARED BY ALL PROCESSES
+
+SQL_CREATE = (
+    "CREATE TABLE IF NOT EXISTS cache ("
+    "   path TEXT PRIMARY KEY, "
+    "   headers TEXT, "
+    "   response BLOB, "  # GZIPPED BODY, OR NULL IF THE BODY IS IN file
+    "   file TEXT, "
+    "   size INTEGER, "  # BYTES OF GZIPPED BODY
+    "   timestamp REAL, "  # LAST ACCESS
+    "   expires REAL "  # WHEN THE RESPONSE MUST BE REVALIDATED, OR NULL IF IT NEVER CHANGES
+    ")"
+)
+SQL_INDEX = "CREATE INDEX IF NOT EXISTS cache_timestamp ON cache (timestamp)"
+SQL_GET = "SELECT headers, response, file, size, expires FROM cache WHERE path=?"
+SQL_PUT = "INSERT OR REPLACE INTO cache (path, headers, response, file, size, timestamp, expires) VALUES (?, ?, ?, ?, ?, ?, ?)"
+SQL_REFRESH = "UPDATE cache SET expires=? WHERE path=?"
+SQL_DELETE = "DELETE FROM cache WHERE path=?"
+SQL_TOUCH = "UPDATE cache SET timestamp=? WHERE path=? AND timestamp<?"
+SQL_SIZE = "SELECT size FROM cache WHERE path=?"
+SQL_TOTAL = "SELECT COUNT(1), SUM(size) FROM cache"
+SQL_IMPORT = "INSERT OR IGNORE INTO cache (path, headers, response, file, size, timestamp, expires) VALUES (?, ?, ?, ?, ?, ?, ?)"
+SQL_EXPORT = "SELECT path, headers, response, file, size, timestamp, expires FROM cache WHERE timestamp>=? ORDER BY timestamp DESC"
+SQL_OLDEST = "SELECT path, file, size FROM cache ORDER BY timestamp LIMIT ?"
+
+SQL_CREATE_LEASES = (
+    "CREATE TABLE IF NOT EXISTS leases ("
+    "   path TEXT PRIMARY KEY, "
+    "   owner TEXT, "  # THE PROCESS FETCHING path FROM UPSTREAM
+    "   expires REAL "
+    ")"
+)
+SQL_EXPIRE_LEASE = "DELETE FROM leases WHERE path=? AND expires<?"
+SQL_LEASE = "INSERT OR IGNORE INTO leases (path, owner, expires) VALUES (?, ?, ?)"
+SQL_LEASE_OWNER = "SELECT owner FROM leases WHERE path=?"
+SQL_RELEASE = "DELETE FROM leases WHERE path=? AND owner=?"
+SQL_RELEASE_ALL = "DELETE FROM leases WHERE owner=?"
+PEEK_BATCH = 500  # paths PER peek() QUERY (SQLITE ALLOWS 999 PARAMETERS)
+
+SQL_CREATE_BUCKETS = "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, last REAL)"
+SQL_BUCKET_GET = "SELECT tokens, last FROM buckets WHERE name=?"
+SQL_BUCKET_PUT = "INSERT OR REPLACE INTO buckets (name, tokens, last) VALUES (?, ?, ?)"
+
+
+class CacheDB(object):
+    """
+    THE SQLITE TABLE BEHIND THE RELAY CACHE
+    THE DATABASE IS IN WAL MODE, AND EACH THREAD BORROWS ITS OWN CONNECTION, SO
+    READERS DO NOT WAIT ON THE WRITER.  ALL STATEMENTS ARE PARAMETERIZED, SO
+    sqlite3 CAN REUSE THE PREPARED STATEMENTS OF EACH CONNECTION.
+    ACCESS TIMES ARE KEPT IN MEMORY, AND WRITTEN IN ONE TRANSACTION EVERY flush_period
+    WHEN OVER budget, THE LEAST RECENTLY USED ENTRIES (AND THEIR FILES) ARE
+    DELETED, AND THE FREED PAGES ARE VACUUMED IN THE BACKGROUND
+    PROCESSES SHARING THE DATABASE ALSO SHARE leases (SO ONLY ONE FETCHES A path)
+    AND THE RATE LIMIT buckets
+    """
+
+    @override
+    def __init__(self, filename, flush_period=ACCESS_FLUSH_PERIOD, budget=None, mmap_size=MMAP_SIZE, daemons=True, kwargs=None):
+        """
+        :param filename: FILE FOR THE DATABASE
+        :param flush_period: HOW OFTEN TO WRITE THE ACCESS TIMES
+        :param budget: MAXIMUM BYTES OF BODIES (None FOR NO LIMIT)
+        :param mmap_size: BYTES OF THE DATABASE TO READ THROUGH A MEMORY MAP (0 TO USE READ())
+        :param daemons: False TO NOT FLUSH ACCESS TIMES, OR EVICT, IN THE BACKGROUND (FOR TOOLS)
+        """
+        self.filename = File(filename).abspath
+        self.flush_period = Duration(flush_period)
+        self.budget = budget
+        self.mmap_size = mmap_size
+        self.owner = socket.gethostname() + ":" + str(os.getpid())
+        self.total_size = 0  # BYTES OF BODIES, AS LAST READ, PLUS OUR OWN puts (OTHER PROCESSES MAY CHANGE THE TABLE)
+        self.count = 0  # NUMBER OF ENTRIES, AS LAST READ, PLUS OUR OWN puts
+        self.evicted = Data(entries=0, bytes=0)
+        self.write_wait = Histogram()  # SECONDS WAITING FOR THE WRITE LOCK (CONTENTION)
+        self.over_budget = Signal("cache over budget")
+        self.pool_locker = Lock("cache db connections")
+        self.pool = []  # IDLE CONNECTIONS
+        self.write_locker = Lock("cache db writes")
+        self.access_locker = Lock("cache db access times")
+        self.accessed = {}  # MAP FROM path TO LATEST ACCESS TIME, NOT YET WRITTEN
+        self.incremental = False  # True IF THE FREED PAGES CAN BE VACUUMED A FEW AT A TIME
+
+        with self.write_locker:
+            with self._connection() as db:
+                db.execute("PRAGMA auto_vacuum=INCREMENTAL")  # ONLY TAKES EFFECT ON A NEW DATABASE, OR AFTER VACUUM
+                db.execute("PRAGMA journal_mode=WAL")
+                columns = [c[1] for c in db.execute("PRAGMA table_info(cache)").fetchall()]
+                if columns and "size" not in columns:
+                    _convert_text_cache(db)
+                elif columns and "expires" not in columns:
+                    # OLD ENTRIES MAY BE STALE; REVALIDATE EACH ONCE
+                    db.execute("ALTER TABLE cache ADD COLUMN expires REAL")
+                    db.execute("UPDATE cache SET expires=0")
+                db.execute(SQL_CREATE)
+                db.execute(SQL_INDEX)
+                db.execute(SQL_CREATE_LEASES)
+                db.execute(SQL_CREATE_BUCKETS)
+                db.execute(SQL_RELEASE_ALL, (self.owner,))  # LEFT BY A DEAD PROCESS WITH OUR pid
+                count, total = db.execute(SQL_TOTAL).fetchone()
+                self.count, self.total_size = count, total or 0
+                self.incremental = db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+        if not self.incremental:
+            Log.note("{{file}} does not allow incremental vacuum; run relay_pack --vacuum while the relay is down", file=self.filename)
+
+        self.flusher = None
+        self.evicter = None
+        if daemons:
+            self.flusher = Thread.run("flush cache access times", self._flush_daemon)
+            self.evicter = Thread.run("evict cache entries", self._evict_daemon)
+
+    @contextmanager
+    def _connection(self):
+        with self.pool_locker:
+            db = self.pool.pop() if self.pool else None
+        if db is None:
+            db = sqlite3.connect(
+                database=self.filename,
+                timeout=BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False
+            )
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA mmap_size=" + str(int(self.mmap_size)))
+        try:
+            yield db
+        finally:
+            with self.pool_locker:
+                if len(self.pool) < MAX_IDLE_CONNECTIONS:
+                    self.pool.append(db)
+                    db = None
+            if db is not None:
+                db.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        :return: CONNECTION, IN A TRANSACTION; COMMITTED ON EXIT, ROLLED BACK ON EXCEPTION
+        """
+        start = time()
+        with self.write_locker:
+            with self._connection() as db:
+                db.execute("BEGIN IMMEDIATE")
+                self.write_wait.add(time() - start)
+                try:
+                    yield db
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+                db.execute("COMMIT")
+
+    def query(self, sql, params=()):
+        """
+        :return: LIST OF ROWS
+        """
+        with self._connection() as db:
+            return db.execute(sql, params).fetchall()
+
+    def get(self, path):
+        """
+        :return: (headers, response, file, size, expires) TUPLE, OR None
+        """
+        rows = self.query(SQL_GET, (path,))
+        if not rows:
+            return None
+        headers, response, file, size, expires = rows[0]
+        return headers, bytes(response) if response is not None else None, file, size, expires
+
+    def totals(self):
+        """
+        READ THE COUNT AND SIZE OF THE WHOLE TABLE, INCLUDING THE CHANGES MADE BY OTHER PROCESSES
+        :return: (count, total_size)
+        """
+        count, total = self.query(SQL_TOTAL)[0]
+        self.count, self.total_size = count, total or 0
+        return self.count, self.total_size
+
+    def has(self, path):
+        """
+        :return: True IF THERE IS AN ENTRY FOR path
+        """
+        return bool(self.query(SQL_SIZE, (path,)))
+
+    def put(self, path, headers, content, file, size, timestamp, expires=None):
+        with self.transaction() as db:
+            old = db.execute(SQL_SIZE, (path,)).fetchone()
+            if old:
+                self.count -= 1
+                self.total_size -= old[0] or 0
+            self.count += 1
+            self.total_size += size
+            db.execute(SQL_PUT, (
+                path,
+                headers,
+                sqlite3.Binary(content) if content is not None else None,
+                file,
+                size,
+                timestamp,
+                expires
+            ))
+        with self.access_locker:
+            self.accessed.pop(path, None)
+        if self.budget and self.total_size > self.budget:
+            self.over_budget.go()
+
+    def refresh(self, path, expires):
+        """
+        UPSTREAM SAYS THE RESPONSE HAS NOT CHANGED; USE IT UNTIL expires
+        """
+        with self.transaction() as db:
+            db.execute(SQL_REFRESH, (expires, path))
+
+    def put_many(self, rows):
+        """
+        INSERT MANY ENTRIES IN ONE TRANSACTION; EXISTING ENTRIES ARE KEPT
+        :param rows: LIST OF (path, headers, content, file, size, timestamp, expires)
+        """
+        with self.transaction() as db:
+            db.executemany(SQL_IMPORT, (
+                (path, headers, sqlite3.Binary(content) if content is not None else None, file, size, timestamp, expires)
+                for path, headers, content, file, size, timestamp, expires in rows
+            ))
+            count, total = db.execute(SQL_TOTAL).fetchone()
+            self.count, self.total_size = count, total or 0
+        if self.budget and self.total_size > self.budget:
+            self.over_budget.go()
+
+    def rows(self, since=None):
+        """
+        :param since: UNIX TIME OF THE OLDEST ACCESS TO INCLUDE
+        :return: GENERATOR OF (path, headers, content, file, size, timestamp, expires), MOST RECENTLY USED FIRST
+        """
+        with self._connection() as db:
+            for path, headers, content, file, size, timestamp, expires in db.execute(SQL_EXPORT, (since or 0,)):
+                yield path, headers, bytes(content) if content is not None else None, file, size, timestamp, expires
+
+    def delete(self, path):
+        with self.transaction() as db:
+            old = db.execute(SQL_SIZE, (path,)).fetchone()
+            if old:
+                self.count -= 1
+                self.total_size -= old[0] or 0
+            db.execute(SQL_DELETE, (path,))
+
+    def lease(self, path, seconds):
+        """
+        CLAIM THE RIGHT TO FETCH path FROM UPSTREAM, FOR seconds
+        :return: True IF CLAIMED (OR ALREADY OURS), False IF ANOTHER PROCESS HOLDS IT
+        """
+        now = time()
+        with self.transaction() as db:
+            db.execute(SQL_EXPIRE_LEASE, (path, now))
+            db.execute(SQL_LEASE, (path, self.owner, now + seconds))
+            return db.execute(SQL_LEASE_OWNER, (path,)).fetchone()[0] == self.owner
+
+    def peek(self, paths, now):
+        """
+        READ-ONLY CHECK ON paths OTHER PROCESSES ARE FETCHING; TAKES NO LOCKS
+        :param paths: LIST OF paths
+        :param now: UNIX TIME
+        :return: (expires, leased) WHERE expires MAPS EACH path IN THE DATABASE TO ITS expires,
+                 AND leased IS THE SET OF paths WITH A LEASE THAT HAS NOT EXPIRED
+        """
+        expires = {}
+        leased = set()
+        with self._connection() as db:
+            for i in range(0, len(paths), PEEK_BATCH):
+                batch = paths[i:i + PEEK_BATCH]
+                params = ",".join("?" * len(batch))
+                for path, e in db.execute("SELECT path, expires FROM cache WHERE path IN (" + params + ")", batch):
+                    expires[path] = e
+                for path, in db.execute("SELECT path FROM leases WHERE expires>=? AND path IN (" + params + ")", [now] + batch):
+                    leased.add(path)
+        return expires, leased
+
+    def release(self, path):
+        with self.transaction() as db:
+            db.execute(SQL_RELEASE, (path, self.owner))
+
+    def token_bucket(self, name, rate, capacity):
+        """
+        :return: TOKEN BUCKET SHARED BY ALL PROCESSES USING THIS DATABASE
+        """
+        return SharedTokenBucket(self, name, rate, capacity)
+
+    def touch(self, path, timestamp):
+        """
+        RECORD AN ACCESS; IT WILL BE WRITTEN WITH THE NEXT flush()
+        """
+        with self.access_locker:
+            if self.accessed.get(path, 0) < timestamp:
+                self.accessed[path] = timestamp
+
+    def flush(self):
+        with self.access_locker:
+            accessed, self.accessed = self.accessed, {}
+        if not accessed:
+            return
+        with self.transaction() as db:
+            db.executemany(SQL_TOUCH, ((t, p, t) for p, t in accessed.items()))
+        DEBUG and Log.note("wrote {{num}} access times", num=len(accessed))
+
+    def stop(self):
+        for thread in (self.flusher, self.evicter):
+            if thread is not None:
+                thread.stop()
+                thread.join()
+
+    def _flush_daemon(self, please_stop):
+        while True:
+            (please_stop | Till(seconds=self.flush_period.seconds)).wait()
+            try:
+                self.flush()
+            except Exception as e:
+                Log.warning("Problem writing access times", cause=e)
+            if please_stop:
+                break
+
+    def evict(self):
+        """
+        DELETE THE LEAST RECENTLY USED ENTRIES UNTIL WE ARE UNDER EVICT_TO OF budget
+        :return: NUMBER OF ENTRIES EVICTED
+        """
+        if not self.budget:
+            return 0
+        # OTHER PROCESSES SHARING THE DATABASE ADD AND EVICT TOO; OUR COUNTERS ARE ONLY A HINT
+        count, total = self.totals()
+        if total <= self.budget:
+            return 0
+        self.flush()  # SO THE TIMESTAMPS ARE CURRENT
+        target = self.budget * EVICT_TO
+        num = 0
+        while True:
+            files = []
+            with self.transaction() as db:
+                count, total = db.execute(SQL_TOTAL).fetchone()
+                total = total or 0
+                if total <= target:
+                    self.count, self.total_size = count, total
+                    break
+                rows = db.execute(SQL_OLDEST, (EVICT_BATCH,)).fetchall()
+                for path, file, size in rows:
+                    if total <= target:
+                        break
+                    db.execute(SQL_DELETE, (path,))
+                    count -= 1
+                    total -= size or 0
+                    self.evicted.entries += 1
+                    self.evicted.bytes += size or 0
+                    num += 1
+                    if file:
+                        files.append(file)
+                self.count, self.total_size = count, total
+            for file in files:
+                try:
+                    os.remove(file)
+                except Exception as e:
+                    DEBUG and Log.note("Can not remove {{file}}", file=file, cause=e)
+        DEBUG and Log.note("evicted {{num}} entries from cache", num=num)
+        return num
+
+    def vacuum(self):
+        """
+        RETURN SOME OF THE FREE PAGES TO THE FILE SYSTEM
+        """
+        if not self.incremental:
+            return
+        with self.write_locker:
+            with self._connection() as db:
+                db.execute("PRAGMA incremental_vacuum(" + str(int(VACUUM_PAGES)) + ")").fetchall()
+
+    def convert_to_incremental(self):
+        """
+        REWRITE THE WHOLE DATABASE SO FREED PAGES CAN BE VACUUMED A FEW AT A TIME
+        THIS TAKES MINUTES ON A LARGE CACHE, AND LOCKS OUT ALL OTHER PROCESSES, SO
+        IT IS ONLY DONE ON REQUEST (relay_pack --vacuum), WHILE THE RELAY IS DOWN
+        """
+        if self.incremental:
+            return
+        Log.note("Vacuum {{file}}, to allow incremental vacuum", file=self.filename)
+        with self.write_locker:
+            with self._connection() as db:
+                db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                db.execute("VACUUM")
+                self.incremental = db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def _evict_daemon(self, please_stop):
+        while not please_stop:
+            (please_stop | self.over_budget | Till(seconds=EVICT_PERIOD.seconds)).wait()
+            if please_stop:
+                break
+            self.over_budget = Signal("cache over budget")
+            try:
+                if self.evict():
+                    self.vacuum()
+            except Exception as e:
+                Log.warning("Problem evicting from cache", cause=e)
+
+
+def _convert_text_cache(db):
+    """
+    THE FIRST cache TABLE KEPT EACH BODY, AS RECEIVED, IN A latin1 TEXT COLUMN;
+    CONVERT THE ROWS TO GZIPPED BLOBS, IN ONE TRANSACTION
+    """
+    from mo_hg.cache import IGNORED_RESPONSE_HEADERS, COMPRESSION_LEVEL
+
+    Log.note("Old cache table format, converting to gzipped bodies")
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("ALTER TABLE cache RENAME TO old_cache")
+        db.execute(SQL_CREATE)
+        converted, dropped = 0, 0
+        for path, headers, response, timestamp in db.cursor().execute("SELECT path, headers, response, timestamp FROM old_cache"):
+            try:
+                headers = json.loads(headers) if headers else {}
+                body = (response or "").encode("latin1")
+                encoding = ([v.lower() for k, v in headers.items() if k.lower() == "content-encoding"] + ["identity"])[0]
+                if encoding == "identity":
+                    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    body = compressor.compress(body) + compressor.flush()
+                elif encoding != "gzip":
+                    dropped += 1
+                    continue
+                headers = json.dumps({k: v for k, v in headers.items() if k.lower() not in IGNORED_RESPONSE_HEADERS})
+                # expires=0: REVALIDATE EACH ONCE
+                db.execute(SQL_PUT, (path, headers, sqlite3.Binary(body), None, len(body), timestamp, 0))
+                converted += 1
+            except Exception as e:
+                DEBUG and Log.note("can not convert {{path}}", path=path, cause=e)
+                dropped += 1
+        db.execute("DROP TABLE old_cache")
+        db.execute("COMMIT")
+    except Exception as e:
+        db.execute("ROLLBACK")
+        Log.error("Can not convert the old cache table", cause=e)
+    Log.note("Converted {{num}} cache entries ({{dropped}} dropped)", num=converted, dropped=dropped)
+
+
+class SharedTokenBucket(object):
+    """
+    SAME AS scheduler.TokenBucket, BUT THE TOKENS ARE KEPT IN THE DATABASE
+    SO ALL PROCESSES DRAW FROM THE SAME rate
+    """
+
+    def __init__(self, db, name, rate, capacity=None):
+        self.db = db
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity or rate))
+
+    def _refill(self, row, now):
+        """
+        :return: (tokens, last) AT now
+        """
+        if not row:
+            return self.capacity, now
+        tokens, last = row
+        if now > last:
+            return min(self.capacity, tokens + (now - last) * self.rate), now
+        return tokens, last
+
+    def _wait(self, tokens):
+        if tokens >= 1:
+            return 0
+        return (1 - tokens) / self.rate
+
+    def wait_time(self, now):
+        rows = self.db.query(SQL_BUCKET_GET, (self.name,))
+        tokens, _ = self._refill(rows[0] if rows else None, now)
+        return self._wait(tokens)
+
+    def take(self, now):
+        with self.db.transaction() as db:
+            tokens, last = self._refill(db.execute(SQL_BUCKET_GET, (self.name,)).fetchone(), now)
+            db.execute(SQL_BUCKET_PUT, (self.name, tokens - 1, last))
+
+    def acquire(self, now):
+        with self.db.transaction() as db:
+            tokens, last = self._refill(db.execute(SQL_BUCKET_GET, (self.name,)).fetchone(), now)
+            wait = self._wait(tokens)
+            if wait <= 0:
+                db.execute(SQL_BUCKET_PUT, (self.name, tokens - 1, last))
+        return wait
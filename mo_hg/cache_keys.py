@@ -0,0 +1,150 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import re
+from collections import OrderedDict
+
+from mo_threads import Lock
+
+MIN_PREFIX = 12  # SHORTEST HASH WE RESOLVE; hg SHOWS 12 CHARACTERS
+MAX_NODES = 100000  # NODES REMEMBERED BY THE PREFIX INDEX
+REV_ENDPOINTS = {
+    "annotate", "json-annotate",
+    "diff", "json-diff",
+    "file", "json-file", "raw-file",
+    "json-info",
+    "log", "json-log",
+    "rev", "json-rev", "raw-rev"
+}  # ENDPOINTS FOLLOWED BY A REVISION
+REV_PARAMS = {"changeset", "node"}  # QUERY PARAMETERS THAT HOLD A REVISION
+STYLED_ENDPOINTS = {
+    ("rev", "json"): "json-rev",
+    ("rev", "raw"): "raw-rev",
+    ("file", "json"): "json-file",
+    ("file", "raw"): "raw-file",
+    ("log", "json"): "json-log",
+    ("annotate", "json"): "json-annotate",
+    ("diff", "json"): "json-diff"
+}  # /rev/X?style=json IS THE SAME AS /json-rev/X
+NODE_SOURCES = ["/json-rev/", "/json-pushes", "/json-log/", "/json-info/"]  # RESPONSES WORTH SCANNING FOR NODES
+NODES = re.compile(r"(?<![0-9a-fA-F])[0-9a-fA-F]{40}(?![0-9a-fA-F])")
+NODE = re.compile(r"^[0-9a-fA-F]{40}$")
+PREFIX = re.compile(r"^[0-9a-fA-F]{" + str(MIN_PREFIX) + r",39}$")
+AMBIGUOUS = "ambiguous"
+
+
+class NodeIndex(object):
+    """
+    REMEMBER FULL NODES, SO A HASH PREFIX CAN BE EXPANDED WITHOUT ASKING hg
+    A PREFIX MATCHING MORE THAN ONE KNOWN NODE IS NOT EXPANDED
+    """
+
+    def __init__(self, size=MAX_NODES):
+        self.size = size
+        self.locker = Lock("node index")
+        self.nodes = OrderedDict()  # MAP FROM MIN_PREFIX CHARACTERS TO FULL NODE (OR AMBIGUOUS), OLDEST FIRST
+
+    def learn(self, node):
+        node = node.lower()
+        key = node[:MIN_PREFIX]
+        with self.locker:
+            known = self.nodes.get(key)
+            if known is None:
+                self.nodes[key] = node
+                if len(self.nodes) > self.size:
+                    self.nodes.popitem(last=False)
+            elif known != node:
+                self.nodes[key] = AMBIGUOUS
+
+    def learn_all(self, text):
+        """
+        LEARN EVERY NODE MENTIONED IN text
+        """
+        for node in set(NODES.findall(text)):
+            self.learn(node)
+
+    def resolve(self, prefix):
+        """
+        :return: FULL NODE FOR prefix, OR None IF NOT KNOWN (OR AMBIGUOUS)
+        """
+        prefix = prefix.lower()
+        if len(prefix) < MIN_PREFIX:
+            return None
+        node = self.nodes.get(prefix[:MIN_PREFIX])
+        if node is None or node == AMBIGUOUS or not node.startswith(prefix):
+            return None
+        return node
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+class CacheKeys(object):
+    """
+    REWRITE RELAY PATHS SO REQUESTS FOR THE SAME CONTENT SHARE ONE CACHE ENTRY
+    * QUERY PARAMETERS ARE SORTED
+    * /rev/X?style=json IS REWRITTEN AS /json-rev/X (AND SIMILAR)
+    * REVISIONS ARE LOWER CASE, AND HASH PREFIXES ARE EXPANDED TO FULL NODES, WHEN KNOWN (FROM learn())
+    THE CANONICAL PATH IS ALSO WHAT IS SENT UPSTREAM, SO IT MUST ASK FOR THE SAME CONTENT
+    """
+
+    def __init__(self, index=None):
+        self.index = index if index is not None else NodeIndex()
+
+    def canonical(self, path):
+        path, _, query = path.partition("?")
+        params = [p for p in query.split("&") if p]
+
+        # /cmd/X?style=S -> /S-cmd/X
+        segments = path.split("/")
+        style = [p for p in params if p.startswith("style=")]
+        if len(style) == 1:
+            s = style[0][6:]
+            for i, seg in enumerate(segments):
+                endpoint = STYLED_ENDPOINTS.get((seg, s))
+                if endpoint:
+                    segments[i] = endpoint
+                    params.remove(style[0])
+                    break
+
+        # THE REVISION FOLLOWS THE FIRST ENDPOINT
+        for i, seg in enumerate(segments[:-1]):
+            if seg in REV_ENDPOINTS:
+                segments[i + 1] = self._revision(segments[i + 1])
+                break
+
+        for i, p in enumerate(params):
+            name, eq, value = p.partition("=")
+            if name in REV_PARAMS:
+                params[i] = name + eq + self._revision(value)
+
+        path = "/".join(segments)
+        if params:
+            params.sort(key=lambda p: p.partition("=")[0])  # STABLE, SO REPEATED PARAMETERS KEEP THEIR ORDER
+            path += "?" + "&".join(params)
+        return path
+
+    def _revision(self, rev):
+        # A CLIENT CAN ASK FOR ANY NODE; ONLY THE RESPONSES FROM hg TEACH THE index
+        if NODE.match(rev):
+            return rev.lower()
+        if PREFIX.match(rev):
+            return self.index.resolve(rev) or rev.lower()
+        return rev
+
+    def learn(self, path, chunks):
+        """
+        LEARN THE NODES IN THE RESPONSE FOR path
+        :param chunks: GENERATOR OF THE (UNCOMPRESSED) RESPONSE BYTES; NOT READ UNLESS path IS IN NODE_SOURCES
+        """
+        if any(e in path for e in NODE_SOURCES):
+            self.index.learn_all(b"".join(chunks).decode("utf8", "replace"))
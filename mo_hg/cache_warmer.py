@@ -0,0 +1,115 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from collections import deque
+
+from mo_dots import Data, listwrap
+from mo_future import text_type
+from mo_json import json2value
+from mo_kwargs import override
+from mo_logs import Log
+from mo_logs.strings import expand_template
+from mo_threads import Thread, Till
+from mo_times import Date, SECOND, Duration
+
+DEBUG = False
+WARM_LANE = "warm"
+WARM_PERIOD = 30 * SECOND  # HOW OFTEN TO ASK EACH BRANCH FOR NEW PUSHES
+WARM_RATE = 2  # UPSTREAM REQUESTS PER SECOND FOR WARMING
+WARM_WEIGHT = 1  # SHARE OF THE UPSTREAM rate, WHEN CLIENTS ARE ALSO WAITING
+MAX_QUEUED = 10  # WARMING REQUESTS IN THE SCHEDULER AT ONCE; A CLIENT ASKING FOR ONE WAITS IN THE WARM LANE
+FEED_INTERVAL = SECOND
+WARM_PATHS = [
+    "{{branch}}/json-rev/{{node}}",
+    "{{branch}}/raw-rev/{{node}}",
+    "{{branch}}/json-pushes?full=1&changeset={{node}}"
+]
+
+
+class CacheWarmer(object):
+    """
+    TAIL json-pushes OF THE GIVEN branches, AND FETCH THE paths OF EVERY NEW
+    CHANGESET BEFORE ANY CLIENT ASKS FOR THEM.  THE FETCHES (INCLUDING THE
+    json-pushes) GO THROUGH THEIR OWN Scheduler LANE, SO WARMING HAS ITS OWN
+    rate, AND GIVES WAY TO CLIENTS
+    """
+
+    @override
+    def __init__(self, cache, branches, period=WARM_PERIOD, rate=WARM_RATE, paths=WARM_PATHS, kwargs=None):
+        """
+        :param cache: THE RELAY Cache
+        :param branches: LIST OF BRANCH PATHS (eg "mozilla-central", "integration/autoland")
+        :param period: HOW OFTEN TO ASK FOR NEW PUSHES
+        :param rate: UPSTREAM REQUESTS PER SECOND FOR WARMING
+        :param paths: TEMPLATES, WITH {{branch}} AND {{node}}, OF THE PATHS TO FETCH FOR EACH CHANGESET
+        """
+        self.cache = cache
+        self.branches = [b.strip("/") for b in listwrap(branches)]
+        self.period = Duration(period)
+        self.paths = listwrap(paths)
+        self.last_push = {}  # MAP FROM BRANCH TO THE LAST PUSH ID SEEN
+        self.pending = deque()  # PATHS NOT YET GIVEN TO THE SCHEDULER
+        self.warmed = Data(pushes=0, changesets=0, requests=0)
+        self.lane = cache.scheduler.add_lane(WARM_LANE, weight=WARM_WEIGHT, rate=rate, paths=[])
+        self.thread = Thread.run("warm relay cache", self._daemon)
+
+    def tail(self, branch):
+        """
+        QUEUE THE paths OF THE CHANGESETS PUSHED TO branch SINCE THE LAST CALL
+        (THE FIRST CALL GETS THE LAST FEW PUSHES)
+        """
+        path = branch + "/json-pushes?version=2"
+        last = self.last_push.get(branch)
+        if last is not None:
+            path += "&startID=" + text_type(last)
+        # THROUGH THE WARM LANE, SO IT COUNTS AGAINST THE UPSTREAM rate, AND GIVES WAY TO CLIENTS
+        status, content = self.cache.get(path, WARM_LANE)
+        if status != 200:
+            Log.error("Can not get {{path}}, status {{status}}", path=path, status=status)
+        response = json2value(content.decode("utf8"))
+
+        for push_id, push in sorted(response.pushes.items(), key=lambda p: int(p[0])):
+            self.warmed.pushes += 1
+            for node in push.changesets:
+                self.warmed.changesets += 1
+                for p in self.paths:
+                    self.pending.append(expand_template(p, {"branch": branch, "node": node}))
+        if response.lastpushid:
+            self.last_push[branch] = response.lastpushid
+
+    def feed(self):
+        """
+        GIVE PENDING PATHS TO THE SCHEDULER, WITHOUT FILLING THE WARM LANE
+        """
+        while self.pending and len(self.lane.queue) < MAX_QUEUED:
+            path = self.pending.popleft()
+            try:
+                if self.cache.warm(path, WARM_LANE):
+                    self.warmed.requests += 1
+                    DEBUG and Log.note("warming {{path}}", path=path)
+            except Exception as e:
+                Log.warning("Problem warming {{path}}", path=path, cause=e)
+
+    def _daemon(self, please_stop):
+        next_tail = Date.now()
+        while not please_stop:
+            if Date.now() >= next_tail:
+                next_tail = Date.now() + self.period
+                for branch in self.branches:
+                    if please_stop:
+                        break
+                    try:
+                        self.tail(branch)
+                    except Exception as e:
+                        Log.warning("Problem reading pushes of {{branch}}", branch=branch, cause=e)
+            self.feed()
+            (please_stop | Till(seconds=FEED_INTERVAL.seconds)).wait()
@@ -0,0 +1,72 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import os
+import zlib
+
+from mo_files import File
+from mo_future import text_type
+from mo_json import value2json, json2value
+from mo_kwargs import override
+from mo_logs import Log
+from mo_math.randoms import Random
+
+DEBUG = False
+
+
+class DiffStore(object):
+    """
+    SIDE STORAGE FOR DIFFS TOO BIG TO KEEP IN THE REVISION DOCUMENT
+    EACH FILE'S changes ARE A SEPARATE COMPRESSED CHUNK, KEYED BY (id12, file index)
+    THE REVISION KEEPS A MANIFEST: THE FILE NAMES, THE chunk INDEX, AND num_changes
+    """
+
+    @override
+    def __init__(self, directory, kwargs=None):
+        self.directory = File(directory)
+
+    def save(self, changeset_id, json_diff):
+        """
+        MOVE THE changes OF EVERY FILE TO A CHUNK
+        :param changeset_id: CHANGESET ID
+        :param json_diff: DIFF, AS RETURNED BY diff_to_json()
+        :return: THE MANIFEST (json_diff WITHOUT changes)
+        """
+        for i, file in enumerate(json_diff):
+            changes = file.changes
+            self._write(self._chunk_file(changeset_id, i), value2json(changes).encode("utf8"))
+            file.changes = None
+            file.chunk = i
+            file.num_changes = len(changes)
+        return json_diff
+
+    def get_changes(self, changeset_id, chunk):
+        """
+        :return: THE changes FOR ONE FILE, OR None IF NOT STORED
+        """
+        file = self._chunk_file(changeset_id, chunk)
+        try:
+            content = file.read_bytes()
+        except Exception as e:
+            DEBUG and Log.note("no chunk {{file}}", file=file.abspath, cause=e)
+            return None
+        return json2value(zlib.decompress(content).decode("utf8"))
+
+    def _chunk_file(self, changeset_id, chunk):
+        id12 = changeset_id[:12]
+        return self.directory / id12[:2] / id12 / (text_type(chunk) + ".json.z")
+
+    def _write(self, file, content):
+        # WRITE TO TEMP FILE, THEN RENAME, SO READERS NEVER SEE A PARTIAL CHUNK
+        temp = File(file.abspath + "." + Random.hex(8) + ".tmp")
+        temp.write_bytes(zlib.compress(content))
+        os.rename(temp.abspath, file.abspath)
@@ -0,0 +1,293 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import struct
+import sys
+import zlib
+from array import array
+
+from mo_dots import listwrap
+from mo_files import File
+from mo_logs import Log
+from mo_threads import Lock
+
+NO_PARENT = -1
+FILE_MAGIC = b"MOHGDAG1"
+
+
+class CommitGraph(object):
+    """
+    COMPACT COMMIT GRAPH FOR A SINGLE BRANCH
+    EACH CHANGESET IS GIVEN AN INTEGER node; PARENTS AND GENERATION NUMBERS ARE
+    KEPT IN ARRAYS INDEXED BY node.  A CHANGESET SEEN ONLY AS A PARENT IS A
+    PLACEHOLDER UNTIL ITS OWN PARENTS ARE ADDED.  THE generation OF A node
+    WITH A PLACEHOLDER IN ITS ANCESTRY IS ONLY A LOWER BOUND, SO IT IS NOT
+    USED TO PRUNE SEARCHES
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.locker = Lock("commit graph " + (name or ""))
+        self.ids = {}  # MAP FROM 12-CHARACTER ID TO node
+        self.nodes = []  # MAP FROM node TO (LONGEST KNOWN) CHANGESET ID
+        self.parent1 = array(str("i"))
+        self.parent2 = array(str("i"))
+        self.generation = array(str("i"))  # LONGEST PATH TO A ROOT, PLUS ONE; PLACEHOLDERS ARE ZERO
+        self.known = bytearray()  # 1 IF THE PARENTS OF node ARE KNOWN
+        self.complete = bytearray()  # 1 IF ALL ANCESTORS OF node ARE KNOWN (SO generation IS EXACT)
+        self.dirty = False  # True IF generation MUST BE RECOMPUTED
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, id):
+        return id[:12] in self.ids
+
+    def add(self, id, parents):
+        """
+        ADD (OR COMPLETE) A CHANGESET
+        :param id: CHANGESET ID
+        :param parents: LIST OF PARENT CHANGESET IDS
+        :return: node
+        """
+        with self.locker:
+            return self._add(id, parents)
+
+    def extend(self, pairs):
+        """
+        :param pairs: ITERABLE OF (id, parents) PAIRS
+        """
+        with self.locker:
+            for id, parents in pairs:
+                self._add(id, parents)
+
+    def add_revision(self, revision):
+        if not revision.changeset.id:
+            return None
+        return self.add(revision.changeset.id, listwrap(revision.parents))
+
+    def _add(self, id, parents):
+        existed = id[:12] in self.ids
+        n = self._node(id)
+        if self.known[n]:
+            return n
+        ps = [self._node(p) for p in parents if p and p[:12] != id[:12]]
+        if len(ps) > 2:
+            Log.error("Expecting no more than two parents for {{id}}", id=id)
+        self.parent1[n] = ps[0] if ps else NO_PARENT
+        self.parent2[n] = ps[1] if len(ps) > 1 else NO_PARENT
+        self.known[n] = 1
+        self.generation[n] = 1 + max([self.generation[p] for p in ps] or [0])
+        self.complete[n] = 1 if all(self.complete[p] for p in ps) else 0
+        if existed:
+            # A PLACEHOLDER MAY ALREADY HAVE CHILDREN, WHICH ARE NOW TOO LOW, OR NOW COMPLETE
+            self.dirty = True
+        return n
+
+    def _node(self, id):
+        short = id[:12]
+        n = self.ids.get(short)
+        if n is None:
+            n = self.ids[short] = len(self.nodes)
+            self.nodes.append(id)
+            self.parent1.append(NO_PARENT)
+            self.parent2.append(NO_PARENT)
+            self.generation.append(0)
+            self.known.append(0)
+            self.complete.append(0)
+        elif len(id) > len(self.nodes[n]):
+            self.nodes[n] = id
+        return n
+
+    def _refresh(self):
+        # ASSUME LOCKED
+        if not self.dirty:
+            return
+        generation, complete = self.generation, self.complete
+        parent1, parent2, known = self.parent1, self.parent2, self.known
+        done = bytearray(len(self.nodes))
+        for start in range(len(self.nodes)):
+            if done[start]:
+                continue
+            stack = [start]
+            while stack:
+                n = stack[-1]
+                if done[n]:
+                    stack.pop()
+                    continue
+                if not known[n]:
+                    generation[n] = 0
+                    complete[n] = 0
+                    done[n] = 1
+                    stack.pop()
+                    continue
+                p1, p2 = parent1[n], parent2[n]
+                if p1 != NO_PARENT and not done[p1]:
+                    stack.append(p1)
+                elif p2 != NO_PARENT and not done[p2]:
+                    stack.append(p2)
+                else:
+                    generation[n] = 1 + max(
+                        generation[p1] if p1 != NO_PARENT else 0,
+                        generation[p2] if p2 != NO_PARENT else 0
+                    )
+                    complete[n] = (p1 == NO_PARENT or complete[p1]) and (p2 == NO_PARENT or complete[p2])
+                    done[n] = 1
+                    stack.pop()
+        self.dirty = False
+
+    def _parents(self, n):
+        p1, p2 = self.parent1[n], self.parent2[n]
+        if p1 == NO_PARENT:
+            return ()
+        if p2 == NO_PARENT:
+            return (p1,)
+        return p1, p2
+
+    def parents(self, id):
+        with self.locker:
+            n = self.ids.get(id[:12])
+            if n is None or not self.known[n]:
+                return None
+            return [self.nodes[p] for p in self._parents(n)]
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        :return: True IF ancestor IS descendant, OR AN ANCESTOR OF IT; False IF NOT;
+                 None IF THE KNOWN HISTORY CAN NOT TELL
+        """
+        with self.locker:
+            a = self.ids.get(ancestor[:12])
+            d = self.ids.get(descendant[:12])
+            if a is None or d is None:
+                return None
+            if a == d:
+                return True
+            self._refresh()
+            min_generation = self.generation[a]
+            complete = True
+            seen = {d}
+            todo = [d]
+            while todo:
+                n = todo.pop()
+                if not self.known[n]:
+                    complete = False
+                    continue
+                for p in self._parents(n):
+                    if p == a:
+                        return True
+                    if p not in seen and (self.generation[p] > min_generation or not self.complete[p]):
+                        seen.add(p)
+                        todo.append(p)
+            return False if complete else None
+
+    def between(self, start, end):
+        """
+        THE CHANGESETS THAT ARE DESCENDANTS OF start AND ANCESTORS OF end
+        (INCLUSIVE, LIKE hg's start::end)
+        :return: LIST OF CHANGESET IDS, OLDEST FIRST; None IF THE KNOWN HISTORY CAN NOT TELL
+        """
+        with self.locker:
+            s = self.ids.get(start[:12])
+            e = self.ids.get(end[:12])
+            if s is None or e is None:
+                return None
+            self._refresh()
+            min_generation = self.generation[s]
+
+            # ANCESTORS OF end THAT ARE NOT OLDER THAN start
+            complete = True
+            candidates = {e}
+            todo = [e]
+            while todo:
+                n = todo.pop()
+                if n == s:
+                    continue  # ITS ANCESTORS ARE NOT IN start::end
+                if not self.known[n]:
+                    complete = False
+                    continue
+                for p in self._parents(n):
+                    if p not in candidates and (self.generation[p] >= min_generation or not self.complete[p]):
+                        candidates.add(p)
+                        todo.append(p)
+            if not complete:
+                # A PATH FROM start MAY PASS THROUGH THE UNKNOWN HISTORY
+                return None
+            if s not in candidates:
+                return []
+
+            # KEEP THE ONES THAT REACH start
+            generation = self.generation
+            reach = {s}
+            for n in sorted(candidates, key=lambda n: generation[n]):
+                if n not in reach and any(p in reach for p in self._parents(n)):
+                    reach.add(n)
+            return [self.nodes[n] for n in sorted(reach, key=lambda n: (generation[n], n))]
+
+    def save(self, filename):
+        with self.locker:
+            self._refresh()
+            parent1, parent2 = array(str("i"), self.parent1), array(str("i"), self.parent2)
+            if sys.byteorder != "little":
+                parent1.byteswap()
+                parent2.byteswap()
+            content = b"".join([
+                FILE_MAGIC,
+                struct.pack(str("<I"), len(self.nodes)),
+                "\n".join(self.nodes).encode("ascii"),
+                b"\0",
+                bytes(self.known),
+                _to_bytes(parent1),
+                _to_bytes(parent2)
+            ])
+        File(filename).write_bytes(zlib.compress(content))
+
+    @classmethod
+    def load(cls, filename, name=None):
+        content = zlib.decompress(File(filename).read_bytes())
+        if not content.startswith(FILE_MAGIC):
+            Log.error("{{file}} is not a commit graph", file=filename)
+        num, = struct.unpack(str("<I"), content[8:12])
+        end_of_ids = content.index(b"\0", 12)
+        ids = content[12:end_of_ids].decode("ascii")
+
+        output = cls(name)
+        output.nodes = ids.split("\n") if num else []
+        output.ids = {id[:12]: n for n, id in enumerate(output.nodes)}
+        offset = end_of_ids + 1
+        output.known = bytearray(content[offset:offset + num])
+        offset += num
+        for a in (output.parent1, output.parent2):
+            _from_bytes(a, content[offset:offset + 4 * num])
+            if sys.byteorder != "little":
+                a.byteswap()
+            offset += 4 * num
+        output.generation = array(str("i"), [0]) * num
+        output.complete = bytearray(num)
+        output.dirty = True
+        with output.locker:
+            output._refresh()
+        return output
+
+
+def _to_bytes(a):
+    try:
+        return a.tobytes()
+    except AttributeError:
+        return a.tostring()
+
+
+def _from_bytes(a, content):
+    try:
+        a.frombytes(content)
+    except AttributeError:
+        a.fromstring(content)
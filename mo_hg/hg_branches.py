@@ -8,40 +8,80 @@
 #
 from __future__ import unicode_literals
 
+import hashlib
+import os
+import re
+from copy import deepcopy
+
 import jx_elasticsearch
 from bs4 import BeautifulSoup
 
 from mo_collections import UniqueIndex
-from mo_dots import Data, set_default, FlatList
+from mo_dots import Data, set_default, wrap, unwrap
+from mo_files import File
+from mo_future import text_type
 from mo_hg.hg_mozilla_org import DEFAULT_LOCALE
+from mo_json import value2json, json2value
 from mo_kwargs import override
 from mo_logs import Log, Except
 from mo_logs import startup, constants
+from mo_logs.exceptions import assert_no_exception
 from mo_math import MAX
+from mo_math.randoms import Random
+from mo_threads import Thread, Lock, Queue, THREAD_STOP
 from mo_times.dates import Date
 from mo_times.durations import SECOND, DAY
 from pyLibrary.env import elasticsearch, http
 
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
 EXTRA_WAIT_TIME = 20 * SECOND  # WAIT TIME TO SEND TO AWS, IF WE wait_forever
 OLD_BRANCH = DAY
 BRANCH_WHITELIST = None
+SCRAPE_THREADS = 8  # NUMBER OF hg DIRECTORY PAGES TO FETCH AT ONCE
+SCRAPE_STATE_SUFFIX = ".scrape"  # THE LAST SCRAPE IS KEPT NEXT TO THE branch_snapshot, IN A FILE WITH THIS SUFFIX
+
+_directories_locker = Lock("branch directories")
+_directories = {}  # MAP FROM DIRECTORY TO (etag, hash, branches) FROM THE LAST SCRAPE
 
 
 @override
-def get_branches(hg, branches, kwargs=None):
+def get_branches(hg, branches, branch_snapshot=None, kwargs=None):
+    """
+    :param hg: WHERE TO SCRAPE THE BRANCHES
+    :param branches: THE ES INDEX OF BRANCHES
+    :param branch_snapshot: FILENAME OF THE LOCAL BRANCH SNAPSHOT; THE LAST SCRAPE IS KEPT BESIDE IT
+    """
     # TRY ES
     cluster = elasticsearch.Cluster(branches)
     try:
         es = cluster.get_index(kwargs=branches, read_only=False)
         esq = jx_elasticsearch.new_instance(branches)
         found_branches = esq.query({"from": "branches", "format": "list", "limit": 10000}).data
+        state_file = File(branch_snapshot + SCRAPE_STATE_SUFFIX) if branch_snapshot else None
+        last_scrape = _load_scrape_state(state_file, found_branches)
 
         # IF IT IS TOO OLD, THEN PULL FROM HG
-        oldest = Date(MAX(found_branches.etl.timestamp))
-        if oldest == None or Date.now() - oldest > OLD_BRANCH:
+        if last_scrape == None:
+            last_scrape = Date(MAX(found_branches.etl.timestamp))
+        if last_scrape == None or Date.now() - last_scrape > OLD_BRANCH:
+            existing = {(b.name, b.locale): b for b in found_branches}
             found_branches = _get_branches_from_hg(hg)
-            es.extend({"id": b.name + " " + b.locale, "value": b} for b in found_branches)
-            es.flush()
+            changed = [b for b in found_branches if _is_changed(existing.get((b.name, b.locale)), b)]
+            Log.note("{{num}} of {{total}} branches changed", num=len(changed), total=len(found_branches))
+            # ONLY THE CHANGED BRANCHES ARE WRITTEN; THE SCRAPE STATE SAYS THE REST ARE STILL CURRENT
+            if changed:
+                es.extend({"id": b.name + " " + b.locale, "value": b} for b in changed)
+                es.flush()
+            _save_scrape_state(state_file)
+        else:
+            # EVERY BRANCH WAS SEEN AT THE LAST SCRAPE
+            for b in found_branches:
+                b.etl.timestamp = MAX([b.etl.timestamp, last_scrape.unix])
 
         try:
             return UniqueIndex(["name", "locale"], data=found_branches, fail_on_dup=False)
@@ -57,19 +97,111 @@ def get_branches(hg, branches, kwargs=None):
         Log.error("problem getting branches", cause=e)
 
 
+def _save_scrape_state(file):
+    """
+    WRITE THE TIME OF THIS SCRAPE, AND THE etag AND hash OF EACH DIRECTORY PAGE, TO file
+    """
+    if file is None:
+        return
+    with _directories_locker:
+        directories = [
+            {"url": url, "etag": etag, "hash": hash, "branches": [b.name + " " + b.locale for b in branches]}
+            for url, (etag, hash, branches) in _directories.items()
+        ]
+    try:
+        # WRITE TO TEMP FILE, THEN RENAME, SO A CRASH DOES NOT LEAVE A PARTIAL FILE
+        temp = File(file.abspath + "." + Random.hex(8) + ".tmp")
+        temp.write_bytes(value2json({"timestamp": Date.now(), "directories": directories}).encode("utf8"))
+        os.rename(temp.abspath, file.abspath)
+    except Exception as e:
+        Log.warning("Can not write scrape state {{file}}", file=file.abspath, cause=e)
+
+
+def _load_scrape_state(file, branches):
+    """
+    AFTER A RESTART, RECOVER THE etag AND hash OF EACH DIRECTORY PAGE FROM THE
+    LAST SCRAPE, SO UNCHANGED PAGES ARE NOT PARSED AGAIN
+    :param file: WRITTEN BY _save_scrape_state() (OR None)
+    :param branches: THE BRANCHES FOUND IN ES
+    :return: TIME OF THE LAST SCRAPE, OR None IF NOT KNOWN
+    """
+    if file is None:
+        return None
+    try:
+        if not file.exists:
+            return None
+        state = json2value(file.read_bytes().decode("utf8"))
+    except Exception as e:
+        Log.warning("Can not read scrape state {{file}}", file=file.abspath, cause=e)
+        return None
+
+    lookup = {b.name + " " + b.locale: b for b in branches}
+    with _directories_locker:
+        if not _directories:
+            for d in state.directories:
+                found = [lookup.get(i) for i in d.branches]
+                if any(b == None for b in found):
+                    continue  # NOT ALL IN ES; PARSE THE PAGE AGAIN
+                _directories[d.url] = (d.etag, d.hash, found)
+    return Date(state.timestamp)
+
+
+def _is_changed(old, new):
+    """
+    :return: True IF new IS DIFFERENT FROM old, IGNORING THE etl MARKUP
+    """
+    if old == None:
+        return True
+
+    def content(branch):
+        output = unwrap(json2value(value2json(branch)))
+        output.pop("etl", None)
+        return output
+
+    return content(old) != content(new)
+
+
 @override
 def _get_branches_from_hg(kwarg):
     # GET MAIN PAGE
     response = http.get(kwarg.url)
-    doc = BeautifulSoup(response.all_content, "html.parser")
+    all_repos = _get_tables(response.all_content)[1]
+    directories = []
+    for row in all_repos:
+        if not row:
+            continue
+        dir, name = [text for text, _ in row]
+        directories.append((name, dir.lstrip("/")))
+
+    # GET THE DIRECTORY PAGES, CONCURRENTLY
+    queue = Queue("branch directories", max=len(directories) + 1)
+    queue.extend(directories)
+    queue.add(THREAD_STOP)
+    results = {}
+    problems = []
+
+    def _scrape(please_stop):
+        for name, dir in queue:
+            if please_stop:
+                return
+            try:
+                results[dir] = _get_single_branch_from_hg(kwarg, name, dir)
+            except Exception as e:
+                problems.append(Except.wrap(e))
+
+    threads = [
+        Thread.run("scrape branches " + text_type(i), _scrape)
+        for i in range(min(SCRAPE_THREADS, len(directories)) or 1)
+    ]
+    for t in threads:
+        with assert_no_exception:
+            t.join()
+    if problems:
+        Log.error("Can not get branches from hg", cause=problems)
 
-    all_repos = doc("table")[1]
     branches = UniqueIndex(["name", "locale"], fail_on_dup=False)
-    for i, r in enumerate(all_repos("tr")):
-        dir, name = [v.text.strip() for v in r("td")]
-
-        b = _get_single_branch_from_hg(kwarg, name, dir.lstrip("/"))
-        branches.extend(b)
+    for name, dir in directories:
+        branches.extend(results[dir])
 
     # branches.add(set_default({"name": "release-mozilla-beta"}, branches["mozilla-beta", DEFAULT_LOCALE]))
     for b in list(branches["mozilla-beta", ]):
@@ -105,28 +237,61 @@ def _get_branches_from_hg(kwarg):
 
 
 def _get_single_branch_from_hg(settings, description, dir):
+    """
+    :return: LIST OF BRANCHES FOUND ON THE dir PAGE; IF THE PAGE HAS NOT
+             CHANGED SINCE THE LAST SCRAPE, THE SAME BRANCHES ARE RETURNED
+             WITHOUT PARSING IT AGAIN
+    """
     if dir == "users":
         return []
-    response = http.get(settings.url + "/" + dir)
-    doc = BeautifulSoup(response.all_content, "html.parser")
+    url = settings.url + "/" + dir
+    with _directories_locker:
+        etag, hash, previous = _directories.get(url, (None, None, None))
+
+    response = http.get(url, headers={"If-None-Match": etag} if etag else {})
+    if response.status_code == 304:
+        return _renew(previous)
+    content = response.all_content
+    new_hash = hashlib.sha1(content).hexdigest()
+    if new_hash == hash:
+        return _renew(previous)
+
+    output = _parse_branches(settings, description, content)
+    with _directories_locker:
+        _directories[url] = (response.headers.get("etag"), new_hash, output)
+    return _renew(output)
+
+
+def _renew(branches):
+    """
+    :return: COPIES OF THE BRANCHES, WITH A NEW etl.timestamp
+    """
+    now = Date.now()
+    output = []
+    for b in branches:
+        b = wrap(deepcopy(unwrap(b)))
+        b.etl.timestamp = now
+        output.append(b)
+    return output
 
+
+def _parse_branches(settings, description, content):
     output = []
     try:
-        all_branches = doc("table")[0]
+        all_branches = _get_tables(content)[0]
     except Exception:
         return []
 
-    for i, b in enumerate(all_branches("tr")):
+    for i, columns in enumerate(all_branches):
         if i == 0:
             continue  # IGNORE HEADER
-        columns = b("td")
 
         try:
-            path = columns[0].a.get('href')
+            path = columns[0][1]
             if path == "/":
                 continue
 
-            name, desc, last_used = [c.text.strip() for c in columns][0:3]
+            name, desc, last_used = [text for text, _ in columns][0:3]
 
             if last_used.startswith('at'):
                 last_used = last_used[2:]
@@ -193,6 +358,52 @@ def _get_single_branch_from_hg(settings, description, dir):
     return output
 
 
+_table_pattern = re.compile(r"<table\b[^>]*>(.*?)</table>", re.DOTALL | re.IGNORECASE)
+_row_pattern = re.compile(r"<tr\b[^>]*>(.*?)</tr>", re.DOTALL | re.IGNORECASE)
+_cell_pattern = re.compile(r"<td\b[^>]*>(.*?)</td>", re.DOTALL | re.IGNORECASE)
+_href_pattern = re.compile(r"<a\b[^>]*?\bhref=[\"']([^\"']*)[\"']", re.IGNORECASE)
+_tag_pattern = re.compile(r"<[^>]*>")
+
+
+def _get_tables(content):
+    """
+    THE hg DIRECTORY PAGES ARE SIMPLE TABLES, SO WE PULL THE CELLS WITH REGULAR
+    EXPRESSIONS, AND ONLY USE BeautifulSoup FOR PAGES WITH NESTED TABLES
+    :param content: PAGE, AS BYTES
+    :return: LIST OF TABLES; EACH TABLE IS A LIST OF ROWS; EACH ROW IS A LIST OF (text, href) CELLS
+    """
+    html = content.decode("utf8", "replace")
+    tables = _table_pattern.findall(html)
+    if any("<table" in t.lower() for t in tables):
+        return _get_tables_slowly(html)
+
+    output = []
+    for table in tables:
+        rows = []
+        for row in _row_pattern.findall(table):
+            cells = []
+            for cell in _cell_pattern.findall(row):
+                href = _href_pattern.search(cell)
+                cells.append((
+                    unescape(_tag_pattern.sub("", cell)).strip(),
+                    unescape(href.group(1)) if href else None
+                ))
+            rows.append(cells)
+        output.append(rows)
+    return output
+
+
+def _get_tables_slowly(html):
+    doc = BeautifulSoup(html, "html.parser")
+    return [
+        [
+            [(c.text.strip(), c.a.get('href') if c.a else None) for c in r("td")]
+            for r in t("tr")
+        ]
+        for t in doc("table")
+    ]
+
+
 branches_schema = {
     "settings": {
         "index.number_of_replicas": 1,
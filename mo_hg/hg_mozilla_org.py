@@ -11,24 +11,32 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+import os
 import re
 from collections import Mapping
 from copy import copy
 
 import mo_threads
-from mo_dots import set_default, Null, coalesce, unwraplist, listwrap, wrap, Data
+from mo_collections import UniqueIndex
+from mo_dots import set_default, Null, coalesce, unwraplist, listwrap, wrap, Data, unwrap, split_field
 from mo_future import text_type, binary_type
+from mo_files import File
+from mo_hg.diffs import DiffStore
+from mo_hg.graph import CommitGraph
+from mo_hg.metrics import Metrics, METRIC_REPORT_PERIOD
 from mo_hg.parse import diff_to_json, diff_to_moves
-from mo_hg.repos.changesets import Changeset
+from mo_hg.prefetch import RevisionWalker, PREFETCH_DEPTH
+from mo_hg.repos.changesets import Changeset, pack_changeset
 from mo_hg.repos.pushs import Push
 from mo_hg.repos.revisions import Revision, revision_schema
-from mo_json import json2value
+from mo_hg.sources import SourceStore
+from mo_json import json2value, value2json
 from mo_kwargs import override
 from mo_logs import Log, strings, machine_metadata
 from mo_logs.exceptions import Explanation, assert_no_exception, Except, suppress_exception
 from mo_logs.strings import expand_template
 from mo_math.randoms import Random
-from mo_threads import Thread, Lock, Queue, THREAD_STOP, Till
+from mo_threads import Thread, Lock, Queue, THREAD_STOP, Till, Signal
 from mo_times.dates import Date
 from mo_times.durations import SECOND, Duration, HOUR, MINUTE, DAY
 from pyLibrary.env import http, elasticsearch
@@ -42,6 +50,13 @@ def _count(values):
     return len(list(values))
 
 
+def _has_changes(file):
+    """
+    :return: True IF THE DIFF file CARRIES ITS changes (AN EMPTY LIST COUNTS; A Data COMPARES [] == None)
+    """
+    return unwrap(file).get("changes") is not None
+
+
 def _late_imports():
     global _hg_branches
     global _OLD_BRANCH
@@ -65,6 +80,9 @@ MAX_TODO_AGE = DAY  # THE DAEMON WILL NEVER STOP SCANNING; DO NOT ADD OLD REVISI
 MIN_ETL_AGE = Date("03may2018").unix  # ARTIFACTS OLDER THAN THIS IN ES ARE REPLACED
 UNKNOWN_PUSH = "Unknown push {{revision}}"
 
+GRAPH_SAVE_INTERVAL = 10 * MINUTE
+BRANCH_RETRY_INTERVAL = MINUTE  # HOW LONG TO WAIT AFTER FAILING TO GET THE BRANCHES
+MIN_BRANCH_REFRESH_INTERVAL = 10 * MINUTE  # DO NOT START A NEW BRANCH REFRESH MORE OFTEN THAN THIS
 MAX_DIFF_SIZE = 1000
 DIFF_URL = "{{location}}/raw-rev/{{rev}}"
 FILE_URL = "{{location}}/raw-file/{{rev}}{{path}}"
@@ -87,40 +105,166 @@ class HgMozillaOrg(object):
         branches=None,  # CONNECTION INFO FOR ES CACHE
         use_cache=False,   # True IF WE WILL USE THE ES FOR DOWNLOADING BRANCHES
         timeout=30 * SECOND,
+        graph=None,     # {"directory": path} TO PERSIST THE COMMIT GRAPHS
+        sources=None,   # {"directory": path} TO KEEP FILES-AT-REVISION LOCALLY
+        diffs=None,     # {"directory": path} TO KEEP DIFFS LARGER THAN MAX_DIFF_SIZE
+        pack_diffs=False,  # True TO STORE diff AND moves IN ES AS ONE COMPRESSED FIELD
+        metrics=None,   # {"period": seconds} TO RECORD THE TIME SPENT IN EACH STAGE OF get_revision
+        branch_snapshot=None,  # FILENAME TO KEEP A LOCAL COPY OF THE BRANCHES
+        lazy=False,     # True TO START WITHOUT WAITING ON hg OR ES (BRANCHES COME FROM branch_snapshot, AND ARE REFRESHED IN THE BACKGROUND)
         kwargs=None
     ):
         if not _hg_branches:
             _late_imports()
 
         self.es_locker = Lock()
+        self.es_setup_locker = Lock("connect to es")
+        self._es = None
+        self._branches = None
+        self.branches_ready = Signal("branches ready")
+        self.branch_refresh_locker = Lock("branch refresh")
+        self.branch_refresh = None  # THE THREAD REFRESHING THE BRANCHES, IF ANY
+        self.branch_refresh_time = None  # WHEN THE LAST REFRESH STARTED
         self.todo = mo_threads.Queue("todo for hg daemon", max=DAEMON_QUEUE_SIZE)
 
         self.settings = kwargs
         self.timeout = Duration(timeout)
+        self.metrics = Metrics(
+            "hg",
+            enabled=bool(self.settings.metrics),
+            period=coalesce(self.settings.metrics.period, METRIC_REPORT_PERIOD)
+        )
+
+        self.graph_locker = Lock("graphs")
+        self.graphs = {}  # MAP FROM BRANCH NAME TO CommitGraph
+        if self.settings.graph.directory:
+            Thread.run("save graphs", self._save_graphs_daemon)
+
+        self.sources = None
+        if self.settings.sources.directory:
+            self.sources = SourceStore(hg=self, kwargs=self.settings.sources)
+
+        self.diffs = None
+        if self.settings.diffs.directory:
+            self.diffs = DiffStore(kwargs=self.settings.diffs)
+
+        if lazy:
+            # ES IS CONNECTED ON FIRST USE; BRANCHES ARE PULLED IN THE BACKGROUND
+            snapshot = self._load_branch_snapshot()
+            if snapshot is not None:
+                self.branches = snapshot
+            self.refresh_branches()
+            if branches != None:
+                Thread.run("hg daemon", self._daemon)
+            return
 
         # VERIFY CONNECTIVITY
         with Explanation("Test connect with hg"):
             response = http.head(self.settings.hg.url)
 
         if branches == None:
-            self.branches = _hg_branches.get_branches(kwargs=kwargs)
-            self.es = None
+            self.update_branches()
             return
 
+        self._es = self._connect_es()
+        self.update_branches()
+        self.timeout = timeout
+        Thread.run("hg daemon", self._daemon)
+
+    @property
+    def es(self):
+        if self._es is None and self.settings.branches != None:
+            with self.es_setup_locker:
+                if self._es is None:
+                    self._es = self._connect_es()
+        return self._es
+
+    def _connect_es(self):
+        repo = self.settings.repo
         set_default(repo, {"schema": revision_schema})
-        self.es = elasticsearch.Cluster(kwargs=repo).get_or_create_index(kwargs=repo)
+        es = elasticsearch.Cluster(kwargs=repo).get_or_create_index(kwargs=repo)
 
         def setup_es(please_stop):
             with suppress_exception:
-                self.es.add_alias()
+                es.add_alias()
 
             with suppress_exception:
-                self.es.set_refresh_interval(seconds=1)
+                es.set_refresh_interval(seconds=1)
 
         Thread.run("setup_es", setup_es)
-        self.branches = _hg_branches.get_branches(kwargs=kwargs)
-        self.timeout = timeout
-        Thread.run("hg daemon", self._daemon)
+        return es
+
+    @property
+    def branches(self):
+        if self._branches is None:
+            # NO SNAPSHOT, SO WAIT FOR THE FIRST REFRESH
+            (self.branches_ready | Till(seconds=self.timeout.seconds)).wait()
+            if self._branches is None:
+                Log.error("The branches are not known yet")
+        return self._branches
+
+    @branches.setter
+    def branches(self, branches):
+        self._branches = branches
+        self.branches_ready.go()
+
+    def update_branches(self):
+        """
+        PULL THE BRANCHES (FROM ES, OR hg), AND UPDATE THE branch_snapshot
+        THE NEW TABLE IS BUILT ASIDE, AND REPLACES THE OLD ONE IN A SINGLE ASSIGNMENT
+        """
+        self.branches = _hg_branches.get_branches(kwargs=self.settings)
+        self._save_branch_snapshot()
+
+    def refresh_branches(self):
+        """
+        START A BACKGROUND REFRESH OF THE BRANCHES, UNLESS ONE IS RUNNING, OR RAN RECENTLY
+        READERS CONTINUE TO USE THE CURRENT (STALE) BRANCHES UNTIL THE NEW ONES ARE SWAPPED IN
+        """
+        with self.branch_refresh_locker:
+            if self.branch_refresh:
+                return
+            if self.branch_refresh_time and Date.now() - self.branch_refresh_time < MIN_BRANCH_REFRESH_INTERVAL:
+                return
+            self.branch_refresh_time = Date.now()
+            self.branch_refresh = Thread.run("refresh branches", self._refresh_branches_daemon)
+
+    def _refresh_branches_daemon(self, please_stop):
+        try:
+            while not please_stop:
+                try:
+                    self.update_branches()
+                    return
+                except Exception as e:
+                    Log.warning("Problem getting branches, will retry", cause=e)
+                (please_stop | Till(seconds=BRANCH_RETRY_INTERVAL.seconds)).wait()
+        finally:
+            with self.branch_refresh_locker:
+                self.branch_refresh = None
+
+    def _load_branch_snapshot(self):
+        if not self.settings.branch_snapshot:
+            return None
+        file = File(self.settings.branch_snapshot)
+        try:
+            if not file.exists:
+                return None
+            return UniqueIndex(["name", "locale"], data=json2value(file.read_bytes().decode("utf8")), fail_on_dup=False)
+        except Exception as e:
+            Log.warning("Can not read branch snapshot {{file}}", file=file.abspath, cause=e)
+            return None
+
+    def _save_branch_snapshot(self):
+        if not self.settings.branch_snapshot:
+            return
+        file = File(self.settings.branch_snapshot)
+        try:
+            # WRITE TO TEMP FILE, THEN RENAME, SO A CRASH DOES NOT LEAVE A PARTIAL SNAPSHOT
+            temp = File(file.abspath + "." + Random.hex(8) + ".tmp")
+            temp.write_bytes(value2json(list(self._branches)).encode("utf8"))
+            os.rename(temp.abspath, file.abspath)
+        except Exception as e:
+            Log.warning("Can not write branch snapshot {{file}}", file=file.abspath, cause=e)
 
     def _daemon(self, please_stop):
         while not please_stop:
@@ -166,12 +310,21 @@ class HgMozillaOrg(object):
                 for r in list(revisions):
                     self._find_revision(r)
 
-    @cache(duration=HOUR, lock=True)
     def get_revision(self, revision, locale=None, get_diff=False, get_moves=True):
         """
         EXPECTING INCOMPLETE revision OBJECT
         RETURNS revision
         """
+        start = self.metrics.start()
+        try:
+            return self._get_revision(revision, locale, get_diff, get_moves)
+        finally:
+            self.metrics.end("get_revision", start)
+
+    @cache(duration=HOUR, lock=True)
+    def _get_revision(self, revision, locale=None, get_diff=False, get_moves=True):
+        # ONLY CALLED ON A MEMO MISS
+        self.metrics.count("get_revision.memo_miss")
         rev = revision.changeset.id
         if not rev:
             return Null
@@ -180,13 +333,18 @@ class HgMozillaOrg(object):
         elif revision.branch.name == None:
             return Null
         locale = coalesce(locale, revision.branch.locale, DEFAULT_LOCALE)
+        start = self.metrics.start()
         output = self._get_from_elasticsearch(revision, locale=locale, get_diff=get_diff)
+        self.metrics.end("es.hit" if output and output.push.date else "es.miss", start)
         if output:
+            if not get_diff and not get_moves:
+                output.changeset.packed = None  # NO NEED TO DECODE
             if not get_diff:  # DIFF IS BIG, DO NOT KEEP IT IF NOT NEEDED
                 output.changeset.diff = None
             if not get_moves:
                 output.changeset.moves = None
             DEBUG and Log.note("Got hg ({{branch}}, {{locale}}, {{revision}}) from ES", branch=output.branch.name, locale=locale, revision=output.changeset.id)
+            self.get_graph(output.branch).add_revision(output)
             if output.push.date >= Date.now()-MAX_TODO_AGE:
                 self.todo.add((output.branch, listwrap(output.parents)))
                 self.todo.add((output.branch, listwrap(output.children)))
@@ -210,7 +368,7 @@ class HgMozillaOrg(object):
                 return Null
 
         if Date.now() - Date(b.etl.timestamp) > _OLD_BRANCH:
-            self.branches = _hg_branches.get_branches(kwargs=self.settings)
+            self.refresh_branches()
 
         push = self._get_push(found_revision.branch, found_revision.changeset.id)
 
@@ -219,8 +377,12 @@ class HgMozillaOrg(object):
         with Explanation("get revision from {{url}}", url=url1, debug=DEBUG):
             raw_rev2 = Null
             try:
+                start = self.metrics.start()
                 raw_rev1 = self._get_raw_json_info(url1, found_revision.branch)
+                self.metrics.end("hg.json_info", start)
+                start = self.metrics.start()
                 raw_rev2 = self._get_raw_json_rev(url2, found_revision.branch)
+                self.metrics.end("hg.json_rev", start)
             except Exception as e:
                 if "Hg denies it exists" in e:
                     raw_rev1 = Data(node=revision.changeset.id)
@@ -237,6 +399,95 @@ class HgMozillaOrg(object):
                 output.changeset.moves = None
             return output
 
+    def iter_ancestors(self, revision, locale=None, depth=PREFETCH_DEPTH, please_stop=None):
+        """
+        GENERATE THE ANCESTORS OF revision, BREADTH-FIRST
+        :param revision: INCOMPLETE REVISION OBJECT TO START FROM (NOT INCLUDED)
+        :param depth: NUMBER OF REVISIONS TO FETCH AHEAD OF THE CALLER
+        :param please_stop: OPTIONAL Signal TO CANCEL THE WALK
+        """
+        return self._walk(revision, "parents", locale, depth, please_stop)
+
+    def iter_descendants(self, revision, locale=None, depth=PREFETCH_DEPTH, please_stop=None):
+        """
+        GENERATE THE DESCENDANTS OF revision, BREADTH-FIRST
+        SAME PARAMETERS AS iter_ancestors()
+        """
+        return self._walk(revision, "children", locale, depth, please_stop)
+
+    def _walk(self, revision, direction, locale, depth, please_stop):
+        start = self.get_revision(revision, locale)
+        if not start:
+            return iter([])
+        return iter(RevisionWalker(self, start, direction, locale=locale, depth=depth, please_stop=please_stop))
+
+    def get_graph(self, branch):
+        """
+        :param branch: BRANCH (OR BRANCH NAME)
+        :return: THE CommitGraph OF KNOWN CHANGESETS ON THAT BRANCH
+        """
+        if isinstance(branch, (text_type, binary_type)):
+            name = branch.lower()
+        else:
+            name = branch.name.lower()
+
+        with self.graph_locker:
+            graph = self.graphs.get(name)
+            if graph is not None:
+                return graph
+
+            graph = None
+            filename = self._graph_filename(name)
+            if filename and filename.exists:
+                try:
+                    graph = CommitGraph.load(filename.abspath, name)
+                except Exception as e:
+                    Log.warning("Can not load commit graph from {{file}}", file=filename.abspath, cause=e)
+            if graph is None:
+                graph = CommitGraph(name)
+            self.graphs[name] = graph
+            return graph
+
+    def is_ancestor(self, ancestor, descendant):
+        """
+        :param ancestor: REVISION
+        :param descendant: REVISION, ON THE SAME BRANCH
+        :return: True/False, OR None IF THE KNOWN HISTORY CAN NOT TELL
+        """
+        graph = self.get_graph(descendant.branch)
+        return graph.is_ancestor(ancestor.changeset.id, descendant.changeset.id)
+
+    def between(self, start, end):
+        """
+        :param start: REVISION
+        :param end: REVISION, ON THE SAME BRANCH
+        :return: IDS OF THE CHANGESETS IN start::end, OLDEST FIRST; None IF THE KNOWN HISTORY CAN NOT TELL
+        """
+        graph = self.get_graph(end.branch)
+        return graph.between(start.changeset.id, end.changeset.id)
+
+    def save_graphs(self):
+        with self.graph_locker:
+            graphs = list(self.graphs.items())
+        for name, graph in graphs:
+            filename = self._graph_filename(name)
+            if filename:
+                graph.save(filename.abspath)
+
+    def _graph_filename(self, name):
+        directory = self.settings.graph.directory
+        if not directory:
+            return None
+        return File.new_instance(directory, name.replace("/", "_") + ".graph")
+
+    def _save_graphs_daemon(self, please_stop):
+        while not please_stop:
+            (please_stop | Till(seconds=GRAPH_SAVE_INTERVAL.seconds)).wait()
+            try:
+                self.save_graphs()
+            except Exception as e:
+                Log.warning("Problem saving commit graphs", cause=e)
+
     def _get_from_elasticsearch(self, revision, locale=None, get_diff=False, get_moves=True):
         rev = revision.changeset.id
         if self.es.cluster.version.startswith("1.7."):
@@ -287,7 +538,51 @@ class HgMozillaOrg(object):
                 if d._id.endswith(d._source.branch.locale):
                     best = d._source
             Log.warning("expecting no more than one document")
-        return best
+        if not best:
+            return None
+        return Revision(best)  # A packed diff IS ONLY DECODED IF USED
+
+    def get_known_files(self, branch, ids):
+        """
+        FROM ES ONLY (hg IS NOT ASKED), IN ONE QUERY
+        :param branch: BRANCH OF THE CHANGESETS
+        :param ids: CHANGESET IDS
+        :return: MAP FROM 12-CHARACTER ID TO THE LIST OF files CHANGED, FOR THE CHANGESETS ES HAS
+        """
+        if not ids or self.es is None:
+            return {}
+        id12s = list(set(i[:12] for i in ids))
+        locale = coalesce(branch.locale, DEFAULT_LOCALE)
+        if self.es.cluster.version.startswith("1.7."):
+            query = {
+                "query": {"filtered": {
+                    "query": {"match_all": {}},
+                    "filter": {"and": [
+                        {"terms": {"changeset.id12": id12s}},
+                        {"term": {"branch.name": branch.name}},
+                        {"term": {"branch.locale": locale}}
+                    ]}
+                }},
+                "_source": ["changeset.id12", "changeset.files"],
+                "size": len(id12s)
+            }
+        else:
+            query = {
+                "query": {"bool": {"must": [
+                    {"terms": {"changeset.id12": id12s}},
+                    {"term": {"branch.name": branch.name}},
+                    {"term": {"branch.locale": locale}}
+                ]}},
+                "_source": ["changeset.id12", "changeset.files"],
+                "size": len(id12s)
+            }
+        try:
+            with self.es_locker:
+                docs = self.es.search(query).hits.hits
+        except Exception as e:
+            Log.warning("Bad ES call, can not get files", cause=e)
+            return {}
+        return {d._source.changeset.id12: listwrap(d._source.changeset.files) for d in docs}
 
     @cache(duration=HOUR, lock=True)
     def _get_raw_json_info(self, url, branch):
@@ -329,14 +624,17 @@ class HgMozillaOrg(object):
 
         try:
             # ALWAYS TRY ES FIRST
+            start = self.metrics.start()
             with self.es_locker:
                 response = self.es.search(query)
                 json_push = response.hits.hits[0]._source.push
             if json_push:
+                self.metrics.end("push.es", start)
                 return json_push
         except Exception:
             pass
 
+        start = self.metrics.start()
         url = branch.url.rstrip("/") + "/json-pushes?full=1&changeset=" + changeset_id
         with Explanation("Pulling pushlog from {{url}}", url=url, debug=DEBUG):
             Log.note(
@@ -347,10 +645,17 @@ class HgMozillaOrg(object):
             data = self._get_and_retry(url, branch)
             # QUEUE UP THE OTHER CHANGESETS IN THE PUSH
             self.todo.add((branch, [c.node for cs in data.values().changesets for c in cs]))
+            self.get_graph(branch).extend(
+                (c.node, listwrap(c.parents))
+                for cs in data.values().changesets
+                for c in cs
+                if c.parents != None
+            )
             pushes = [
                 Push(id=int(index), date=_push.date, user=_push.user)
                 for index, _push in data.items()
             ]
+        self.metrics.end("push.hg", start)
 
         if len(pushes) == 0:
             return Null
@@ -401,6 +706,7 @@ class HgMozillaOrg(object):
         r.bookmarks = None
 
         set_default(rev, r)
+        self.get_graph(rev.branch).add_revision(rev)
 
         # ADD THE DIFF
         if get_diff:
@@ -410,13 +716,60 @@ class HgMozillaOrg(object):
 
         try:
             _id = coalesce(rev.changeset.id12, "") + "-" + rev.branch.name + "-" + coalesce(rev.branch.locale, DEFAULT_LOCALE)
+            value = rev
+            if self.settings.pack_diffs:
+                value = rev.__data__()  # A Changeset WOULD UNPACK ITSELF WHEN SERIALIZED
+                value["changeset"] = pack_changeset(rev.changeset)
+            start = self.metrics.start()
             with self.es_locker:
-                self.es.add({"id": _id, "value": rev})
+                self.es.add({"id": _id, "value": value})
+            self.metrics.end("es.write", start)
         except Exception as e:
             Log.warning("did not save to ES", cause=e)
 
         return rev
 
+    def pack_existing(self, batch_size=100, please_stop=None):
+        """
+        MIGRATE EXISTING DOCUMENTS TO THE PACKED FORMAT (SEE pack_diffs)
+        SAFE TO STOP AND RESTART: ONLY DOCUMENTS WITHOUT changeset.packed ARE TOUCHED
+        """
+        with Explanation("add changeset.packed to {{index}} mapping", index=self.es.settings.index):
+            self.es.cluster.put(
+                "/" + self.es.settings.index + "/_mapping/" + self.es.settings.type,
+                data={"properties": {"changeset": {"properties": {"packed": {"type": "binary"}}}}}
+            )
+
+        if self.es.cluster.version.startswith("1.7."):
+            query = {
+                "query": {"filtered": {
+                    "query": {"match_all": {}},
+                    "filter": {"missing": {"field": "changeset.packed"}}
+                }},
+                "size": batch_size
+            }
+        else:
+            query = {
+                "query": {"bool": {"must_not": {"exists": {"field": "changeset.packed"}}}},
+                "size": batch_size
+            }
+
+        total = 0
+        while not please_stop:
+            with self.es_locker:
+                docs = self.es.search(query).hits.hits
+            if not docs:
+                break
+            for d in docs:
+                rev = d._source
+                rev.changeset = pack_changeset(rev.changeset)
+                with self.es_locker:
+                    self.es.add({"id": d._id, "value": rev})
+            total += len(docs)
+            Log.note("packed {{num}} revisions", num=total)
+            self.es.refresh()
+        return total
+
     def _get_and_retry(self, url, branch, **kwargs):
         """
         requests 2.5.0 HTTPS IS A LITTLE UNSTABLE
@@ -537,10 +890,12 @@ class HgMozillaOrg(object):
 
             try:
                 # ALWAYS TRY ES FIRST
+                start = self.metrics.start()
                 with self.es_locker:
                     response = self.es.search(query)
-                    json_diff = response.hits.hits[0]._source.changeset.diff
+                    json_diff = Changeset(response.hits.hits[0]._source.changeset).diff
                 if json_diff:
+                    self.metrics.end("diff.es", start)
                     return json_diff
             except Exception as e:
                 pass
@@ -548,15 +903,20 @@ class HgMozillaOrg(object):
             url = expand_template(DIFF_URL, {"location": revision.branch.url, "rev": changeset_id})
             DEBUG and Log.note("get unified diff from {{url}}", url=url)
             try:
+                start = self.metrics.start()
                 response = http.get(url)
                 diff = response.content.decode("utf8")
                 json_diff = diff_to_json(diff)
+                self.metrics.end("diff.hg", start)
                 num_changes = _count(c for f in json_diff for c in f.changes)
                 if json_diff:
                     if revision.changeset.description.startswith("merge "):
                         return None  # IGNORE THE MERGE CHANGESETS
                     elif num_changes < MAX_DIFF_SIZE:
                         return json_diff
+                    elif self.diffs:
+                        Log.note("Revision at {{url}} has a diff with {{num}} changes, stored separately", url=url, num=num_changes)
+                        return self.diffs.save(changeset_id, json_diff)
                     else:
                         Log.warning("Revision at {{url}} has a diff with {{num}} changes, ignored", url=url, num=num_changes)
                         for file in json_diff:
@@ -567,6 +927,50 @@ class HgMozillaOrg(object):
 
         return inner(revision.changeset.id)
 
+    def iter_diff(self, revision):
+        """
+        GENERATE THE FILES OF THE DIFF, ONE AT A TIME, EACH WITH ITS changes
+        BIG DIFFS ARE READ FROM THE DIFF STORE, ONE FILE AT A TIME
+        :param revision: INCOMPLETE REVISION OBJECT
+        """
+        manifest = self._get_json_diff_from_hg(revision)
+        if not manifest:
+            return
+        if any(not _has_changes(f) and f.chunk == None for f in manifest):
+            # NOT STORED WHEN IT WAS FIRST SEEN
+            manifest = self._store_diff(revision)
+        for i, file in enumerate(manifest):
+            if not _has_changes(file):
+                file = copy(file)
+                file.changes = self.get_diff_changes(revision, coalesce(file.chunk, i))
+            yield file
+
+    def get_diff_changes(self, revision, chunk):
+        """
+        :param revision: INCOMPLETE REVISION OBJECT
+        :param chunk: INDEX OF THE FILE IN THE DIFF
+        :return: THE changes FOR THAT ONE FILE
+        """
+        changeset_id = revision.changeset.id
+        if self.diffs:
+            changes = self.diffs.get_changes(changeset_id, chunk)
+            if changes is None:
+                self._store_diff(revision)
+                changes = self.diffs.get_changes(changeset_id, chunk)
+            return wrap(changes)
+        return self._store_diff(revision)[chunk].changes
+
+    def _store_diff(self, revision):
+        """
+        DOWNLOAD THE WHOLE DIFF; KEEP IT IN THE DIFF STORE, IF WE HAVE ONE
+        """
+        url = expand_template(DIFF_URL, {"location": revision.branch.url, "rev": revision.changeset.id})
+        DEBUG and Log.note("get unified diff from {{url}}", url=url)
+        json_diff = diff_to_json(http.get(url).content.decode("utf8"))
+        if self.diffs:
+            return self.diffs.save(revision.changeset.id, json_diff)
+        return json_diff
+
     def _get_moves_from_hg(self, revision):
         """
         :param revision: INCOMPLETE REVISION OBJECT
@@ -596,10 +1000,12 @@ class HgMozillaOrg(object):
 
             try:
                 # ALWAYS TRY ES FIRST
+                start = self.metrics.start()
                 with self.es_locker:
                     response = self.es.search(query)
-                    moves = response.hits.hits[0]._source.changeset.moves
+                    moves = Changeset(response.hits.hits[0]._source.changeset).moves
                 if moves:
+                    self.metrics.end("moves.es", start)
                     return moves
             except Exception as e:
                 pass
@@ -607,20 +1013,25 @@ class HgMozillaOrg(object):
             url = expand_template(DIFF_URL, {"location": revision.branch.url, "rev": changeset_id})
             DEBUG and Log.note("get unified diff from {{url}}", url=url)
             try:
+                start = self.metrics.start()
                 moves = http.get(url).content.decode('latin1')  # THE ENCODING DOES NOT MATTER BECAUSE WE ONLY USE THE '+', '-' PREFIXES IN THE DIFF
-                return diff_to_moves(text_type(moves))
+                moves = diff_to_moves(text_type(moves))
+                self.metrics.end("moves.hg", start)
+                return moves
             except Exception as e:
                 Log.warning("could not get unified diff from {{url}}", url=url, cause=e)
 
         return inner(revision.changeset.id)
 
     def _get_source_code_from_hg(self, revision, file_path):
+        if self.sources:
+            return self.sources.get_text(revision, file_path)
         response = http.get(expand_template(FILE_URL, {"location": revision.branch.url, "rev": revision.changeset.id, "path": file_path}))
         return response.content.decode("utf8", "replace")
 
 
 def _trim(url):
-    return url.split("/json-pushes?")[0].split("/json-info?")[0].split("/json-rev/")[0]
+    return url.split("/json-pushes?")[0].split("/json-info?")[0].split("/json-rev/")[0].split("/json-log/")[0]
 
 
 def _get_url(url, branch, **kwargs):
@@ -649,43 +1060,114 @@ def minimize_repo(repo):
     """
     if repo == None:
         return Null
-    output = wrap(_copy_but(repo, _exclude_from_repo))
-    output.changeset.description = strings.limit(output.changeset.description, 1000)
-    return output
-
-
-_exclude_from_repo = Data()
-for k in [
-    "changeset.files",
-    "changeset.diff",
-    "changeset.moves",
-    "etl",
-    "branch.last_used",
-    "branch.description",
-    "branch.etl",
-    "branch.parent_name",
-    "children",
-    "parents",
-    "phase",
-    "bookmarks",
-    "tags"
-]:
-    _exclude_from_repo[k] = True
-_exclude_from_repo = _exclude_from_repo
+    return wrap(_minimize(repo))
 
 
-def _copy_but(value, exclude):
-    output = {}
-    for k, v in value.items():
-        e = exclude.get(k, {})
-        if e!=True:
+def minimize_repos(repos):
+    """
+    STREAM MINIMAL VERSIONS OF MANY CHANGESETS
+    :param repos: ITERABLE OF REVISIONS
+    :return: GENERATOR OF MINIMAL REVISIONS
+    """
+    minimize = _minimize
+    for repo in repos:
+        if repo == None:
+            yield Null
+        else:
+            yield wrap(minimize(repo))
+
+
+def compile_projection(exclude, transforms=None):
+    """
+    BUILD A FUNCTION THAT COPIES A DOCUMENT, WITHOUT THE exclude PATHS
+    THE EXCLUSION TREE IS WALKED ONCE, HERE, NOT ONCE PER DOCUMENT
+    :param exclude: LIST OF DOT-DELIMITED PATHS TO REMOVE
+    :param transforms: MAP FROM DOT-DELIMITED PATH TO FUNCTION, APPLIED TO THE LEAF VALUE
+    :return: FUNCTION THAT RETURNS A PLAIN dict (OR None IF NOTHING IS LEFT)
+    """
+    tree = {}
+    for path in exclude:
+        _add_path(tree, split_field(path), True)
+    for path, func in (transforms or {}).items():
+        _add_path(tree, split_field(path), func)
+    return _compile_node(tree)
+
+
+def _add_path(tree, steps, leaf):
+    for s in steps[:-1]:
+        tree = tree.setdefault(s, {})
+        if tree is True:
+            return  # ALREADY EXCLUDED
+    tree[steps[-1]] = leaf
+
+
+def _compile_node(tree):
+    drop = frozenset(k for k, v in tree.items() if v is True)
+    children = {k: _compile_node(v) for k, v in tree.items() if isinstance(v, dict)}
+    leaves = {k: v for k, v in tree.items() if v is not True and not isinstance(v, dict)}
+
+    def project(value):
+        output = {}
+        for k, v in unwrap(value).items():
+            if k in drop:
+                continue
+            v = unwrap(v)
+            if v is None:
+                continue
             if isinstance(v, Mapping):
-                v2 = _copy_but(v, e)
-                if v2 != None:
-                    output[k] = v2
-            elif v != None:
-                output[k] = v
-    return output if output else None
+                child = children.get(k)
+                v = child(v) if child else _copy_all(v)
+                if v is None:
+                    continue
+            elif v.__class__ is list and not v:
+                continue
+            else:
+                func = leaves.get(k)
+                if func:
+                    v = func(v)
+            output[k] = v
+        return output or None
+
+    return project
+
+
+def _copy_all(value):
+    output = {}
+    for k, v in unwrap(value).items():
+        v = unwrap(v)
+        if v is None:
+            continue
+        if isinstance(v, Mapping):
+            v = _copy_all(v)
+            if v is None:
+                continue
+        elif v.__class__ is list and not v:
+            continue
+        output[k] = v
+    return output or None
+
+
+_minimize = compile_projection(
+    exclude=[
+        "changeset.files",
+        "changeset.diff",
+        "changeset.moves",
+        "changeset.packed",
+        "etl",
+        "branch.last_used",
+        "branch.description",
+        "branch.etl",
+        "branch.parent_name",
+        "children",
+        "parents",
+        "phase",
+        "bookmarks",
+        "tags"
+    ],
+    transforms={
+        "changeset.description": lambda d: strings.limit(d, 1000)
+    }
+)
 
 
 KNOWN_TAGS = {
@@ -0,0 +1,158 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from math import log
+from time import time
+
+from mo_dots import Data, wrap
+from mo_logs import Log
+from mo_threads import Thread, Till, Lock
+from mo_times import SECOND, Duration
+
+METRIC_REPORT_PERIOD = 60 * SECOND
+BUCKET_BASE = 1.1  # EACH BUCKET IS 10% WIDER THAN THE LAST, SO A PERCENTILE IS WITHIN 10%
+MIN_MILLIS = 0.01  # BUCKET 0 COUNTS DURATIONS LESS THAN THIS
+NUM_BUCKETS = 200  # BUCKET i COUNTS DURATIONS LESS THAN MIN_MILLIS * BUCKET_BASE^i MILLISECONDS (ABOUT 28 MINUTES FOR THE LAST BOUNDED ONE)
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram(object):
+    """
+    LATENCY HISTOGRAM WITH LOGARITHMIC BUCKETS, EACH BUCKET_BASE TIMES WIDER THAN THE LAST
+    add() TAKES NO LOCK; UNDER HEAVY CONTENTION A FEW COUNTS MAY BE LOST
+    """
+
+    __slots__ = ["counts", "total", "max"]
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        millis = seconds * 1000
+        if millis < MIN_MILLIS:
+            i = 0
+        else:
+            i = min(NUM_BUCKETS - 1, int(log(millis / MIN_MILLIS, BUCKET_BASE)) + 1)
+        self.counts[i] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def percentile(self, percentile):
+        """
+        :return: UPPER BOUND (IN SECONDS) OF THE BUCKET HOLDING THE GIVEN PERCENTILE
+        """
+        counts = list(self.counts)
+        target = percentile * sum(counts)
+        acc = 0
+        for i, c in enumerate(counts):
+            acc += c
+            if c and acc >= target:
+                if i == NUM_BUCKETS - 1:
+                    return self.max
+                return min(self.max, MIN_MILLIS * (BUCKET_BASE ** i) / 1000)
+        return None
+
+    def snapshot(self):
+        count = self.count
+        output = Data(
+            count=count,
+            total=self.total,
+            mean=self.total / count if count else None,
+            max=self.max
+        )
+        for p in PERCENTILES:
+            output["p" + str(int(p * 100))] = self.percentile(p)
+        return output
+
+
+class Metrics(object):
+    """
+    NAMED COUNTERS AND LATENCY HISTOGRAMS
+    WHEN NOT enabled, start() AND end() DO NOTHING, SO THEY CAN STAY ON THE HOT PATH
+    """
+
+    def __init__(self, name, enabled=False, period=METRIC_REPORT_PERIOD):
+        """
+        :param name: FOR THE LOGS
+        :param enabled: False TO RECORD NOTHING
+        :param period: HOW OFTEN TO LOG (AND EXPORT) A SNAPSHOT; None FOR NEVER
+        """
+        self.name = name
+        self.enabled = enabled
+        self.locker = Lock("metrics for " + name)
+        self.counters = {}
+        self.histograms = {}
+        self.exporters = []
+        self.period = Duration(period) if period else None
+        if enabled and self.period:
+            Thread.run("report " + name + " metrics", self._daemon)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def start(self):
+        """
+        :return: TOKEN TO GIVE TO end()
+        """
+        if not self.enabled:
+            return None
+        return time()
+
+    def end(self, name, start):
+        """
+        COUNT name, AND RECORD THE TIME SINCE start
+        """
+        if start is None:
+            return
+        duration = time() - start
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.locker:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.add(duration)
+
+    def snapshot(self):
+        """
+        :return: Data WITH counters, AND A SUMMARY OF EACH HISTOGRAM
+        """
+        with self.locker:
+            counters = dict(self.counters)
+            histograms = list(self.histograms.items())
+        return wrap({
+            "name": self.name,
+            "counters": counters,
+            "latency": {name: h.snapshot() for name, h in histograms}
+        })
+
+    def add_exporter(self, exporter):
+        """
+        :param exporter: FUNCTION THAT ACCEPTS A snapshot(); CALLED EVERY period
+        """
+        self.exporters.append(exporter)
+
+    def _daemon(self, please_stop):
+        while not please_stop:
+            (please_stop | Till(seconds=self.period.seconds)).wait()
+            snapshot = self.snapshot()
+            Log.note("{{name}} metrics:\n{{snapshot|json|indent}}", name=self.name, snapshot=snapshot)
+            for e in self.exporters:
+                try:
+                    e(snapshot)
+                except Exception as cause:
+                    Log.warning("metrics exporter failed", cause=cause)
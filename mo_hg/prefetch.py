@@ -0,0 +1,175 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from mo_dots import listwrap, Null
+from mo_future import text_type
+from mo_logs import Log
+from mo_logs.strings import expand_template
+from mo_threads import Lock, Signal, Queue, Thread
+
+from mo_hg.repos.revisions import Revision
+
+DEBUG = False
+PREFETCH_DEPTH = 20  # NUMBER OF REVISIONS TO FETCH AHEAD OF THE CONSUMER
+PREFETCH_THREADS = 4
+LOG_URL = "{{location}}/json-log/{{rev}}?revcount={{num}}"
+
+
+class RevisionWalker(object):
+    """
+    BREADTH-FIRST WALK OF THE parents (OR children) OF A REVISION
+    THE NEXT depth REVISIONS ARE FETCHED IN THE BACKGROUND WHILE THE CALLER CONSUMES
+    THE EARLIER ONES.  WHEN WALKING parents, json-log IS USED TO LEARN THE ANCESTRY
+    AHEAD OF THE FETCHES, SO A LINEAR HISTORY DOES NOT COST ONE ROUND TRIP PER REVISION
+    """
+
+    def __init__(self, hg, revision, direction, locale=None, depth=PREFETCH_DEPTH, please_stop=None):
+        """
+        :param hg: HgMozillaOrg INSTANCE
+        :param revision: STARTING REVISION (NOT INCLUDED IN THE RESULT)
+        :param direction: "parents" OR "children"
+        :param depth: MAXIMUM NUMBER OF REVISIONS FETCHED AHEAD OF THE CONSUMER
+        :param please_stop: OPTIONAL Signal TO CANCEL THE WALK
+        """
+        if direction not in ("parents", "children"):
+            Log.error("Expecting direction of parents or children, not {{direction}}", direction=direction)
+        self.hg = hg
+        self.branch = revision.branch
+        self.locale = locale
+        self.direction = direction
+        self.depth = max(1, depth)
+        self.please_stop = Signal("stop walking from " + text_type(revision.changeset.id))
+        if please_stop is not None:
+            please_stop.on_go(self.please_stop.go)
+
+        self.locker = Lock("revision walker")
+        self.work = Queue("revision walker work")
+        self.order = []  # REVISION IDS, IN BREADTH-FIRST ORDER
+        self.seen = set()  # SHORT IDS OF EVERYTHING IN order
+        self.results = {}  # MAP FROM id TO (ready, revision) PAIR
+        self.hints = {}  # MAP FROM SHORT id TO LIST OF parents, LEARNED BEFORE THE REVISION ARRIVES
+        self.hint_pending = False
+        self.hint_tried = set()  # SHORT IDS WE ALREADY ASKED json-log ABOUT
+        self.next_submit = 0  # INDEX INTO order OF NEXT REVISION TO FETCH
+        self.consumed = 0  # INDEX INTO order OF NEXT REVISION TO GIVE TO CONSUMER
+        self.expanded = 0  # INDEX INTO order OF NEXT REVISION TO FIND NEIGHBOURS FOR
+
+        with self.locker:
+            self._append(revision.changeset.id)
+            self._submit()
+
+        self.threads = []  # STARTED BY THE FIRST next(), SO AN ITERATOR NEVER USED LEAVES NO THREADS
+
+    def __iter__(self):
+        try:
+            self.threads = [
+                Thread.run("revision walker " + text_type(i), self._worker, please_stop=self.please_stop)
+                for i in range(PREFETCH_THREADS)
+            ]
+            first = True
+            while not self.please_stop:
+                with self.locker:
+                    if self.consumed >= len(self.order):
+                        return
+                    id = self.order[self.consumed]
+                    self.consumed += 1
+                    self._submit()
+                    ready, _ = self.results[id]
+
+                (ready | self.please_stop).wait()
+                if self.please_stop:
+                    return
+                with self.locker:
+                    _, rev = self.results.pop(id)
+                if first:
+                    first = False  # DO NOT EMIT THE STARTING REVISION
+                    continue
+                if rev:
+                    yield rev
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.please_stop.go()
+
+    def _append(self, id):
+        # ASSUME LOCKED
+        short = id[:12]
+        if short in self.seen:
+            return
+        self.seen.add(short)
+        self.order.append(id)
+
+    def _submit(self):
+        # ASSUME LOCKED
+        limit = min(len(self.order), self.consumed + self.depth)
+        while self.next_submit < limit:
+            id = self.order[self.next_submit]
+            self.next_submit += 1
+            self.results[id] = (Signal(id), None)
+            self.work.add(("revision", id))
+
+    def _expand(self):
+        # ASSUME LOCKED
+        while self.expanded < len(self.order):
+            id = self.order[self.expanded]
+            neighbours = self.hints.pop(id[:12], None)
+            if neighbours is None:
+                ready, rev = self.results.get(id, (None, None))
+                if not ready:
+                    # NOT FETCHED YET
+                    if self.direction == "parents" and not self.hint_pending and id[:12] not in self.hint_tried:
+                        self.hint_pending = True
+                        self.hint_tried.add(id[:12])
+                        self.work.add(("log", id))
+                    break
+                neighbours = listwrap(rev[self.direction]) if rev else []
+            self.expanded += 1
+            for n in neighbours:
+                self._append(n)
+        self._submit()
+
+    def _worker(self, please_stop):
+        while not please_stop:
+            task = self.work.pop(till=please_stop)
+            if please_stop:
+                break
+            type_, id = task
+            if type_ == "log":
+                self._get_hints(id)
+                continue
+
+            try:
+                rev = self.hg.get_revision(Revision(branch=self.branch, changeset={"id": id}), self.locale)
+            except Exception as e:
+                Log.warning("Can not get revision {{revision|left(12)}}, walk is incomplete", revision=id, cause=e)
+                rev = Null
+            with self.locker:
+                ready, _ = self.results[id]
+                self.results[id] = (ready, rev)
+                ready.go()
+                self._expand()
+
+    def _get_hints(self, id):
+        url = expand_template(LOG_URL, {"location": self.branch.url.rstrip("/"), "rev": id, "num": self.depth * 2})
+        try:
+            data = self.hg._get_and_retry(url, self.branch)
+            hints = {c.node: list(listwrap(c.parents)) for c in data.changesets}
+        except Exception as e:
+            DEBUG and Log.note("can not read ancestry from {{url}}", url=url, cause=e)
+            hints = {}
+        with self.locker:
+            for node, parents in hints.items():
+                if self.direction == "parents":
+                    self.hints[node[:12]] = parents
+            self.hint_pending = False
+            self._expand()
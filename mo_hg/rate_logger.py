@@ -8,38 +8,100 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
+from time import time
+
+from mo_dots import Data
 from mo_logs import Log
-from mo_threads import Till, Thread, Lock
-from mo_times import Date, SECOND
+from mo_threads import Till, Thread
+from mo_times import SECOND
+
+from mo_hg.metrics import Histogram
 
-METRIC_DECAY_RATE = 0.9  # PER-SECOND DECAY RATE FOR REPORTING REQUEST RATE
 METRIC_REPORT_PERIOD = 10 * SECOND
+WINDOW = 60  # SECONDS OF COUNTS KEPT BY A Window
+
+
+class Window(object):
+    """
+    COUNTS FOR EACH OF THE LAST size SECONDS
+    add() TAKES NO LOCK; UNDER HEAVY CONTENTION A FEW COUNTS MAY BE LOST
+    """
+
+    __slots__ = ["counts", "seconds", "size"]
+
+    def __init__(self, size=WINDOW):
+        self.size = size
+        self.counts = [0] * size
+        self.seconds = [0] * size  # THE SECOND EACH SLOT IS COUNTING
+
+    def add(self, now, amount=1):
+        second = int(now)
+        i = second % self.size
+        if self.seconds[i] != second:
+            self.seconds[i] = second
+            self.counts[i] = 0
+        self.counts[i] += amount
+
+    def total(self, now, seconds=None):
+        """
+        :return: SUM OF THE COUNTS OF THE LAST seconds (NOT INCLUDING THE CURRENT, PARTIAL, SECOND)
+        """
+        second = int(now)
+        seconds = min(self.size - 1, seconds or self.size - 1)
+        return sum(
+            c
+            for s, c in zip(list(self.seconds), list(self.counts))
+            if second - seconds <= s < second
+        )
+
+    def rate(self, now, seconds=None):
+        """
+        :return: AVERAGE PER SECOND, OVER THE LAST seconds
+        """
+        seconds = min(self.size - 1, seconds or self.size - 1)
+        return self.total(now, seconds) / seconds
 
 
 class RateLogger(object):
+    """
+    COUNT EVENTS (AND THEIR DURATIONS) AND LOG THE RATE EVERY METRIC_REPORT_PERIOD
+    add() TAKES NO LOCK
+    """
 
     def __init__(self, name):
         self.name = name
-        self.lock = Lock("rate locker")
-        self.request_rate = 0.0
-        self.last_request = Date.now()
+        self.count = 0
+        self.window = Window()
+        self.latency = Histogram()
 
         Thread.run("rate logger", self._daemon)
 
-    def add(self, timestamp):
-        with self.lock:
-            decay = METRIC_DECAY_RATE ** (timestamp - self.last_request).seconds
-            self.request_rate = decay*self.request_rate + 1
-            self.last_request = timestamp
+    def add(self, timestamp, duration=None):
+        """
+        :param timestamp: Date OF THE EVENT
+        :param duration: SECONDS THE EVENT TOOK, IF ANY
+        """
+        self.count += 1
+        self.window.add(timestamp.unix)
+        if duration is not None:
+            self.latency.add(duration)
+
+    def rate(self, seconds=METRIC_REPORT_PERIOD.seconds):
+        return self.window.rate(time(), seconds)
+
+    def snapshot(self):
+        now = time()
+        output = Data(
+            name=self.name,
+            count=self.count,
+            rate_10s=self.window.rate(now, 10),
+            rate_1m=self.window.rate(now)
+        )
+        if self.latency.count:
+            output.latency = self.latency.snapshot()
+        return output
 
     def _daemon(self, please_stop):
         while not please_stop:
-            timestamp = Date.now()
-            with self.lock:
-                decay = METRIC_DECAY_RATE ** (timestamp - self.last_request).seconds
-                request_rate = self.request_rate = decay * self.request_rate
-                self.last_request = timestamp
-
-            Log.note("{{name}} request rate: {{rate|round(places=2)}} requests per second", name=self.name, rate=request_rate)
+            Log.note("{{name}} request rate: {{rate|round(places=2)}} requests per second", name=self.name, rate=self.rate())
             (please_stop | Till(seconds=METRIC_REPORT_PERIOD.seconds)).wait()
-
@@ -13,7 +13,8 @@ import os
 import flask
 from flask import Flask, Response
 
-from mo_hg.cache import Cache
+from mo_hg.cache import Cache, STATS_PATH
+from mo_hg.cache_warmer import CacheWarmer
 from mo_json import value2json
 from mo_logs import Log, constants, startup, Except
 from mo_logs.strings import unicode2utf8
@@ -37,12 +38,27 @@ class RelayApp(Flask):
 flask_app = None
 config = None
 cache = None
+warmer = None
+
+
+@cors_wrapper
+def relay_stats():
+    status = cache.status()
+    if warmer is not None:
+        status.warm = warmer.warmed
+    return Response(
+        unicode2utf8(value2json(status, pretty=True)),
+        status=200,
+        headers={
+            "Content-Type": "application/json"
+        }
+    )
 
 
 @cors_wrapper
 def relay_get(path):
     try:
-        return cache.request("get", path, flask.request.headers)
+        return cache.request("get", _with_query(path), flask.request.headers)
     except Exception as e:
         e = Except.wrap(e)
         Log.warning("could not handle request", cause=e)
@@ -58,7 +74,7 @@ def relay_get(path):
 @cors_wrapper
 def relay_post(path):
     try:
-        return cache.request("post", path, flask.request.headers)
+        return cache.request("post", _with_query(path), flask.request.headers)
     except Exception as e:
         e = Except.wrap(e)
         Log.warning("could not handle request", cause=e)
@@ -71,10 +87,22 @@ def relay_post(path):
         )
 
 
+def _with_query(path):
+    # THE QUERY IS PART OF THE CACHE KEY
+    query = flask.request.query_string
+    if not query:
+        return path
+    return path + "?" + query.decode("utf8")
+
+
 def add(any_flask_app):
-    global cache
+    global cache, warmer
 
     cache = Cache(config.cache)
+    if config.warm and not config.args.process_num:
+        # ONE PROCESS IS ENOUGH TO WATCH FOR PUSHES
+        warmer = CacheWarmer(cache, kwargs=config.warm)
+    any_flask_app.add_url_rule(str('/' + STATS_PATH), None, relay_stats, methods=[str('GET')])
     any_flask_app.add_url_rule(str('/<path:path>'), None, relay_get, methods=[str('GET')])
     any_flask_app.add_url_rule(str('/<path:path>'), None, relay_post, methods=[str('POST')])
     any_flask_app.add_url_rule(str('/'), None, relay_get, methods=[str('GET')])
@@ -100,7 +128,20 @@ if __name__ in ("__main__",):
         finally:
             Log.stop()
 
-    if config.flask:
+    if config.asyncio:
+        # ONE COROUTINE PER WAITING CLIENT, RATHER THAN ONE THREAD (PYTHON 3 ONLY)
+        from mo_hg.relay_async import AsyncRelay
+
+        if config.asyncio.port and config.args.process_num:
+            config.asyncio.port += config.args.process_num
+        Log.note("Running asyncio...")
+        try:
+            AsyncRelay(cache, warmer, kwargs=config.asyncio).run()
+        except BaseException as e:
+            Log.warning(APP_NAME + " service shutdown!", cause=e)
+        finally:
+            Log.stop()
+    elif config.flask:
         if config.flask.port and config.args.process_num:
             config.flask.port += config.args.process_num
         Log.note("Running Flask...")
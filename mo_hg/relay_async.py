@@ -0,0 +1,282 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+ASYNCIO SERVER FOR THE RELAY (PYTHON 3 ONLY)
+A CLIENT WAITING ON A COALESCED REQUEST, ON ANOTHER PROCESS FETCHING THE SAME path (THE
+lease), OR ON THE RATE LIMIT, IS A COROUTINE, NOT A THREAD. THE EXECUTOR ONLY DOES THE
+DATABASE AND FILE WORK. THE UPSTREAM REQUESTS ARE STILL MADE BY THE Cache WORKER THREADS.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import asyncio
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.client import responses
+from urllib.parse import unquote
+
+from mo_dots import coalesce
+from mo_json import value2json
+from mo_kwargs import override
+from mo_logs import Log, Except
+from mo_times import Date
+
+from mo_hg.cache import InFlight, ON_DISK, response_headers, STATS_PATH
+
+EXECUTOR_THREADS = 20  # FOR DATABASE LOOKUPS AND FILE READS
+BACKLOG = 2048  # CONNECTIONS WAITING TO BE ACCEPTED
+KEEP_ALIVE_TIMEOUT = 60  # SECONDS AN IDLE CONNECTION IS KEPT OPEN
+MAX_LINE = 64 * 1024  # LONGEST REQUEST LINE, OR HEADER
+STATUS = dict(responses)  # REASON PHRASE FOR EACH STATUS CODE
+
+
+class AsyncRelay(object):
+    """
+    SERVE Cache.request() OVER HTTP/1.1, WITH ONE COROUTINE PER CONNECTION
+    """
+
+    @override
+    def __init__(self, cache, warmer=None, host="0.0.0.0", port=8088, threads=EXECUTOR_THREADS, kwargs=None):
+        """
+        :param cache: THE Cache TO SERVE
+        :param warmer: THE CacheWarmer, IF ANY, FOR THE STATS
+        :param threads: NUMBER OF THREADS FOR THE (BLOCKING) DATABASE AND FILE WORK
+        """
+        self.cache = cache
+        self.warmer = warmer
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.loop = None
+
+    def run(self):
+        self.loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(asyncio.start_server(
+            self._serve,
+            self.host,
+            self.port,
+            backlog=BACKLOG,
+            limit=MAX_LINE
+        ))
+        Log.note("Relay listening on {{host}}:{{port}}", host=self.host, port=self.port)
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+            self.executor.shutdown()
+
+    async def request(self, method, path, headers):
+        """
+        SAME AS Cache.request(), BUT WAITING DOES NOT HOLD A THREAD
+        :return: (status, headers, ASYNC GENERATOR OF BODY BYTES)
+        """
+        cache = self.cache
+        now = Date.now()
+        path = cache.keys.canonical(path)
+        cache.inbound_rate.add(now)
+        accept_gzip = "gzip" in coalesce(headers.get("Accept-Encoding"), "")
+
+        ready, pair, stale = cache.lookup(path, now)
+        if pair is None:
+            # fill() DOES NOT WAIT ON THE lease; A path ANOTHER PROCESS IS FETCHING IS WAITED FOR HERE, ON ready
+            found = await self.loop.run_in_executor(self.executor, cache.fill, ready, method, path, headers, now, stale)
+            if found is None:
+                cache.stats.upstream += 1
+                await self._wait(ready)
+                found = cache.result(path)
+            else:
+                cache.stats.database += 1
+        elif isinstance(pair[2], InFlight):
+            # JOINED A FETCH WHOSE BODY IS STILL ARRIVING
+            cache.stats.coalesced += 1
+            found = pair[1], pair[2]
+        elif pair[2] is not None:
+            cache.stats.memory += 1
+            found = pair[1], pair[2]
+        else:
+            # REQUEST IS IN THE QUEUE, WAIT FOR THE RESPONSE TO START
+            cache.stats.coalesced += 1
+            await self._wait(ready)
+            found = cache.result(path)
+
+        resp_headers, body = found
+        chunks = self._chunks(body)
+        if not accept_gzip:
+            chunks = _gunzip(chunks)
+        resp_headers = response_headers(resp_headers, body, accept_gzip)
+        return body.status, {_header_name(k): v for k, v in resp_headers.items()}, chunks
+
+    def status(self):
+        output = self.cache.status()
+        if self.warmer is not None:
+            output.warm = self.warmer.warmed
+        return output
+
+    def _wait(self, signal):
+        """
+        :return: FUTURE THAT IS DONE WHEN signal GOES
+        """
+        loop = self.loop
+        future = loop.create_future()
+        signal.on_go(lambda: loop.call_soon_threadsafe(_done, future))
+        return future
+
+    async def _chunks(self, body):
+        """
+        GZIPPED BYTES OF body
+        """
+        if isinstance(body, InFlight):
+            offset = 0
+            while True:
+                chunk, more = body.read_memory(offset)
+                if more is ON_DISK:
+                    # A SLOW, OR LATE, READER OF A SPILLED BODY; THE FILE IS READ OFF THE LOOP
+                    chunk, more = await self.loop.run_in_executor(self.executor, body.read, offset)
+                if chunk is not None:
+                    offset += len(chunk)
+                    yield chunk
+                elif more is None:
+                    return
+                else:
+                    await self._wait(more)
+        elif body.content is not None:
+            for chunk in body.chunks():
+                yield chunk
+        else:
+            chunks = body.chunks()
+            while True:
+                chunk = await self.loop.run_in_executor(self.executor, next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not line:
+                    break
+                request_line = line.decode("latin1").split()
+                if len(request_line) != 3:
+                    await _send(writer, 400, {"Content-Type": "text/plain"}, _one(b"bad request line"), False)
+                    break
+                method, target, version = request_line
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin1").partition(":")
+                    headers[_header_name(name.strip())] = value.strip()
+                length = int(headers.get("Content-Length") or 0)
+                if length:
+                    await reader.readexactly(length)  # THE RELAY DOES NOT FORWARD REQUEST BODIES
+
+                keep_alive = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+                head = method.upper() == "HEAD"
+                path, _, query = target.partition("?")
+                path = unquote(path).lstrip("/")
+                if query:
+                    path += "?" + query
+
+                try:
+                    if path == STATS_PATH:
+                        status, resp_headers, chunks = 200, {"Content-Type": "application/json"}, _one(value2json(self.status()).encode("utf8"))
+                    else:
+                        # A HEAD IS A GET TO THE Cache (SO THE FULL BODY IS KEPT), WITHOUT SENDING THE BODY
+                        status, resp_headers, chunks = await self.request("get" if head else method.lower(), path, headers)
+                except Exception as e:
+                    e = Except.wrap(e)
+                    Log.warning("could not handle request", cause=e)
+                    status = 400
+                    resp_headers = {"Content-Type": "text/html"}
+                    chunks = _one(value2json(e, pretty=True).encode("utf8"))
+                _cors(resp_headers, headers)
+                await _send(writer, status, resp_headers, chunks, keep_alive, self.cache.stats, head)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            Log.warning("problem serving connection", cause=e)
+        finally:
+            writer.close()
+
+
+async def _send(writer, status, headers, chunks, keep_alive, stats=None, head=False):
+    """
+    :param head: True TO SEND ONLY THE HEADERS (THE RESPONSE TO A HEAD)
+    """
+    chunked = keep_alive and "Content-Length" not in headers
+    headers["Connection"] = "keep-alive" if keep_alive else "close"
+    if chunked:
+        headers["Transfer-Encoding"] = "chunked"
+    lines = ["HTTP/1.1 " + str(status) + " " + STATUS.get(status, "")]
+    lines.extend(k + ": " + str(v) for k, v in headers.items())
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin1"))
+    if head:
+        await writer.drain()
+        return
+    async for chunk in chunks:
+        if stats is not None:
+            stats.bytes_served += len(chunk)
+        if chunked:
+            writer.write(("%x\r\n" % len(chunk)).encode("ascii") + chunk + b"\r\n")
+        else:
+            writer.write(chunk)
+        await writer.drain()
+    if chunked:
+        writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def _gunzip(chunks):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    async for c in chunks:
+        data = decompressor.decompress(c)
+        if data:
+            yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+async def _one(data):
+    yield data
+
+
+def _done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def _header_name(name):
+    # Accept-Encoding, X-Relay-Lane, ...
+    return "-".join(p.capitalize() for p in name.split("-"))
+
+
+def _cors(headers, request_headers):
+    # SAME AS pyLibrary.env.flask_wrappers.cors_wrapper
+    for k, v in [
+        ("Access-Control-Allow-Origin", "*"),
+        ("Access-Control-Allow-Headers", request_headers.get("Access-Control-Request-Headers")),
+        ("Access-Control-Allow-Methods", request_headers.get("Access-Control-Request-Methods")),
+        ("Content-Type", "application/json"),
+        ("Strict-Transport-Security", "max-age=31536000; includeSubDomains; preload")
+    ]:
+        if v is not None:
+            headers.setdefault(k, v)
@@ -0,0 +1,160 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+COPY A RELAY CACHE TO A PACK FILE, AND BACK, TO SEED A NEW RELAY NODE
+
+    python -m mo_hg.relay_pack --settings=resources/config/relay.json --export=relay.pack --match=json-rev --age=7day
+    python -m mo_hg.relay_pack --settings=resources/config/relay.json --import=relay.pack
+    python -m mo_hg.relay_pack --settings=resources/config/relay.json --vacuum    # WHILE THE RELAY IS DOWN
+
+THE PACK IS A HEADER LINE, THEN, FOR EACH ENTRY, ONE LINE OF JSON FOLLOWED BY
+ITS size BYTES OF (ALREADY GZIPPED) BODY
+
+--vacuum CONVERTS AN OLD DATABASE SO THE RELAY CAN RETURN FREED PAGES A FEW AT A TIME
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+
+from mo_dots import wrap
+from mo_files import File
+from mo_json import value2json
+from mo_logs import Log, startup, constants
+from mo_times import Date, Duration
+
+from mo_hg.cache import BodyWriter, CHUNK_SIZE, body_file
+from mo_hg.cache_db import CacheDB
+
+PACK_HEADER = b"hg-relay-pack 1\n"
+IMPORT_BATCH = 500  # ENTRIES INSERTED PER TRANSACTION
+MAX_IMPORT_BYTES = 64 * 1024 * 1024  # BYTES OF BODIES HELD IN MEMORY BEFORE INSERTING
+
+
+def export_pack(db, filename, match=None, age=None):
+    """
+    :param db: CacheDB TO READ
+    :param filename: PACK FILE TO WRITE
+    :param match: REGULAR EXPRESSION THE path MUST CONTAIN
+    :param age: Duration; ONLY ENTRIES USED IN THIS LONG
+    :return: NUMBER OF ENTRIES WRITTEN
+    """
+    pattern = re.compile(match) if match else None
+    since = (Date.now() - Duration(age)).unix if age else None
+    num = 0
+    with open(filename, "wb") as pack:
+        pack.write(PACK_HEADER)
+        for path, headers, content, file, size, timestamp, expires in db.rows(since):
+            if pattern and not pattern.search(path):
+                continue
+            try:
+                if content is None:
+                    with open(file, "rb") as f:
+                        content = f.read()
+            except Exception as e:
+                Log.note("Skipping {{path}}, body is missing", path=path, cause=e)
+                continue
+            meta = value2json({
+                "path": path,
+                "headers": headers,
+                "size": len(content),
+                "timestamp": timestamp,
+                "expires": expires
+            })
+            pack.write(meta.encode("utf8") + b"\n")
+            pack.write(content)
+            num += 1
+    Log.note("Exported {{num}} entries to {{file}}", num=num, file=filename)
+    return num
+
+
+def import_pack(db, filename, files=None):
+    """
+    :param db: CacheDB TO FILL; ENTRIES IT ALREADY HAS ARE KEPT
+    :param filename: PACK FILE TO READ
+    :param files: DIRECTORY FOR THE LARGE BODIES (SAME AS THE Cache files)
+    :return: NUMBER OF ENTRIES READ
+    """
+    num = 0
+    batch = []
+    batch_bytes = 0
+    seen = set()  # PATHS IMPORTED SO FAR
+    with open(filename, "rb") as pack:
+        if pack.readline() != PACK_HEADER:
+            Log.error("{{file}} is not a relay pack", file=filename)
+        while True:
+            line = pack.readline()
+            if not line:
+                break
+            meta = json.loads(line.decode("utf8"))
+            path = meta["path"]
+            if path in seen or db.has(path):
+                # KEEP THE EXISTING ENTRY; DO NOT WRITE OVER ITS BODY FILE
+                pack.seek(meta["size"], os.SEEK_CUR)
+                num += 1
+                continue
+            seen.add(path)
+            writer = BodyWriter(True, files)
+            remaining = meta["size"]
+            while remaining:
+                data = pack.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    writer.abort()
+                    Log.error("{{file}} is truncated at {{path}}", file=filename, path=path)
+                writer.write(data)
+                remaining -= len(data)
+            body = writer.close(body_file(files, path))
+            batch.append((path, meta["headers"], body.content, body.file, body.size, meta["timestamp"], meta.get("expires")))
+            batch_bytes += body.size if body.content is not None else 0
+            num += 1
+            if len(batch) >= IMPORT_BATCH or batch_bytes >= MAX_IMPORT_BYTES:
+                db.put_many(batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            db.put_many(batch)
+    Log.note("Imported {{num}} entries from {{file}}", num=num, file=filename)
+    return num
+
+
+def main():
+    db = None
+    try:
+        settings = startup.read_settings(defs=[
+            {"name": ["--export"], "help": "pack file to write", "type": str, "dest": "export", "required": False},
+            {"name": ["--import"], "help": "pack file to read", "type": str, "dest": "import", "required": False},
+            {"name": ["--match"], "help": "only paths matching this regular expression", "type": str, "dest": "match", "required": False},
+            {"name": ["--age"], "help": "only entries used within this duration (eg 7day)", "type": str, "dest": "age", "required": False},
+            {"name": ["--vacuum"], "help": "convert the database to incremental vacuum (relay must be down)", "action": "store_true", "dest": "vacuum"}
+        ])
+        constants.set(settings.constants)
+        Log.start(settings.debug)
+
+        args = wrap(settings.args)
+        db = CacheDB(daemons=False, kwargs=settings.cache.database)
+        if args.vacuum:
+            db.convert_to_incremental()
+        elif args["export"]:
+            export_pack(db, args["export"], match=args.match, age=args.age)
+        elif args["import"]:
+            import_pack(db, args["import"], files=File(settings.cache.files).abspath if settings.cache.files else None)
+        else:
+            Log.error("Expecting --export, --import or --vacuum")
+    except Exception as e:
+        Log.error("Problem with relay pack", e)
+    finally:
+        if db is not None:
+            db.stop()
+        Log.stop()
+
+
+if __name__ == "__main__":
+    main()
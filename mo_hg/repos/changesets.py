@@ -11,16 +11,95 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
-from mo_dots import Data
+import base64
+import zlib
 
+from mo_dots import unwrap
+from mo_hg.repos.records import Record, _set_record
+from mo_json import value2json, json2value
+from mo_logs import Log
 
-class Changeset(Data):
+PACKED_FIELDS = ("diff", "moves")  # KEPT TOGETHER IN THE packed PROPERTY
+PACK_VERSION = b"\x01"
+
+
+class Changeset(Record):
+    """
+    diff AND moves MAY ARRIVE AS ONE COMPRESSED packed PROPERTY (SEE pack())
+    IT IS ONLY DECODED WHEN ONE OF THEM IS ACCESSED, OR ASSIGNED, OR THE
+    Changeset IS ITERATED (OR SERIALIZED)
+    """
+    _fields = ("id", "id12", "author", "description", "date", "files", "backedoutby", "bug", "diff", "moves", "packed")
+    __slots__ = _fields + ("_key",)
+
+    def __getattr__(self, key):
+        if key in PACKED_FIELDS and self._unpack():
+            return getattr(self, key)
+        return Record.__getattr__(self, key)
+
+    def __setattr__(self, key, value):
+        if key in PACKED_FIELDS:
+            self._unpack()
+        _set_record(self, key, value)
+
+    def __setitem__(self, key, value):
+        self.__setattr__(key, value)
+
+    def __iter__(self):
+        # items(), __data__() AND to_json() ALL COME THROUGH HERE
+        self._unpack()
+        return Record.__iter__(self)
+
+    def _unpack(self):
+        """
+        :return: True IF THERE WAS SOMETHING TO UNPACK
+        """
+        try:
+            packed = object.__getattribute__(self, "packed")
+        except AttributeError:
+            return False
+        object.__delattr__(self, "packed")
+        for k, v in unpack(packed).items():
+            if k in PACKED_FIELDS:
+                _set_record(self, k, v)
+        return True
+
+    def _changed(self, key):
+        if key == "id":
+            object.__setattr__(self, "_key", hash(unwrap(self.id)))
 
     def __hash__(self):
-        return hash(self.id)
+        try:
+            return self._key
+        except AttributeError:
+            return hash(None)
 
     def __eq__(self, other):
         if other==None:
             return False
         return self.id == other.id
 
+
+
+def pack(diff, moves):
+    """
+    :return: diff AND moves AS ONE COMPRESSED, base64-ENCODED STRING (FOR THE ES binary TYPE)
+    """
+    content = value2json({"diff": diff, "moves": moves}).encode("utf8")
+    return base64.b64encode(PACK_VERSION + zlib.compress(content)).decode("ascii")
+
+
+def unpack(packed):
+    raw = base64.b64decode(packed)
+    if raw[0:1] != PACK_VERSION:
+        Log.error("Unknown packing version")
+    return json2value(zlib.decompress(raw[1:]).decode("utf8"))
+
+
+def pack_changeset(changeset):
+    """
+    :return: PLAIN dict OF changeset (FOR ES), WITH diff AND moves REPLACED BY packed
+    """
+    output = Changeset(changeset).__data__()
+    output["packed"] = pack(output.pop("diff", None), output.pop("moves", None))
+    return output
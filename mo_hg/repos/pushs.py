@@ -11,8 +11,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
-from mo_dots import Data
+from mo_hg.repos.records import Record
 
 
-class Push(Data):
-    pass
+class Push(Record):
+    _fields = ("id", "date", "user")
+    __slots__ = _fields
+
+    def __hash__(self):
+        return hash(self.id)
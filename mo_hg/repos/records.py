@@ -0,0 +1,204 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import json
+from collections import Mapping
+
+from mo_dots import Null, wrap, unwrap, FlatList, Data
+from mo_future import text_type, binary_type
+from mo_json import value2json
+
+
+class Record(Mapping):
+    """
+    COMPACT ALTERNATIVE TO Data FOR THE (MANY) OBJECTS WE KEEP IN MEMORY
+    KNOWN PROPERTIES ARE STORED IN __slots__; UNKNOWN PROPERTIES GO TO A SMALL OVERFLOW dict
+    BEHAVES LIKE Data: MISSING PROPERTIES ARE Null, ASSIGNING None REMOVES THE PROPERTY
+    """
+
+    __slots__ = ["_extra"]
+    _fields = ()  # THE PROPERTIES KEPT IN __slots__
+    _types = {}   # MAP FROM PROPERTY NAME TO Record SUBCLASS, FOR CONVERTING NESTED dicts
+
+    def __init__(self, *args, **kwargs):
+        if args:
+            kwargs = dict(unwrap(args[0]), **kwargs)
+        for k, v in kwargs.items():
+            _set_record(self, k, v)
+
+    def __getattr__(self, key):
+        # ONLY CALLED WHEN THE SLOT IS EMPTY, OR THE PROPERTY IS UNKNOWN
+        if key.startswith("_"):
+            raise AttributeError(key)
+        try:
+            extra = object.__getattribute__(self, "_extra")
+        except AttributeError:
+            return Null
+        return wrap(extra.get(key))
+
+    def __setattr__(self, key, value):
+        _set_record(self, key, value)
+
+    def __getitem__(self, key):
+        if "." in key:
+            output = self
+            for step in key.split("."):
+                output = output[step]
+            return output
+        if key in self._fields:
+            return getattr(self, key)
+        return self.__getattr__(key)
+
+    def __setitem__(self, key, value):
+        _set_record(self, key, value)
+
+    def __delitem__(self, key):
+        _set_record(self, key, None)
+
+    def get(self, key, default=None):
+        output = self[key]
+        if output == None:
+            return default
+        return output
+
+    def keys(self):
+        return list(self.__iter__())
+
+    def items(self):
+        return [(k, self[k]) for k in self.__iter__()]
+
+    def values(self):
+        return [self[k] for k in self.__iter__()]
+
+    def __iter__(self):
+        for k in self._fields:
+            try:
+                object.__getattribute__(self, k)
+                yield k
+            except AttributeError:
+                pass
+        try:
+            extra = object.__getattribute__(self, "_extra")
+        except AttributeError:
+            return
+        for k in extra.keys():
+            yield k
+
+    def __len__(self):
+        return sum(1 for _ in self.__iter__())
+
+    def __contains__(self, key):
+        return self[key] != None
+
+    def __copy__(self):
+        output = object.__new__(self.__class__)
+        for k in self.__slots__:
+            try:
+                object.__setattr__(output, k, object.__getattribute__(self, k))
+            except AttributeError:
+                pass
+        try:
+            object.__setattr__(output, "_extra", dict(object.__getattribute__(self, "_extra")))
+        except AttributeError:
+            pass
+        return output
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if other == None:
+            return False
+        return self.__data__() == unwrap(_scrub(other))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __data__(self):
+        """
+        :return: PLAIN dict, SUITABLE FOR value2json()
+        """
+        return {k: _scrub(v) for k, v in self.items()}
+
+    def __json__(self):
+        return value2json(self.__data__())
+
+    to_json = __json__
+
+    @classmethod
+    def from_json(cls, value):
+        """
+        :param value: JSON TEXT (OR ALREADY-PARSED dict)
+        :return: INSTANCE OF cls
+        """
+        if isinstance(value, binary_type):
+            value = value.decode("utf8")
+        if isinstance(value, text_type):
+            value = json.loads(value)
+        return cls(value)
+
+    def _changed(self, key):
+        """
+        CALLED AFTER key IS ASSIGNED, SO SUBCLASSES CAN INVALIDATE PRECOMPUTED VALUES
+        """
+        pass
+
+    def __repr__(self):
+        return self.__class__.__name__ + "(" + repr(self.__data__()) + ")"
+
+
+def _set_record(record, key, value):
+    cls = record.__class__
+    if key in cls._fields:
+        if value is None or value is Null:
+            try:
+                object.__delattr__(record, key)
+            except AttributeError:
+                pass
+        else:
+            type_ = cls._types.get(key)
+            if type_ is not None and value.__class__ is not type_ and isinstance(value, Mapping):
+                value = type_(value)
+            else:
+                value = wrap(value)
+            object.__setattr__(record, key, value)
+        record._changed(key)
+        return
+
+    try:
+        extra = object.__getattribute__(record, "_extra")
+    except AttributeError:
+        if value is None or value is Null:
+            return
+        extra = {}
+        object.__setattr__(record, "_extra", extra)
+
+    if value is None or value is Null:
+        extra.pop(key, None)
+    else:
+        extra[key] = unwrap(value)
+
+
+def _scrub(value):
+    """
+    CONVERT Records, Data AND FlatLists TO PLAIN dicts AND lists
+    """
+    if isinstance(value, Record):
+        return value.__data__()
+    elif isinstance(value, (Data, dict)):
+        return {k: _scrub(v) for k, v in unwrap(value).items() if v is not None}
+    elif isinstance(value, (FlatList, list, tuple)):
+        return [_scrub(v) for v in unwrap(value)]
+    else:
+        return value
@@ -11,17 +11,53 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
-from mo_dots import Data
+from mo_future import text_type, binary_type
+from mo_hg.repos.changesets import Changeset
+from mo_hg.repos.pushs import Push
+from mo_hg.repos.records import Record
 
 
-class Revision(Data):
+class Revision(Record):
+    _fields = ("branch", "index", "changeset", "parents", "children", "push", "phase", "bookmarks", "etl")
+    _types = {"changeset": Changeset, "push": Push}
+    __slots__ = _fields + ("_key",)
+
+    def _changed(self, key):
+        if key in ("branch", "changeset"):
+            try:
+                object.__delattr__(self, "_key")
+            except AttributeError:
+                pass
+
+    def key(self):
+        """
+        :return: (lowercase branch name, short changeset id) PAIR; COMPUTED ONCE
+        """
+        try:
+            return self._key
+        except AttributeError:
+            output = _revision_key(self)
+            object.__setattr__(self, "_key", output)
+            return output
+
     def __hash__(self):
-        return hash((self.branch.name.lower(), self.changeset.id[:12]))
+        return hash(self.key())
 
     def __eq__(self, other):
         if other == None:
             return False
-        return (self.branch.name.lower(), self.changeset.id[:12]) == (other.branch.name.lower(), other.changeset.id[:12])
+        if isinstance(other, Revision):
+            return self.key() == other.key()
+        return self.key() == _revision_key(other)
+
+
+def _revision_key(revision):
+    branch = revision.branch
+    if isinstance(branch, (text_type, binary_type)):
+        name = branch
+    else:
+        name = branch.name
+    return name.lower(), revision.changeset.id[:12]
 
 
 revision_schema = {
@@ -79,6 +115,9 @@ revision_schema = {
                                 }
                             }
                         },
+                        "packed": {
+                            "type": "binary"
+                        },
                         "diff": {
                             "type": "nested",
                             "dynamic": True,
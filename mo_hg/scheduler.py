@@ -0,0 +1,210 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from collections import deque
+from time import time
+
+from mo_dots import coalesce, listwrap, unwrap
+from mo_logs import Log
+from mo_threads import Lock, Till
+
+LANE_HEADER = "X-Relay-Lane"  # CLIENTS MAY NAME THEIR LANE
+DEFAULT_LANES = [
+    {"name": "interactive", "weight": 4, "paths": ["/json-rev/", "/json-info", "/json-pushes", "/rev/", "/json-log/", "/pushloghtml"]},
+    {"name": "bulk", "weight": 1, "paths": []}  # EVERYTHING ELSE
+]
+
+
+class TokenBucket(object):
+    """
+    ALLOW rate EVENTS PER SECOND, WITH BURSTS OF UP TO capacity
+    """
+
+    __slots__ = ["rate", "capacity", "tokens", "last"]
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(coalesce(capacity, rate)))
+        self.tokens = self.capacity
+        self.last = time()
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def wait_time(self, now):
+        """
+        :return: SECONDS UNTIL A TOKEN IS AVAILABLE (ZERO IF ONE IS AVAILABLE NOW)
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def acquire(self, now):
+        """
+        TAKE A TOKEN, IF ONE IS AVAILABLE
+        :return: ZERO IF TAKEN, OTHERWISE SECONDS UNTIL ONE IS AVAILABLE
+        """
+        wait = self.wait_time(now)
+        if wait <= 0:
+            self.take(now)
+        return wait
+
+
+def local_bucket(name, rate, capacity):
+    """
+    :return: TokenBucket FOR THIS PROCESS ONLY
+    """
+    return TokenBucket(rate, capacity)
+
+
+class Lane(object):
+    """
+    A QUEUE OF REQUESTS, WITH A weight (ITS FAIR SHARE) AND AN OPTIONAL rate LIMIT
+    """
+
+    def __init__(self, name, weight=1, rate=None, burst=None, paths=None, buckets=local_bucket):
+        self.name = name
+        self.weight = float(weight)
+        self.bucket = buckets("lane " + name, rate, coalesce(burst, rate)) if rate else None
+        self.paths = listwrap(paths)
+        self.queue = deque()
+        self.vtime = 0.0  # VIRTUAL TIME; THE LANE WITH THE SMALLEST GOES NEXT
+        self.served = 0
+
+
+class Scheduler(object):
+    """
+    TOKEN-BUCKET RATE LIMITER WITH PRIORITY LANES
+    ALL LANES SHARE ONE BUCKET OF rate REQUESTS PER SECOND.  WHEN MORE THAN ONE
+    LANE IS WAITING, THEY ARE SERVED IN PROPORTION TO THEIR weight; A LANE WITH
+    NOTHING WAITING DOES NOT HOLD BACK ITS SHARE, SO A BULK LANE CAN USE THE WHOLE
+    BUDGET WHILE THE INTERACTIVE LANE IS IDLE
+    """
+
+    def __init__(self, rate, period=1, lanes=None, buckets=local_bucket):
+        """
+        :param rate: REQUESTS PER SECOND, OVER ALL LANES
+        :param period: SECONDS OF rate ALLOWED IN A BURST
+        :param lanes: LIST OF {"name", "weight", "rate", "burst", "paths"}; THE LAST LANE IS THE DEFAULT
+        :param buckets: FUNCTION(name, rate, capacity) TO MAKE THE TOKEN BUCKETS; GIVE ONE THAT
+                        RETURNS A BUCKET SHARED BY ALL PROCESSES TO HAVE ONE BUDGET FOR ALL
+        """
+        self.locker = Lock("scheduler")
+        self.buckets = buckets
+        self.bucket = buckets("all", rate, rate * period)
+        self.lanes = [Lane(buckets=buckets, **l) for l in coalesce(unwrap(lanes), DEFAULT_LANES)]
+        if not self.lanes:
+            Log.error("Expecting at least one lane")
+        self.by_name = {l.name: l for l in self.lanes}
+        self.vclock = 0.0  # VIRTUAL TIME OF THE LAST REQUEST SERVED
+
+    def add_lane(self, name, weight=1, rate=None, burst=None, paths=None):
+        """
+        ADD A LANE, AHEAD OF THE OTHERS (SO IT IS NOT THE DEFAULT)
+        :return: THE Lane
+        """
+        lane = Lane(name, weight, rate, burst, paths, buckets=self.buckets)
+        with self.locker:
+            lane.vtime = self.vclock
+            self.lanes.insert(0, lane)
+            self.by_name[name] = lane
+        return lane
+
+    def lane_for(self, path, headers=None):
+        """
+        :return: THE Lane FOR THE REQUEST; CHOSEN BY LANE_HEADER, OR ELSE BY path
+        """
+        if headers:
+            lane = self.by_name.get(headers.get(LANE_HEADER))
+            if lane:
+                return lane
+        for lane in self.lanes:
+            if any(p in path for p in lane.paths):
+                return lane
+        return self.lanes[-1]
+
+    def add(self, lane, request):
+        with self.locker:
+            if not lane.queue:
+                # AN IDLE LANE DOES NOT SAVE UP ITS SHARE
+                lane.vtime = max(lane.vtime, self.vclock)
+            lane.queue.append(request)
+
+    def __len__(self):
+        return sum(len(l.queue) for l in self.lanes)
+
+    def pop(self, till=None):
+        """
+        WAIT FOR THE NEXT REQUEST THE BUDGET ALLOWS
+        THE TOKENS ARE TAKEN OUTSIDE THE locker, BECAUSE A SHARED BUCKET IS A
+        DATABASE TRANSACTION; THE CHOSEN REQUEST IS HELD ASIDE MEANWHILE
+        :param till: Signal TO STOP WAITING
+        :return: THE REQUEST, OR None IF till
+        """
+        while not till:
+            with self.locker:
+                lane, wait = self._choose(time())
+                if lane is None:
+                    if wait is None:
+                        self.locker.wait(till=till)  # NOTHING TO DO; WAIT FOR add()
+                    else:
+                        waiting = Till(seconds=wait)
+                        self.locker.wait(till=waiting | till if till is not None else waiting)
+                    continue
+                request = lane.queue.popleft()
+
+            now = time()
+            wait = self.bucket.acquire(now)
+            if wait <= 0:
+                if lane.bucket:
+                    lane.bucket.take(now)
+                with self.locker:
+                    self.vclock = lane.vtime
+                    lane.vtime += 1 / lane.weight
+                    lane.served += 1
+                return request
+
+            with self.locker:
+                # NO TOKEN; PUT IT BACK, AT THE FRONT OF ITS LANE
+                lane.queue.appendleft(request)
+            waiting = Till(seconds=wait)
+            (waiting | till if till is not None else waiting).wait()
+        return None
+
+    def _choose(self, now):
+        """
+        ASSUME LOCKED
+        :return: (lane, None) FOR THE LANE TO SERVE NEXT, OR (None, seconds) TO WAIT FOR
+                 A LANE'S OWN BUDGET, OR (None, None) IF NOTHING IS WAITING
+        """
+        best = None
+        wait = None
+        for lane in self.lanes:
+            if not lane.queue:
+                continue
+            if lane.bucket:
+                lane_wait = lane.bucket.wait_time(now)
+                if lane_wait > 0:
+                    wait = lane_wait if wait is None else min(wait, lane_wait)
+                    continue
+            if best is None or lane.vtime < best.vtime:
+                best = lane
+        if best is not None:
+            return best, None
+        return None, wait
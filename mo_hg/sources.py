@@ -0,0 +1,204 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import zlib
+
+from mo_dots import listwrap
+from mo_files import File
+from mo_kwargs import override
+from mo_logs import Log
+from mo_logs.strings import expand_template
+from mo_math.randoms import Random
+from mo_threads import Lock
+from pyLibrary.env import http
+from pyLibrary.sql.sqlite import Sqlite, quote_value, quote_list
+
+DEBUG = False
+FILE_URL = "{{location}}/raw-file/{{rev}}{{path}}"
+MAX_REUSE_WALK = 20  # NUMBER OF UNCHANGED PARENTS TO LOOK THROUGH FOR A KNOWN VERSION OF THE FILE
+MEMORY_CACHE_SIZE = 200  # NUMBER OF (branch, rev, path) -> hash ENTRIES KEPT IN MEMORY
+
+
+class SourceStore(object):
+    """
+    CONTENT-ADDRESSED STORE FOR FILES-AT-REVISION
+    (branch, rev, path) -> sha1 OF CONTENT -> COMPRESSED BLOB ON DISK
+    A FILE THAT IS NOT IN A CHANGESET'S files LIST IS THE SAME AS IN ITS PARENT,
+    SO WE LOOK AT RECENT PARENTS BEFORE GOING TO hg
+    """
+
+    @override
+    def __init__(self, directory, hg=None, kwargs=None):
+        """
+        :param directory: WHERE TO KEEP THE BLOBS AND THE INDEX
+        :param hg: HgMozillaOrg, FOR LOOKING UP PARENTS AND CHANGED FILES
+        """
+        self.directory = File(directory)
+        self.hg = hg
+        self.locker = Lock("source store")
+        self.recent = {}  # SMALL MAP FROM (branch, rev12, path) TO hash
+        if not self.directory.exists:
+            self.directory.create()
+        self.db = Sqlite(filename=(self.directory / "sources.sqlite").abspath)
+        if not self.db.query("SELECT name FROM sqlite_master WHERE type='table'").data:
+            with self.db.transaction() as t:
+                t.execute(
+                    "CREATE TABLE files ("
+                    "   branch TEXT, "
+                    "   rev TEXT, "
+                    "   path TEXT, "
+                    "   hash TEXT, "
+                    "   PRIMARY KEY (branch, rev, path)"
+                    ")"
+                )
+
+    def get_source(self, revision, path):
+        """
+        :param revision: REVISION WITH branch AND changeset.id
+        :param path: FILE PATH, STARTING WITH "/"
+        :return: FILE CONTENT, AS BYTES; ERROR IF hg DOES NOT HAVE IT (NOTHING IS STORED)
+        """
+        branch = revision.branch
+        rev = revision.changeset.id
+        hash = self._get_hash(branch.name, rev, path)
+        if hash:
+            content = self._read_blob(hash)
+            if content is not None:
+                return content
+
+        # LOOK FOR THE SAME FILE IN RECENT PARENTS
+        unchanged = [rev]
+        hash = self._find_in_parents(revision, path, unchanged)
+        if hash:
+            content = self._read_blob(hash)
+            if content is not None:
+                self._set_hashes(branch.name, unchanged, path, hash)
+                return content
+
+        url = expand_template(FILE_URL, {"location": branch.url, "rev": rev, "path": path})
+        DEBUG and Log.note("get source from {{url}}", url=url)
+        response = http.get(url)
+        if response.status_code != 200:
+            Log.error("Can not get {{path}} from {{url}}, status {{status}}", path=path, url=url, status=response.status_code)
+        content = response.content
+        hash = self._write_blob(content)
+        self._set_hashes(branch.name, unchanged, path, hash)
+        return content
+
+    def get_text(self, revision, path):
+        return self.get_source(revision, path).decode("utf8", "replace")
+
+    def get_lines(self, revision, path, start=1, end=None):
+        """
+        :param start: FIRST LINE (1-BASED, INCLUSIVE)
+        :param end: LAST LINE (INCLUSIVE), None FOR END OF FILE
+        :return: LIST OF LINES; ONLY THESE LINES ARE DECODED
+        """
+        lines = self.get_source(revision, path).split(b"\n")
+        return [l.decode("utf8", "replace") for l in lines[max(0, start - 1):end]]
+
+    def _find_in_parents(self, revision, path, unchanged):
+        """
+        WALK BACK THROUGH SINGLE-PARENT CHANGESETS THAT DID NOT TOUCH path
+        ONLY WHAT IS ALREADY KNOWN IS USED: THE PARENTS COME FROM THE COMMIT GRAPH,
+        AND THE files OF THE CHANGESETS WALKED COME FROM ONE ES QUERY; hg IS NOT ASKED
+        :param unchanged: LIST OF REVISIONS WITH THE SAME CONTENT; APPENDED TO
+        :return: hash, IF FOUND
+        """
+        if not self.hg:
+            return None
+        branch = revision.branch
+        graph = self.hg.get_graph(branch)
+
+        # FIND THE NEAREST PARENT WITH A KNOWN VERSION OF path
+        chain = []
+        parents = listwrap(revision.parents) or graph.parents(revision.changeset.id)
+        for _ in range(MAX_REUSE_WALK):
+            if not parents or len(parents) != 1:
+                return None  # NOT KNOWN, ROOT, OR MERGE
+            parent = parents[0]
+            hash = self._get_hash(branch.name, parent, path)
+            if hash:
+                break
+            chain.append(parent)
+            parents = graph.parents(parent)
+        else:
+            return None
+
+        # NONE OF THE CHANGESETS SINCE THAT PARENT MAY HAVE TOUCHED path
+        files = {}
+        if revision.changeset.files:
+            files[revision.changeset.id[:12]] = listwrap(revision.changeset.files)
+        files.update(self.hg.get_known_files(branch, [c for c in [revision.changeset.id] + chain if c[:12] not in files]))
+        relative_path = path.lstrip("/")
+        for c in [revision.changeset.id] + chain:
+            changed = files.get(c[:12])
+            if changed is None or relative_path in changed:
+                return None
+        unchanged.extend(chain)
+        return hash
+
+    def _get_hash(self, branch_name, rev, path):
+        key = (branch_name, rev[:12], path)
+        with self.locker:
+            hash = self.recent.get(key)
+        if hash:
+            return hash
+        result = self.db.query(
+            "SELECT hash FROM files WHERE branch=" + quote_value(branch_name) +
+            " AND rev=" + quote_value(rev[:12]) +
+            " AND path=" + quote_value(path)
+        ).data
+        if not result:
+            return None
+        hash = result[0][0]
+        self._remember(key, hash)
+        return hash
+
+    def _set_hashes(self, branch_name, revs, path, hash):
+        with self.db.transaction() as t:
+            for rev in revs:
+                t.execute(
+                    "INSERT OR REPLACE INTO files (branch, rev, path, hash) VALUES " +
+                    quote_list((branch_name, rev[:12], path, hash))
+                )
+        for rev in revs:
+            self._remember((branch_name, rev[:12], path), hash)
+
+    def _remember(self, key, hash):
+        with self.locker:
+            if len(self.recent) >= MEMORY_CACHE_SIZE:
+                self.recent.clear()
+            self.recent[key] = hash
+
+    def _blob_file(self, hash):
+        return self.directory / "blobs" / hash[:2] / (hash + ".z")
+
+    def _read_blob(self, hash):
+        file = self._blob_file(hash)
+        try:
+            return zlib.decompress(file.read_bytes())
+        except Exception as e:
+            DEBUG and Log.note("blob {{hash}} is missing", hash=hash, cause=e)
+            return None
+
+    def _write_blob(self, content):
+        hash = hashlib.sha1(content).hexdigest()
+        file = self._blob_file(hash)
+        if not file.exists:
+            # WRITE TO TEMP FILE, THEN RENAME, SO READERS NEVER SEE A PARTIAL BLOB
+            temp = File(file.abspath + "." + Random.hex(8) + ".tmp")
+            temp.write_bytes(zlib.compress(content))
+            os.rename(temp.abspath, file.abspath)
+        return hash
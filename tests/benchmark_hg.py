@@ -0,0 +1,144 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+END-TO-END BENCHMARK OF HgMozillaOrg, WITHOUT THE NETWORK
+
+    python tests/benchmark_hg.py --settings=tests/benchmark_hg.json --record   # ONCE, WITH hg (AND ES)
+    python tests/benchmark_hg.py --settings=tests/benchmark_hg.json            # OFFLINE, FROM THE FIXTURES
+
+FOR EACH OF get_revision, _get_push AND _find_revision, REPORT THE CALLS PER SECOND
+    cold - NEW HgMozillaOrg, EMPTY ES; EVERYTHING COMES FROM (RECORDED) hg
+    es   - NEW HgMozillaOrg, ES HOLDS THE REVISIONS (AND ANY RECORDED DOCUMENTS)
+    memo - SAME HgMozillaOrg AGAIN; THE MEMOIZED RESULTS
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from time import time
+
+from mo_dots import wrap, Data, set_default
+from mo_json import value2json
+from mo_logs import Log, constants, startup
+from mo_files import File
+
+from mo_hg import hg_mozilla_org
+from mo_hg.hg_mozilla_org import HgMozillaOrg, DEFAULT_LOCALE
+from mo_hg.repos.revisions import Revision
+from tests.fixtures import Fixtures, FakeES, RecordingIndex
+
+hg_mozilla_org.DAEMON_HG_INTERVAL = 0
+
+
+def new_hg(settings, es):
+    """
+    :return: HgMozillaOrg THAT USES es, WITH NO DAEMON
+    """
+    kwargs = set_default({"lazy": True}, settings)
+    kwargs.branches = None  # NO DAEMON; THE BRANCHES COME FROM THE FIXTURES
+    kwargs.branch_snapshot = None
+    hg = HgMozillaOrg(kwargs)
+    hg._es = es
+    return hg
+
+
+def branch(hg, name):
+    return hg.branches[(name, DEFAULT_LOCALE)]
+
+
+def benchmark(name, calls):
+    """
+    :param calls: LIST OF ZERO-ARGUMENT FUNCTIONS
+    :return: Data WITH THE THROUGHPUT
+    """
+    errors = 0
+    start = time()
+    for c in calls:
+        try:
+            c()
+        except Exception as e:
+            errors += 1
+            Log.warning("{{name}} failed", name=name, cause=e)
+    duration = time() - start
+    return Data(
+        calls=len(calls),
+        errors=errors,
+        seconds=duration,
+        per_second=len(calls) / duration if duration else None
+    )
+
+
+def workloads(hg, settings):
+    """
+    :return: MAP FROM NAME TO LIST OF ZERO-ARGUMENT FUNCTIONS
+    """
+    revisions = [(branch(hg, r.branch), r.changeset) for r in settings.revisions]
+    return {
+        "get_revision": [
+            (lambda b=b, c=c: hg.get_revision(Revision(branch=b, changeset={"id": c})))
+            for b, c in revisions
+        ],
+        "_get_push": [
+            (lambda b=b, c=c: hg._get_push(b, c))
+            for b, c in revisions
+        ],
+        "_find_revision": [
+            (lambda c=c: hg._find_revision(c))
+            for c in settings.find
+        ]
+    }
+
+
+def main():
+    try:
+        settings = startup.read_settings(defs=[{
+            "name": ["--record"],
+            "help": "record hg (and ES) to the fixtures directory, rather than replay",
+            "action": "store_true",
+            "dest": "record"
+        }])
+        constants.set(settings.constants)
+        Log.start(settings.debug)
+        record = settings.args.record
+
+        with Fixtures(settings.fixtures, record=record, settings=settings) as fixtures:
+            # AN ES WITH THE REVISIONS, FOR THE es STAGE (WHEN RECORDING, THIS GETS EVERYTHING FROM hg)
+            filled = FakeES()
+            hg = new_hg(settings, filled)
+            for c in workloads(hg, settings)["get_revision"]:
+                c()
+            if record and settings.repo:
+                # ALSO RECORD WHAT THE LIVE ES HAS
+                live = new_hg(settings, None)
+                live._es = RecordingIndex(live._connect_es(), settings.fixtures)
+                for c in workloads(live, settings)["get_revision"]:
+                    c()
+            filled.load(settings.fixtures)
+
+            report = {}
+            for name in ["get_revision", "_get_push", "_find_revision"]:
+                result = report[name] = {}
+                hg = new_hg(settings, FakeES())
+                result["cold"] = benchmark(name, workloads(hg, settings)[name])
+                hg = new_hg(settings, filled)
+                result["es"] = benchmark(name, workloads(hg, settings)[name])
+                result["memo"] = benchmark(name, workloads(hg, settings)[name])
+
+            report = wrap({"benchmark": report, "fixtures": fixtures.counts, "es": filled.counts})
+            Log.note("hg benchmark:\n{{report|json|indent}}", report=report)
+            if settings.output:
+                File(settings.output).write(value2json(report, pretty=True))
+    except Exception as e:
+        Log.error("Problem with hg benchmark", e)
+    finally:
+        Log.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+RECORD hg RESPONSES AND ES DOCUMENTS TO A DIRECTORY, AND REPLAY THEM, SO
+HgMozillaOrg CAN RUN WITHOUT THE NETWORK
+
+    directory/http/<sha1 OF method AND url>.json   ONE RESPONSE EACH
+    directory/es/<sha1 OF _id>.json                ONE DOCUMENT EACH, AS SEEN IN A SEARCH
+    directory/branches.json                        THE BRANCHES
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from mo_collections import UniqueIndex
+from mo_dots import wrap, Data, listwrap, unwrap
+from mo_files import File
+from mo_json import value2json, json2value
+from mo_logs import Log
+from mo_threads import Lock
+from pyLibrary.env import http
+
+from mo_hg import hg_branches
+
+DEFAULT_SIZE = 10  # ES RETURNS THIS MANY HITS WHEN THE QUERY HAS NO size
+
+
+class Fixtures(object):
+    """
+    WHILE ENTERED, pyLibrary.env.http AND hg_branches.get_branches ARE
+    RECORDED TO (record=True), OR REPLAYED FROM, directory
+    A REQUEST NOT RECORDED IS AN ERROR WHEN REPLAYING
+    """
+
+    def __init__(self, directory, record=False, settings=None):
+        """
+        :param directory: WHERE THE FIXTURES ARE KEPT
+        :param record: True TO CALL hg (AND ES), AND KEEP WHAT COMES BACK
+        :param settings: HgMozillaOrg SETTINGS FOR RECORDING THE BRANCHES (NEEDS branches)
+        """
+        self.directory = File(directory)
+        self.record = record
+        self.settings = settings
+        self.counts = Data(requests=0, recorded=0, replayed=0)
+        self.original = None
+
+    def __enter__(self):
+        self.original = (http.request, hg_branches.get_branches)
+        http.request = self._request
+        hg_branches.get_branches = self._get_branches
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        http.request, hg_branches.get_branches = self.original
+
+    def _request(self, method, url, headers=None, **kwargs):
+        self.counts.requests += 1
+        url = str(url)
+        file = self.directory / "http" / (_hash(method.lower() + " " + url) + ".json")
+        if self.record:
+            response = self.original[0](method, url, headers=headers, **kwargs)
+            content = response.content
+            file.write(value2json({
+                "method": method.lower(),
+                "url": url,
+                "status_code": response.status_code,
+                "headers": dict(response.headers),
+                "content": content.decode("latin1")
+            }, pretty=True))
+            self.counts.recorded += 1
+            return response
+
+        if not file.exists:
+            Log.error("No recorded response for {{method|upper}} {{url}}", method=method, url=url)
+        recorded = json.loads(file.read())
+        self.counts.replayed += 1
+        response = Response()
+        response.status_code = recorded["status_code"]
+        response.headers = CaseInsensitiveDict(recorded["headers"])
+        response.headers.pop("Content-Encoding", None)  # content IS RECORDED DECODED
+        response.url = url
+        response._content = recorded["content"].encode("latin1")
+        return response
+
+    def _get_branches(self, *args, **kwargs):
+        file = self.directory / "branches.json"
+        if self.record and not self.counts.branches:
+            # ONCE; EACH HgMozillaOrg WILL ASK
+            self.counts.branches = 1
+            branches = self.original[1](kwargs=self.settings)
+            file.write(value2json(list(branches), pretty=True))
+        if not file.exists:
+            Log.error("No recorded branches in {{file}}", file=file.abspath)
+        return UniqueIndex(["name", "locale"], data=json2value(file.read()), fail_on_dup=False)
+
+
+class RecordingIndex(object):
+    """
+    WRAP A REAL ES INDEX; THE DOCUMENTS SEEN IN EACH search() ARE RECORDED TO directory
+    """
+
+    def __init__(self, index, directory):
+        self.index = index
+        self.directory = File(directory) / "es"
+        self.cluster = index.cluster
+        self.settings = index.settings
+
+    def search(self, query):
+        response = self.index.search(query)
+        for hit in response.hits.hits:
+            (self.directory / (_hash(hit._id) + ".json")).write(value2json({"_id": hit._id, "_source": hit._source}, pretty=True))
+        return response
+
+    def add(self, record):
+        return self.index.add(record)
+
+    def refresh(self):
+        return self.index.refresh()
+
+
+class FakeES(object):
+    """
+    IN-PROCESS STAND-IN FOR THE ES INDEX HgMozillaOrg USES: search() AND add()
+    search() UNDERSTANDS THE QUERIES HgMozillaOrg SENDS (term, prefix, range,
+    exists, missing, match_all, UNDER bool, filtered, OR and)
+    """
+
+    def __init__(self, directory=None, version="6.2.2"):
+        """
+        :param directory: RECORDED DOCUMENTS TO START WITH (SEE RecordingIndex)
+        :param version: THE ES VERSION TO PRETEND TO BE (HgMozillaOrg SENDS 1.7 QUERIES TO 1.7.x)
+        """
+        self.cluster = Data(version=version)
+        self.settings = Data(index="repo", type="revision")
+        self.locker = Lock("fake es")
+        self.docs = {}  # MAP FROM _id TO _source
+        self.counts = Data(searches=0, adds=0)
+        if directory:
+            self.load(directory)
+
+    def load(self, directory):
+        """
+        ADD THE DOCUMENTS RECORDED IN directory
+        """
+        folder = File(directory) / "es"
+        if not folder.exists:
+            return
+        for file in folder.children:
+            if file.extension == "json":
+                doc = json.loads(file.read())
+                with self.locker:
+                    self.docs[doc["_id"]] = wrap(doc["_source"])
+
+    def search(self, query):
+        query = wrap(query)
+        self.counts.searches += 1
+        with self.locker:
+            docs = list(self.docs.items())
+        hits = [
+            {"_id": _id, "_source": source}
+            for _id, source in sorted(docs, key=lambda d: d[0])
+            if _matches(query.query, source)
+        ]
+        size = DEFAULT_SIZE if query.size == None else query.size
+        return wrap({"hits": {"total": len(hits), "hits": hits[:size]}})
+
+    def add(self, record):
+        # SAME SERIALIZATION AS SENDING TO ES
+        source = json2value(value2json(record["value"]))
+        self.counts.adds += 1
+        with self.locker:
+            self.docs[record["id"]] = source
+
+    def refresh(self):
+        pass
+
+
+def _matches(query, doc):
+    if query == None:
+        return True
+    for op, term in query.items():
+        if op == "match_all":
+            continue
+        elif op == "bool":
+            if not all(_matches(q, doc) for q in listwrap(term.must) + listwrap(term.filter)):
+                return False
+            if any(_matches(q, doc) for q in listwrap(term.must_not)):
+                return False
+            if term.should and not any(_matches(q, doc) for q in listwrap(term.should)):
+                return False
+        elif op == "filtered":
+            if not (_matches(term.query, doc) and _matches(term.filter, doc)):
+                return False
+        elif op == "and":
+            if not all(_matches(q, doc) for q in listwrap(term)):
+                return False
+        elif op == "or":
+            if not any(_matches(q, doc) for q in listwrap(term)):
+                return False
+        elif op == "not":
+            if _matches(term, doc):
+                return False
+        elif op == "term":
+            if not all(v in _values(doc, f) for f, v in term.items()):
+                return False
+        elif op == "terms":
+            if not all(set(_values(doc, f)) & set(listwrap(v)) for f, v in term.items()):
+                return False
+        elif op == "prefix":
+            if not all(any(isinstance(d, type(v)) and d.startswith(v) for d in _values(doc, f)) for f, v in term.items()):
+                return False
+        elif op == "range":
+            for f, r in term.items():
+                if not any(_in_range(d, r) for d in _values(doc, f)):
+                    return False
+        elif op == "exists":
+            if not _values(doc, term.field):
+                return False
+        elif op == "missing":
+            if _values(doc, term.field):
+                return False
+        else:
+            Log.error("FakeES does not know {{op}}", op=op)
+    return True
+
+
+def _values(doc, field):
+    return [v for v in listwrap(unwrap(doc[field])) if v is not None]
+
+
+def _in_range(value, range):
+    for op, limit in range.items():
+        if op == "gt" and not value > limit:
+            return False
+        if op == "gte" and not value >= limit:
+            return False
+        if op == "lt" and not value < limit:
+            return False
+        if op == "lte" and not value <= limit:
+            return False
+    return True
+
+
+def _hash(text):
+    return hashlib.sha1(text.encode("utf8")).hexdigest()
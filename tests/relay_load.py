@@ -0,0 +1,358 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Author: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+OFFLINE LOAD TEST OF THE RELAY (PYTHON 3 ONLY)
+
+    python tests/relay_load.py --settings=tests/relay_load.json
+
+STARTS A STUB hg (WITH latency, body_size AND error_rate), A RELAY IN FRONT OF
+IT (flask OR asyncio), AND MANY CLIENTS THAT REPLAY A REQUEST MIX (SYNTHETIC,
+OR ONE PATH PER LINE FROM A FILE). EVERYTHING RUNS ON 127.0.0.1; NO NETWORK.
+REPORTS THE THROUGHPUT, CLIENT LATENCY, UPSTREAM REQUESTS SAVED, AND TIME
+WAITING FOR THE SQLITE WRITE LOCK, FOR EACH round (THE FIRST IS COLD)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import http.client
+import random
+import socket
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+
+from mo_dots import wrap, Data, set_default
+from mo_files import File
+from mo_json import value2json
+from mo_kwargs import override
+from mo_logs import Log, constants, startup
+from mo_logs.strings import expand_template
+from mo_threads import Thread, Lock
+
+from mo_hg.metrics import Histogram, NUM_BUCKETS
+
+BRANCH = "mozilla-central"
+SYNTHETIC_MIX = [
+    ("{{branch}}/json-rev/{{node}}", 5),
+    ("{{branch}}/raw-rev/{{node}}", 2),
+    ("{{branch}}/json-pushes?full=1&changeset={{node}}", 2),
+    ("{{branch}}/json-info/{{node}}", 1)
+]  # (PATH TEMPLATE, WEIGHT)
+TIMEOUT = 60  # SECONDS A CLIENT WAITS FOR A RESPONSE
+
+
+class StubHg(object):
+    """
+    PRETEND TO BE hg.mozilla.org: EVERY PATH IS FOUND, AFTER latency SECONDS
+    """
+
+    @override
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, jitter=0.02, body_size=20000, error_rate=0, seed=0, kwargs=None):
+        """
+        :param latency: MEAN SECONDS BEFORE RESPONDING
+        :param jitter: LATENCY IS UNIFORM IN latency +/- jitter
+        :param body_size: BYTES OF (UNCOMPRESSED) BODY
+        :param error_rate: FRACTION OF REQUESTS ANSWERED WITH 500
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.body_size = body_size
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.locker = Lock("stub hg")
+        self.counts = Data(requests=0, not_modified=0, errors=0)
+        self.paths = set()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://" + host + ":" + str(self.server.server_port) + "/"
+        self.thread = Thread.run("stub hg", self._serve)
+
+    def _serve(self, please_stop):
+        please_stop.on_go(self.server.shutdown)
+        self.server.serve_forever()
+
+    def _handle(self, handler):
+        path = handler.path.lstrip("/")
+        with self.locker:
+            self.counts.requests += 1
+            self.paths.add(path)
+            delay = max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            fail = self.random.random() < self.error_rate
+        sleep(delay)
+
+        if fail:
+            with self.locker:
+                self.counts.errors += 1
+            _respond(handler, 500, {"Content-Type": "text/plain"}, b"stub error")
+            return
+
+        etag = '"' + hashlib.sha1(path.encode("utf8")).hexdigest()[:16] + '"'
+        if handler.headers.get("If-None-Match") == etag:
+            with self.locker:
+                self.counts.not_modified += 1
+            _respond(handler, 304, {"ETag": etag}, b"")
+            return
+
+        body = self.body(path)
+        headers = {"Content-Type": "application/json", "ETag": etag}
+        if "gzip" in (handler.headers.get("Accept-Encoding") or ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        _respond(handler, 200, headers, body)
+
+    def body(self, path):
+        """
+        JSON THAT MENTIONS THE NODE IN THE path, PADDED TO body_size WITH HEX (SO IT COMPRESSES LIKE A DIFF)
+        """
+        seed = hashlib.sha1(path.encode("utf8")).hexdigest()
+        node = ([s for s in path.replace("=", "/").replace("&", "/").split("/") if len(s) == 40] + [seed])[0]
+        pad = (seed * (self.body_size // 40 + 1))[:self.body_size]
+        return value2json({"node": node, "path": path, "pad": pad}).encode("utf8")
+
+    def stop(self):
+        self.thread.stop()
+        self.server.server_close()
+
+
+def _respond(handler, status, headers, body):
+    handler.send_response(status)
+    for k, v in headers.items():
+        handler.send_header(k, v)
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    if body:
+        handler.wfile.write(body)
+
+
+def synthetic_mix(requests, distinct, skew=1.0, seed=0):
+    """
+    :param requests: LENGTH OF THE MIX
+    :param distinct: NUMBER OF CHANGESETS ASKED ABOUT
+    :param skew: ZIPF EXPONENT; THE i-th CHANGESET IS ASKED ABOUT (1/i)^skew AS OFTEN AS THE FIRST
+    :return: LIST OF PATHS
+    """
+    rand = random.Random(seed)
+    nodes = [hashlib.sha1(("node" + str(i)).encode("utf8")).hexdigest() for i in range(distinct)]
+    node_weights = [1 / ((i + 1) ** skew) for i in range(distinct)]
+    templates, template_weights = zip(*SYNTHETIC_MIX)
+    return [
+        expand_template(t, {"branch": BRANCH, "node": n})
+        for t, n in zip(
+            rand.choices(templates, template_weights, k=requests),
+            rand.choices(nodes, node_weights, k=requests)
+        )
+    ]
+
+
+def recorded_mix(filename):
+    """
+    :param filename: FILE WITH ONE PATH (OR hg URL) PER LINE
+    """
+    output = []
+    for line in File(filename).read_lines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if "://" in line:
+            line = line.split("://", 1)[1].partition("/")[2]
+        output.append(line.lstrip("/"))
+    return output
+
+
+def start_relay(server, cache_settings):
+    """
+    :param server: "flask" OR "asyncio"
+    :return: (Cache, host, port) OF THE RUNNING RELAY
+    """
+    port = _free_port()
+    if server == "asyncio":
+        from mo_hg.cache import Cache
+        from mo_hg.relay_async import AsyncRelay
+
+        cache = Cache(cache_settings)
+        relay = AsyncRelay(cache, host="127.0.0.1", port=port)
+
+        def serve(please_stop):
+            please_stop.on_go(lambda: relay.loop.call_soon_threadsafe(relay.loop.stop))
+            relay.run()
+    else:
+        from werkzeug.serving import make_server
+        from mo_hg import relay_app
+
+        relay_app.config = wrap({"cache": cache_settings})
+        app = relay_app.RelayApp(relay_app.__name__)
+        relay_app.add(app)
+        cache = relay_app.cache
+        http_server = make_server("127.0.0.1", port, app, threaded=True)
+
+        def serve(please_stop):
+            please_stop.on_go(http_server.shutdown)
+            http_server.serve_forever()
+
+    Thread.run("relay " + server, serve)
+    _wait_for_port(port)
+    return cache, "127.0.0.1", port
+
+
+def run_round(host, port, paths, clients):
+    """
+    SEND paths FROM clients THREADS, EACH WITH ITS OWN KEEP-ALIVE CONNECTION
+    :return: Data WITH THE COUNTS AND LATENCY
+    """
+    locker = Lock("next path")
+    remaining = list(reversed(paths))
+    results = []
+
+    def client(please_stop):
+        latency = Histogram()
+        result = Data(requests=0, errors=0, upstream_errors=0, bytes=0, latency=latency)
+        conn = http.client.HTTPConnection(host, port, timeout=TIMEOUT)
+        try:
+            while not please_stop:
+                with locker:
+                    if not remaining:
+                        break
+                    path = remaining.pop()
+                start = time()
+                try:
+                    conn.request("GET", "/" + path, headers={"Accept-Encoding": "gzip"})
+                    response = conn.getresponse()
+                    data = response.read()
+                    if response.status >= 500:
+                        result.upstream_errors += 1  # PASSED ALONG FROM THE STUB; COMPARE WITH stub.errors
+                    elif response.status != 200:
+                        result.errors += 1
+                    result.bytes += len(data)
+                except Exception as e:
+                    Log.note("client problem with {{path}}", path=path, cause=e)
+                    result.errors += 1
+                    conn.close()
+                latency.add(time() - start)
+                result.requests += 1
+        finally:
+            conn.close()
+            with locker:
+                results.append(result)
+
+    start = time()
+    threads = [Thread.run("load client " + str(i), client) for i in range(clients)]
+    for t in threads:
+        t.join()
+    duration = time() - start
+
+    latency = Histogram()
+    for r in results:
+        _merge(latency, r.latency)
+    requests = sum(r.requests for r in results)
+    return wrap({
+        "requests": requests,
+        "errors": sum(r.errors for r in results),
+        "upstream_errors": sum(r.upstream_errors for r in results),
+        "bytes": sum(r.bytes for r in results),
+        "seconds": duration,
+        "throughput": requests / duration if duration else None,
+        "latency": latency.snapshot()
+    })
+
+
+def _merge(total, histogram):
+    for i in range(NUM_BUCKETS):
+        total.counts[i] += histogram.counts[i]
+    total.total += histogram.total
+    total.max = max(total.max, histogram.max)
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _wait_for_port(port, timeout=30):
+    end = time() + timeout
+    while time() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except Exception:
+            sleep(0.1)
+    Log.error("Relay did not start on port {{port}}", port=port)
+
+
+def main():
+    stub = None
+    try:
+        settings = startup.read_settings()
+        constants.set(settings.constants)
+        Log.start(settings.debug)
+
+        load = settings.load
+        if load.mix:
+            paths = recorded_mix(load.mix)
+        else:
+            paths = synthetic_mix(load.requests or 10000, load.distinct or 500, load.skew or 1.0, load.seed or 0)
+
+        stub = StubHg(kwargs=settings.stub)
+        directory = File(settings.directory or tempfile.mkdtemp(prefix="relay_load_"))
+        cache_settings = set_default({}, settings.cache, {
+            "source": {"url": stub.url},
+            "database": {"filename": (directory / "relay.db").abspath},
+            "files": (directory / "files").abspath
+        })
+        cache, host, port = start_relay(settings.server or "asyncio", cache_settings)
+
+        rounds = []
+        for r in range(load.rounds or 2):
+            before = stub.counts.requests
+            mix = list(paths)
+            random.Random(r).shuffle(mix)
+            result = run_round(host, port, mix, load.clients or 100)
+            result.upstream = stub.counts.requests - before
+            result.saved = result.requests - result.upstream
+            Log.note("round {{round}}: {{result|json}}", round=r, result=result)
+            rounds.append(result)
+
+        report = wrap({
+            "server": settings.server or "asyncio",
+            "clients": load.clients or 100,
+            "distinct_paths": len(set(paths)),
+            "stub": stub.counts,
+            "rounds": rounds,
+            "relay": cache.status()
+        })
+        Log.note("load test report:\n{{report|json|indent}}", report=report)
+        if settings.output:
+            File(settings.output).write(value2json(report, pretty=True))
+    except Exception as e:
+        Log.error("Problem with relay load test", e)
+    finally:
+        if stub is not None:
+            stub.stop()
+        Log.stop()
+
+
+if __name__ == "__main__":
+    main()
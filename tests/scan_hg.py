@@ -9,8 +9,7 @@
 from __future__ import division
 from __future__ import unicode_literals
 
-from mo_collections.queue import Queue
-from mo_dots import listwrap, wrap
+from mo_dots import wrap
 from mo_logs import Log, constants, startup
 from mo_times import Date
 
@@ -35,13 +34,10 @@ def main():
         Log.start(settings.debug)
 
         hg = HgMozillaOrg(settings)
-        todo = Queue()
-        todo.add("97160a734959")
         least = 100000
 
-        while todo:
-            next_ = todo.pop()
-            curr = hg.get_revision(wrap({"changeset": {"id": next_}, "branch": {"name": BRANCH}}))
+        start = wrap({"changeset": {"id": "97160a734959"}, "branch": {"name": BRANCH}})
+        for curr in hg.iter_ancestors(start):
             if len(curr.changeset.files) > MIN_FILES:
                 diff = hg._get_json_diff_from_hg(curr)
                 num_changes = sum(len(d.changes) for d in diff)
@@ -49,7 +45,6 @@ def main():
                 if score < least:
                     least = score
                     Log.note("smallest = {{rev}}, num_lines={{num}}, num_files={{files}}", rev=curr.changeset.id, num=num_changes, files=len(diff))
-            todo.extend(listwrap(curr.parents))
 
     except Exception as e:
         Log.error("Problem with scna", e)
@@ -10,14 +10,41 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import unicode_literals
 
-from mo_dots import Null, wrap, coalesce
+import copy
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zlib
+
+from mo_collections import UniqueIndex
+from mo_dots import Null, wrap, coalesce, Data
 from mo_files import File
-from mo_hg.hg_mozilla_org import HgMozillaOrg
+from mo_hg import cache, cache_db, hg_branches
+from mo_hg.cache import Body, Cache, BodyWriter, InFlight, body_file, _response
+from mo_hg.cache_db import CacheDB
+from mo_hg.cache_keys import CacheKeys
+from mo_hg.cache_warmer import CacheWarmer, WARM_LANE
+from mo_hg.graph import CommitGraph
+from mo_hg.metrics import Histogram
+from mo_hg.hg_mozilla_org import HgMozillaOrg, minimize_repo, minimize_repos, DEFAULT_LOCALE
 from mo_hg.parse import diff_to_json, diff_to_moves
+from mo_hg.prefetch import RevisionWalker
+from mo_hg.rate_logger import Window
+from mo_hg.scheduler import Scheduler, TokenBucket
+from mo_hg.sources import SourceStore
+from mo_hg.relay_pack import export_pack, import_pack
+from mo_hg.repos.changesets import Changeset, pack_changeset, unpack
+from mo_hg.repos.pushs import Push
+from mo_hg.repos.revisions import Revision
+from mo_json import value2json
 from mo_logs import constants, Log, startup
 from mo_testing.fuzzytestcase import FuzzyTestCase
-from mo_threads import Till
+from mo_threads import Signal, Thread, Till
+from mo_times import Date
 from pyLibrary.env import http
+from tests.fixtures import FakeES
 
 
 class TestHg(FuzzyTestCase):
@@ -103,3 +130,773 @@ class TestHg(FuzzyTestCase):
         diff = http.get('https://hg.mozilla.org/mozilla-central/raw-rev/14dc6342ec5').content.decode('utf8')
         moves = diff_to_moves(diff)
         Log.note("{{files}}", files=[m.old.name if m.new.name=='dev/null' else m.new.name for m in moves])
+
+
+class TestOffline(FuzzyTestCase):
+    """
+    TESTS THAT NEED NEITHER hg NOR ES
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        Log.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        Log.stop()
+
+    def test_revision_record(self):
+        rev = Revision(branch={"name": "Mozilla-Central"}, changeset={"id": "de7aa6b08234abcdef"}, parents="abc")
+        same = wrap({"branch": {"name": "mozilla-central"}, "changeset": {"id": "de7aa6b08234"}})
+        self.assertTrue(rev == same)
+        self.assertEqual(hash(rev), hash(Revision(same)))
+        self.assertEqual(rev.push.date, None)
+        self.assertEqual(Revision.from_json(rev.to_json()), rev.__data__())
+
+    def test_record(self):
+        rev = Revision(
+            branch={"name": "mozilla-central"},
+            changeset={"id": "de7aa6b08234abcdef", "files": ["a.py"]},
+            push={"id": 32390, "date": 1500000000},
+            unknown={"a": 1}
+        )
+        self.assertIsInstance(rev.changeset, Changeset)
+        self.assertIsInstance(rev.push, Push)
+        self.assertEqual(rev.unknown.a, 1)  # UNKNOWN PROPERTIES ARE KEPT, IN _extra
+        self.assertEqual(rev["changeset.files"], ["a.py"])
+        self.assertEqual(rev.missing, None)
+
+        rev.unknown = None
+        rev.phase = None
+        self.assertEqual(set(rev.keys()), {"branch", "changeset", "push"})
+
+        other = copy.copy(rev)
+        other.phase = "public"
+        other.extra = "x"
+        self.assertEqual(rev.phase, None)
+        self.assertEqual(rev.extra, None)
+        self.assertEqual(Revision.from_json(rev.to_json()).__data__(), rev.__data__())
+
+        # A Revision WITH A PACKED changeset SURVIVES THE ROUND TRIP
+        diff = [{"new": {"name": "a.py"}, "changes": [{"new": {"line": 1, "content": "x"}}]}]
+        rev.changeset = pack_changeset(Changeset(rev.changeset, diff=diff, moves=[]))
+        again = Revision.from_json(rev.to_json())
+        self.assertEqual(again.changeset.diff, diff)
+        self.assertEqual(again, rev)
+        self.assertEqual(again.__data__(), rev.__data__())
+
+    def test_pack_changeset(self):
+        diff = [{"new": {"name": "a.py"}, "changes": [{"new": {"line": 1, "content": "x"}}]}]
+        moves = [{"new": {"name": "a.py"}, "changes": [{"new": 1}]}]
+        changeset = Changeset(id="de7aa6b08234abcdef", diff=diff, moves=moves)
+        packed = pack_changeset(changeset)
+        self.assertEqual(set(packed.keys()), {"id", "packed"})
+        self.assertEqual(unpack(packed["packed"]), {"diff": diff, "moves": moves})
+
+        # ITERATING, OR SERIALIZING, UNPACKS
+        self.assertEqual(Changeset(packed).__data__(), changeset.__data__())
+        self.assertNotIn("packed", Changeset(packed).to_json())
+        self.assertEqual(Changeset(packed).diff, diff)
+        minimal = minimize_repo(Revision(changeset=Changeset(packed)))
+        self.assertEqual(minimal, {"changeset": {"id": "de7aa6b08234abcdef"}})
+        self.assertEqual(minimal.changeset.keys(), {"id"})
+
+    def test_minimize_repo(self):
+        rev = wrap({
+            "branch": {"name": "mozilla-central", "etl": {"timestamp": 1}},
+            "changeset": {"id": "de7aa6b08234", "files": ["a.py"], "description": "x" * 2000},
+            "parents": "abc",
+            "push": {"id": 32390}
+        })
+        expected = {"branch": {"name": "mozilla-central"}, "changeset": {"id": "de7aa6b08234"}, "push": {"id": 32390}}
+        minimal = minimize_repo(rev)
+        self.assertEqual(minimal, expected)
+        self.assertEqual(minimal.parents, None)
+        self.assertEqual(minimal.changeset.files, None)
+        self.assertEqual(len(minimal.changeset.description), 1000)
+        self.assertEqual(list(minimize_repos([rev, None])), [expected, None])
+
+    def test_commit_graph(self):
+        def id(i):
+            return ("%02d" % i) * 20
+
+        graph = CommitGraph("test")
+        graph.add(id(5), [id(3), id(4)])  # CHILDREN BEFORE PARENTS
+        graph.add(id(3), [id(2)])
+        graph.add(id(4), [id(2)])
+        self.assertEqual(graph.is_ancestor(id(1), id(5)), None)  # NOT KNOWN YET
+        graph.add(id(2), [id(1)])
+        graph.add(id(1), [])
+        graph.add(id(6), [id(1)])
+
+        self.assertEqual(graph.is_ancestor(id(1), id(5)), True)
+        self.assertEqual(graph.is_ancestor(id(6), id(5)), False)
+        self.assertEqual(graph.between(id(3), id(5)), [id(3), id(5)])
+        self.assertEqual(graph.between(id(6), id(5)), [])
+
+        filename = "tests/results/test.graph"
+        graph.save(filename)
+        loaded = CommitGraph.load(filename)
+        self.assertEqual(loaded.between(id(2), id(5)), graph.between(id(2), id(5)))
+        File(filename).delete()
+
+    def test_commit_graph_gaps(self):
+        def id(name):
+            return name * 40
+
+        graph = CommitGraph("test")
+        graph.add(id("a"), [id("x")])  # x IS NOT KNOWN
+        graph.add(id("d"), [id("c")])
+        graph.add(id("c"), [id("b")])  # b IS NOT KNOWN
+        self.assertEqual(graph.is_ancestor(id("a"), id("d")), None)
+        self.assertEqual(graph.between(id("a"), id("d")), None)
+
+        graph.add(id("b"), [id("a")])
+        self.assertEqual(graph.is_ancestor(id("a"), id("d")), True)
+        self.assertEqual(graph.between(id("a"), id("d")), [id("a"), id("b"), id("c"), id("d")])
+        graph.add(id("e"), [id("d"), id("y")])  # y IS NOT KNOWN, AND MAY DESCEND FROM a
+        self.assertEqual(graph.between(id("a"), id("e")), None)
+        self.assertEqual(graph.is_ancestor(id("d"), id("a")), None)  # x IS NOT KNOWN
+        graph.add(id("x"), [])
+        self.assertEqual(graph.is_ancestor(id("d"), id("a")), False)
+
+    def test_cache_keys(self):
+        keys = CacheKeys()
+        node = "14dc6342ec5000000000000000000000000000ab"
+        self.assertEqual(keys.canonical("mozilla-central/json-rev/14dc6342ec50"), "mozilla-central/json-rev/14dc6342ec50")
+        self.assertEqual(keys.canonical("mozilla-central/rev/" + node.upper() + "?style=json"), "mozilla-central/json-rev/" + node)
+        self.assertEqual(keys.canonical("mozilla-central/json-rev/14dc6342ec50"), "mozilla-central/json-rev/14dc6342ec50")  # REQUESTS DO NOT TEACH
+        keys.learn("mozilla-central/json-rev/" + node, [b'{"node": "' + node.encode("ascii") + b'"}'])
+        self.assertEqual(keys.canonical("mozilla-central/json-rev/14dc6342ec50"), "mozilla-central/json-rev/" + node)
+        self.assertEqual(
+            keys.canonical("mozilla-central/json-pushes?version=2&full=1&changeset=14dc6342ec500"),
+            "mozilla-central/json-pushes?changeset=" + node + "&full=1&version=2"
+        )
+
+    def test_rate_window(self):
+        window = Window(size=10)
+        for t in [100.1, 100.5, 101.2, 103.9, 109.0]:
+            window.add(t)
+        self.assertEqual(window.total(109.5), 4)  # THE CURRENT SECOND IS NOT COUNTED
+        self.assertEqual(window.total(109.5, 6), 1)
+        window.add(111.0)  # REUSES THE SLOT OF SECOND 101
+        self.assertEqual(window.total(111.5), 2)  # SECONDS 103 AND 109
+        self.assertEqual(window.total(112.5), 3)
+
+    def test_fake_es(self):
+        es = FakeES()
+        es.add({"id": "de7aa6b08234-mozilla-central-en-US", "value": {
+            "branch": {"name": "mozilla-central", "locale": "en-US"},
+            "changeset": {"id": "de7aa6b08234abcdef", "id12": "de7aa6b08234"},
+            "etl": {"timestamp": 1600000000}
+        }})
+        hit = es.search({"query": {"bool": {"must": [
+            {"term": {"changeset.id12": "de7aa6b08234"}},
+            {"term": {"branch.name": "mozilla-central"}},
+            {"range": {"etl.timestamp": {"gt": 1500000000}}}
+        ]}}, "size": 2000}).hits.hits
+        self.assertEqual(hit, [{"_id": "de7aa6b08234-mozilla-central-en-US"}])
+        miss = es.search({"query": {"filtered": {
+            "query": {"match_all": {}},
+            "filter": {"and": [{"prefix": {"changeset.id": "de7aa6b08234"}}, {"range": {"etl.timestamp": {"gt": 1700000000}}}]}
+        }}, "size": 1}).hits.hits
+        self.assertEqual(len(miss), 0)
+
+    def test_import_pack_keeps_existing(self):
+        temp = tempfile.mkdtemp()
+        files = os.path.join(temp, "files")
+        old_max, cache.MAX_BLOB_SIZE = cache.MAX_BLOB_SIZE, 1  # EVERY BODY GOES TO A FILE
+        source = CacheDB(filename=os.path.join(temp, "source.db"))
+        dest = CacheDB(filename=os.path.join(temp, "dest.db"))
+        try:
+            source.put("a", "{}", b"new a", None, 5, 1)
+            source.put("b", "{}", b"new b", None, 5, 1)
+            export_pack(source, os.path.join(temp, "relay.pack"))
+
+            existing = body_file(files, "a")
+            os.makedirs(os.path.dirname(existing))
+            with open(existing, "wb") as f:
+                f.write(b"old")
+            dest.put("a", "{}", None, existing, 3, 1)
+            self.assertEqual(import_pack(dest, os.path.join(temp, "relay.pack"), files=files), 2)
+
+            with open(existing, "rb") as f:
+                self.assertEqual(f.read(), b"old")
+            self.assertEqual(dest.get("a")[3], 3)
+            headers, content, file, size, expires = dest.get("b")
+            with open(file, "rb") as f:
+                self.assertEqual(f.read(), b"new b")
+            self.assertEqual(dest.total_size, 8)
+        finally:
+            cache.MAX_BLOB_SIZE = old_max
+            source.stop()
+            dest.stop()
+            shutil.rmtree(temp)
+
+    def test_scrape_state(self):
+        url = "https://hg.mozilla.org/releases"
+        beta = wrap({"name": "mozilla-beta", "locale": "en-US", "url": url + "/mozilla-beta", "etl": {"timestamp": 1500000000}})
+        temp = tempfile.mkdtemp()
+        file = File(os.path.join(temp, "branches.json" + hg_branches.SCRAPE_STATE_SUFFIX))
+        old = dict(hg_branches._directories)
+        try:
+            hg_branches._directories.clear()
+            hg_branches._directories[url] = ("etag", "hash", [beta])
+            hg_branches._save_scrape_state(file)
+            self.assertEqual(hg_branches._load_scrape_state(None, [beta]), None)
+
+            # AFTER A RESTART, THE PAGE STATE COMES BACK FROM THE FILE
+            hg_branches._directories.clear()
+            last_scrape = hg_branches._load_scrape_state(file, [beta])
+            self.assertLess(abs((Date.now() - last_scrape).seconds), 60)
+            self.assertEqual(hg_branches._directories[url], ("etag", "hash", [beta]))
+
+            # A BRANCH MISSING FROM ES MEANS THE PAGE IS PARSED AGAIN
+            hg_branches._directories.clear()
+            hg_branches._load_scrape_state(file, [])
+            self.assertEqual(hg_branches._directories, {})
+        finally:
+            hg_branches._directories.clear()
+            hg_branches._directories.update(old)
+            shutil.rmtree(temp)
+
+    def test_iter_diff_empty_changes(self):
+        manifest = wrap([
+            {"new": {"name": "binary.png"}, "changes": []},
+            {"new": {"name": "a.py"}, "changes": [{"new": {"line": 1, "content": "x"}}]}
+        ])
+
+        class Stub(object):
+            def _get_json_diff_from_hg(self, revision):
+                return manifest
+
+            def _store_diff(self, revision):
+                raise Exception("expecting no download")
+
+        files = list(HgMozillaOrg.iter_diff(Stub(), Null))
+        self.assertEqual([len(f.changes) for f in files], [0, 1])
+
+    def test_peer_wait(self):
+        temp = tempfile.mkdtemp()
+        filename = os.path.join(temp, "relay.db")
+        relay = Cache(source={"url": "http://127.0.0.1:1/"}, database={"filename": filename}, shared=True)
+        peer = CacheDB(filename=filename)
+        peer.owner = "another process"
+        path = "mozilla-central/json-rev/" + "a" * 40
+        try:
+            self.assertTrue(peer.lease(path, 60))
+            ready, pair, stale = relay.lookup(path, Date.now())
+            # DOES NOT BLOCK WHILE THE PEER HOLDS THE LEASE
+            self.assertEqual(relay.fill(ready, "get", path, {}, Date.now(), stale), None)
+            self.assertEqual(relay.stats.peer_waits, 1)
+            self.assertFalse(ready)
+
+            # WHILE THE PEER HOLDS THE LEASE, THE WAITER ONLY READS
+            writes = relay.db.write_wait.count
+            Till(seconds=cache.LEASE_POLL * 5).wait()
+            self.assertEqual(relay.db.write_wait.count, writes)
+            self.assertEqual(relay.db.peek([path, "missing"], Date.now().unix), ({}, {path}))
+
+            peer.put(path, "{}", b"body", None, 4, Date.now().unix)
+            peer.release(path)
+            (ready | Till(seconds=10)).wait()
+            self.assertTrue(ready)
+            headers, body = relay.result(path)
+            self.assertEqual(body.content, b"body")
+            self.assertEqual(relay.peer_waits, {})
+
+            # THE PEER DIED; ONCE ITS LEASE EXPIRES, WE FETCH IT OURSELVES
+            other = "mozilla-central/json-rev/" + "b" * 40
+            self.assertTrue(peer.lease(other, 60))
+            ready, pair, stale = relay.lookup(other, Date.now())
+            self.assertEqual(relay.fill(ready, "get", other, {}, Date.now(), stale), None)
+            with peer.transaction() as db:
+                db.execute("UPDATE leases SET expires=0 WHERE path=?", (other,))
+            (ready | Till(seconds=10)).wait()
+            self.assertTrue(ready)
+            self.assertEqual(relay.stats.failures, 1)  # THERE IS NO UPSTREAM
+        finally:
+            for t in relay.threads + [relay.cleaner, relay.peer_waiter]:
+                t.stop()
+            relay.db.stop()
+            peer.stop()
+            shutil.rmtree(temp)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=3)
+        now = bucket.last
+        self.assertEqual([bucket.acquire(now) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.acquire(now), 0.5)  # ONE TOKEN EVERY HALF SECOND
+        self.assertEqual(bucket.acquire(now + 0.5), 0)
+        self.assertAlmostEqual(bucket.wait_time(now + 0.75), 0.25)
+        bucket.wait_time(now + 100)
+        self.assertEqual(bucket.tokens, 3)  # NO MORE THAN capacity
+
+    def test_scheduler_weights(self):
+        scheduler = Scheduler(rate=1000)  # DEFAULT_LANES: interactive IS WEIGHT 4, bulk IS WEIGHT 1
+        interactive, bulk = scheduler.by_name["interactive"], scheduler.by_name["bulk"]
+        for i in range(50):
+            scheduler.add(bulk, ("bulk", i))
+            scheduler.add(interactive, ("interactive", i))
+        served = [scheduler.pop()[0] for _ in range(25)]
+        self.assertEqual(served.count("interactive"), 20)
+        self.assertEqual(served.count("bulk"), 5)
+        self.assertEqual(len(scheduler), 75)
+
+    def test_scheduler_idle_lane(self):
+        scheduler = Scheduler(rate=1000)
+        interactive, bulk = scheduler.by_name["interactive"], scheduler.by_name["bulk"]
+        for i in range(20):
+            scheduler.add(bulk, ("bulk", i))
+        served = [scheduler.pop()[0] for _ in range(10)]
+        self.assertEqual(served, ["bulk"] * 10)  # AN IDLE LANE DOES NOT HOLD BACK ITS SHARE
+
+        # ...NOR DOES IT SAVE IT UP
+        for i in range(20):
+            scheduler.add(interactive, ("interactive", i))
+        served = [scheduler.pop()[0] for _ in range(10)]
+        self.assertEqual(served.count("bulk"), 1)
+
+    def test_scheduler_lane_rate(self):
+        scheduler = Scheduler(rate=1000, lanes=[
+            {"name": "slow", "weight": 100, "rate": 1, "paths": ["/slow/"]},
+            {"name": "bulk", "weight": 1}
+        ])
+        slow, bulk = scheduler.lane_for("a/slow/b"), scheduler.lane_for("a/b")
+        self.assertEqual((slow.name, bulk.name), ("slow", "bulk"))
+        for i in range(3):
+            scheduler.add(slow, ("slow", i))
+            scheduler.add(bulk, ("bulk", i))
+        served = [scheduler.pop()[0] for _ in range(4)]
+        self.assertEqual(served, ["slow", "bulk", "bulk", "bulk"])  # slow HAS ONE TOKEN
+
+    def test_scheduler_out_of_tokens(self):
+        scheduler = Scheduler(rate=1)
+        bulk = scheduler.by_name["bulk"]
+        scheduler.add(bulk, "first")
+        scheduler.add(bulk, "second")
+        self.assertEqual(scheduler.pop(), "first")
+        self.assertEqual(scheduler.pop(till=Till(seconds=0.2)), None)
+        self.assertEqual(list(bulk.queue), ["second"])  # PUT BACK, NOT LOST
+        self.assertEqual(scheduler.pop(till=Till(seconds=5)), "second")
+
+    def test_scheduler_shared_bucket(self):
+        temp = tempfile.mkdtemp()
+        db = CacheDB(filename=os.path.join(temp, "relay.db"))
+        try:
+            first = Scheduler(rate=2, buckets=db.token_bucket)
+            second = Scheduler(rate=2, buckets=db.token_bucket)  # ANOTHER PROCESS, SAME BUDGET
+            first.add(first.lanes[-1], "a")
+            second.add(second.lanes[-1], "b")
+            second.add(second.lanes[-1], "c")
+            self.assertEqual(first.pop(), "a")
+            self.assertEqual(second.pop(), "b")
+            self.assertEqual(second.pop(till=Till(seconds=0.1)), None)  # BOTH TOKENS ARE SPENT
+        finally:
+            db.stop()
+            shutil.rmtree(temp)
+
+    def test_in_flight_spill(self):
+        temp = tempfile.mkdtemp()
+        old = cache.MAX_BLOB_SIZE, cache.IN_FLIGHT_MEMORY
+        cache.MAX_BLOB_SIZE, cache.IN_FLIGHT_MEMORY = 10, 20
+        try:
+            in_flight = InFlight()
+            writer = BodyWriter(True, temp, tee=in_flight.add)
+            early = in_flight.stream()
+            expected = b""
+            for i in range(10):
+                chunk = ("chunk %d;" % i).encode("ascii")
+                writer.write(chunk)
+                expected += chunk
+                if i == 0:
+                    self.assertEqual(next(early), chunk)  # KEEPING UP, FROM MEMORY
+            self.assertLessEqual(sum(len(c) for _, c in in_flight.chunks), 30)  # THE REST IS ONLY ON DISK
+            self.assertEqual(in_flight.read_memory(0), (None, cache.ON_DISK))
+
+            late = in_flight.stream()
+            self.assertEqual(next(late), expected)  # FROM THE FILE, UP TO WHAT HAS ARRIVED
+
+            body = writer.close(os.path.join(temp, "body.gz"))  # RENAMES THE FILE
+            in_flight.finish(body.file)
+            self.assertEqual(b"".join(in_flight.stream()), expected)
+            self.assertEqual(b"".join(early), expected[len(b"chunk 0;"):])
+            self.assertEqual(list(late), [])
+        finally:
+            cache.MAX_BLOB_SIZE, cache.IN_FLIGHT_MEMORY = old
+            shutil.rmtree(temp)
+
+    def test_convert_text_cache(self):
+        temp = tempfile.mkdtemp()
+        filename = os.path.join(temp, "relay.db")
+        plain = b'{"node": "\xe9"}'
+        old = sqlite3.connect(filename)
+        old.execute("CREATE TABLE cache (path TEXT PRIMARY KEY, headers TEXT, response TEXT, timestamp REAL)")
+        old.executemany("INSERT INTO cache VALUES (?, ?, ?, ?)", [
+            ("plain", json.dumps({"Content-Type": "application/json", "ETag": "1"}), plain.decode("latin1"), 100),
+            ("gzipped", json.dumps({"Content-Encoding": "gzip"}), _gzip(plain).decode("latin1"), 200),
+            ("deflated", json.dumps({"Content-Encoding": "deflate"}), "?", 300)
+        ])
+        old.commit()
+        old.close()
+
+        db = CacheDB(filename=filename)
+        try:
+            self.assertEqual(db.count, 2)
+            headers, content, file, size, expires = db.get("plain")
+            self.assertEqual(zlib.decompress(content, 16 + zlib.MAX_WBITS), plain)
+            self.assertEqual(json.loads(headers), {"Content-Type": "application/json", "ETag": "1"})
+            self.assertEqual((size, expires), (len(content), 0))  # REVALIDATED ON FIRST USE
+            headers, content, file, size, expires = db.get("gzipped")
+            self.assertEqual(zlib.decompress(content, 16 + zlib.MAX_WBITS), plain)
+            self.assertEqual(json.loads(headers), {})
+            self.assertEqual(db.get("deflated"), None)
+            self.assertEqual(db.total_size, sum(len(db.get(p)[1]) for p in ["plain", "gzipped"]))
+        finally:
+            db.stop()
+            shutil.rmtree(temp)
+
+    def test_response_status(self):
+        body = Body(content=_gzip(b"not found"), status=404)
+        response = _response("{}", body, False, Data(bytes_served=0))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(b"".join(response.response), b"not found")
+        self.assertEqual(_response("{}", Body(content=_gzip(b"")), True, Data(bytes_served=0)).status_code, 200)
+
+    def test_warmer_tail(self):
+        node = "14dc6342ec5000000000000000000000000000ab"
+
+        class StubCache(object):
+            scheduler = Scheduler(rate=1000)
+            asked = []
+
+            def get(self, path, lane):
+                self.asked.append((path, lane))
+                return 200, value2json({"lastpushid": 7, "pushes": {"7": {"changesets": [node]}}}).encode("utf8")
+
+        stub = StubCache()
+        warmer = CacheWarmer(stub, branches=[], paths=["{{branch}}/json-rev/{{node}}"])
+        try:
+            warmer.tail("mozilla-central")
+            warmer.tail("mozilla-central")
+        finally:
+            warmer.thread.stop()
+        # THE PUSHES ARE READ THROUGH THE WARM LANE, NOT DIRECTLY FROM hg
+        self.assertEqual(stub.asked, [
+            ("mozilla-central/json-pushes?version=2", WARM_LANE),
+            ("mozilla-central/json-pushes?version=2&startID=7", WARM_LANE)
+        ])
+        self.assertEqual(list(warmer.pending), ["mozilla-central/json-rev/" + node] * 2)
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(0.5), None)
+        for millis in range(1, 101):
+            histogram.add(millis / 1000)
+        self.assertEqual(histogram.count, 100)
+        # THE UPPER BOUND OF THE BUCKET, SO NO MORE THAN 10% HIGH
+        for p, expected in [(0.5, 0.050), (0.9, 0.090), (0.99, 0.099)]:
+            self.assertGreaterEqual(histogram.percentile(p), expected)
+            self.assertLessEqual(histogram.percentile(p), expected * 1.1)
+        self.assertEqual(histogram.percentile(1), 0.1)  # NEVER MORE THAN max
+        snapshot = histogram.snapshot()
+        self.assertAlmostEqual(snapshot.mean, 0.0505)
+        self.assertEqual(snapshot.p50, histogram.percentile(0.5))
+
+        histogram.add(0)  # TOO SMALL TO MEASURE
+        histogram.add(3600)  # BEYOND THE LAST BOUNDED BUCKET
+        self.assertEqual((histogram.counts[0], histogram.counts[-1]), (1, 1))
+        self.assertEqual(histogram.percentile(1), 3600)
+
+    def test_revision_walker(self):
+        def id(i):
+            return ("%02d" % i) * 20
+
+        class StubHg(object):
+            def get_revision(self, revision, locale=None):
+                i = int(revision.changeset.id[:2])
+                return wrap({"changeset": {"id": id(i)}, "parents": [id(i - 1)] if i else []})
+
+            def _get_and_retry(self, url, branch):
+                raise Exception("no json-log")
+
+        start = Revision(branch={"name": "mozilla-central", "url": "https://hg.mozilla.org/mozilla-central"}, changeset={"id": id(5)})
+        walker = RevisionWalker(StubHg(), start, "parents", depth=2)
+        walk = iter(walker)
+        self.assertEqual(walker.threads, [])  # NOTHING RUNS UNTIL THE FIRST next()
+
+        self.assertEqual([r.changeset.id for r in walk], [id(i) for i in [4, 3, 2, 1, 0]])
+        self.assertEqual(len(walker.threads), 4)
+        self.assertTrue(walker.please_stop)  # THE THREADS ARE STOPPED AT THE END
+
+    def test_branch_snapshot(self):
+        temp = tempfile.mkdtemp()
+        snapshot = os.path.join(temp, "branches.json")
+        central = {"name": "mozilla-central", "locale": DEFAULT_LOCALE, "url": "https://hg.mozilla.org/mozilla-central"}
+        scraped = Signal("scraped")
+        proceed = Signal("proceed")
+
+        def get_branches(*args, **kwargs):
+            scraped.go()
+            proceed.wait()
+            return UniqueIndex(["name", "locale"], data=[central], fail_on_dup=False)
+
+        original, hg_branches.get_branches = hg_branches.get_branches, get_branches
+        try:
+            # NO SNAPSHOT: branches WAITS FOR THE BACKGROUND REFRESH, WHICH WRITES ONE
+            hg = HgMozillaOrg(lazy=True, branch_snapshot=snapshot, hg={"url": "https://hg.mozilla.org"}, timeout=10)
+            self.assertEqual(hg._es, None)  # ES IS NOT CONNECTED AT STARTUP
+            scraped.wait()
+            refresh = hg.branch_refresh
+            self.assertFalse(hg.branches_ready)
+            proceed.go()
+            self.assertEqual(hg.branches[("mozilla-central", DEFAULT_LOCALE)].url, central["url"])
+            refresh.join()
+            self.assertTrue(os.path.exists(snapshot))
+
+            # WITH A SNAPSHOT: THE BRANCHES ARE THERE AT ONCE, EVEN WHILE THE REFRESH IS STUCK
+            scraped, proceed = Signal("scraped"), Signal("proceed")
+            hg = HgMozillaOrg(lazy=True, branch_snapshot=snapshot, hg={"url": "https://hg.mozilla.org"}, timeout=10)
+            scraped.wait()
+            refresh = hg.branch_refresh
+            self.assertTrue(hg.branches_ready)
+            self.assertEqual(hg.branches[("mozilla-central", DEFAULT_LOCALE)].url, central["url"])
+            proceed.go()
+            refresh.join()
+        finally:
+            hg_branches.get_branches = original
+            shutil.rmtree(temp)
+
+    def test_refresh_branches_once(self):
+        central = {"name": "mozilla-central", "locale": DEFAULT_LOCALE, "url": "https://hg.mozilla.org/mozilla-central"}
+        calls = [0]
+        proceed = Signal("proceed")
+
+        def get_branches(*args, **kwargs):
+            calls[0] += 1
+            proceed.wait()
+            return UniqueIndex(["name", "locale"], data=[central], fail_on_dup=False)
+
+        original, hg_branches.get_branches = hg_branches.get_branches, get_branches
+        try:
+            hg = HgMozillaOrg(lazy=True, hg={"url": "https://hg.mozilla.org"}, timeout=10)
+            refresh = hg.branch_refresh
+
+            # MANY READERS FIND THE BRANCHES MISSING AT ONCE: ONLY ONE SCRAPE
+            def many(please_stop):
+                for _ in range(20):
+                    hg.refresh_branches()
+
+            for t in [Thread.run("refresh " + str(i), many) for i in range(5)]:
+                t.join()
+            proceed.go()
+            refresh.join()
+            self.assertEqual(calls[0], 1)
+            self.assertEqual(hg.branches[("mozilla-central", DEFAULT_LOCALE)].url, central["url"])
+
+            # A REFRESH THAT JUST FINISHED IS NOT REPEATED
+            hg.refresh_branches()
+            self.assertEqual(hg.branch_refresh, None)
+            self.assertEqual(calls[0], 1)
+        finally:
+            hg_branches.get_branches = original
+
+    def test_cache_db_accounting(self):
+        temp = tempfile.mkdtemp()
+        db = CacheDB(filename=os.path.join(temp, "relay.db"), flush_period=3600)
+        try:
+            def total():
+                count, size = db.query("SELECT COUNT(1), SUM(size) FROM cache")[0]
+                return count, size or 0
+
+            db.put("a", "{}", b"a" * 100, None, 100, 1)
+            db.put("b", "{}", b"b" * 200, None, 200, 2)
+            db.put("a", "{}", b"a" * 50, None, 50, 3)  # REPLACE
+            self.assertEqual((db.count, db.total_size), (2, 250))
+            self.assertEqual((db.count, db.total_size), total())
+            db.delete("b")
+            db.delete("missing")
+            self.assertEqual((db.count, db.total_size), (1, 50))
+            self.assertEqual((db.count, db.total_size), total())
+            db.put_many([("c", "{}", b"c" * 10, None, 10, 4, None), ("a", "{}", b"x", None, 1, 5, None)])  # a IS KEPT
+            self.assertEqual((db.count, db.total_size), (2, 60))
+            self.assertEqual((db.count, db.total_size), total())
+
+            # ACCESS TIMES ARE KEPT IN MEMORY UNTIL flush(), AND NEVER GO BACKWARDS
+            db.touch("a", 10)
+            db.touch("a", 7)
+            self.assertEqual(db.query("SELECT timestamp FROM cache WHERE path='a'")[0][0], 3)
+            db.flush()
+            self.assertEqual(db.query("SELECT timestamp FROM cache WHERE path='a'")[0][0], 10)
+            db.touch("a", 8)
+            db.flush()
+            self.assertEqual(db.query("SELECT timestamp FROM cache WHERE path='a'")[0][0], 10)
+
+            # CONNECTIONS ARE REUSED, AND AT MOST MAX_IDLE_CONNECTIONS ARE KEPT
+            with db._connection() as first:
+                pass
+            with db._connection() as again:
+                self.assertIs(again, first)
+            borrowed = []
+
+            def borrow(please_stop):
+                with db._connection():
+                    borrowed.append(1)  # ALL HOLD A CONNECTION AT ONCE
+                    while len(borrowed) < cache_db.MAX_IDLE_CONNECTIONS + 5:
+                        Till(seconds=0.01).wait()
+
+            threads = [Thread.run("borrow " + str(i), borrow) for i in range(cache_db.MAX_IDLE_CONNECTIONS + 5)]
+            for t in threads:
+                t.join()
+            self.assertEqual(len(db.pool), cache_db.MAX_IDLE_CONNECTIONS)
+        finally:
+            db.stop()
+            shutil.rmtree(temp)
+
+    def test_cache_db_evict(self):
+        temp = tempfile.mkdtemp()
+        db = CacheDB(filename=os.path.join(temp, "relay.db"), flush_period=3600)
+        try:
+            body = os.path.join(temp, "d.body")
+            with open(body, "wb") as f:
+                f.write(b"d" * 3000)
+            db.put("a", "{}", os.urandom(3000), None, 3000, 1)
+            db.put("b", "{}", os.urandom(3000), None, 3000, 2)
+            db.put("c", "{}", os.urandom(3000), None, 3000, 3)
+            db.put("d", "{}", None, body, 3000, 4)
+            db.put("b", "{}", os.urandom(4000), None, 4000, 5)  # REPLACED, SO RECENT
+            db.touch("a", 10)  # NOT YET FLUSHED; evict() MUST SEE IT
+            self.assertEqual(db.evict(), 0)  # NO budget
+
+            db.budget = 10000
+            self.assertEqual(db.evict(), 2)  # DOWN TO EVICT_TO OF budget, OLDEST FIRST
+            self.assertEqual([p for p, in db.query("SELECT path FROM cache ORDER BY path")], ["a", "b"])
+            self.assertEqual((db.count, db.total_size), (2, 7000))
+            self.assertEqual(db.evicted, {"entries": 2, "bytes": 6000})
+            self.assertFalse(os.path.exists(body))
+
+            # THE FREED PAGES ARE RETURNED TO THE FILE SYSTEM
+            self.assertEqual(db.query("PRAGMA auto_vacuum")[0][0], 2)
+            self.assertGreater(db.query("PRAGMA freelist_count")[0][0], 0)
+            db.vacuum()
+            self.assertEqual(db.query("PRAGMA freelist_count")[0][0], 0)
+        finally:
+            db.stop()
+            shutil.rmtree(temp)
+
+    def test_cache_db_shared_totals(self):
+        temp = tempfile.mkdtemp()
+        filename = os.path.join(temp, "relay.db")
+        db = CacheDB(filename=filename, flush_period=3600)
+        peer = CacheDB(filename=filename, flush_period=3600)  # ANOTHER PROCESS
+        try:
+            for i, p in enumerate("abcd"):
+                peer.put(p, "{}", os.urandom(3000), None, 3000, i + 1)
+            self.assertEqual((db.count, db.total_size), (0, 0))  # WE DID NOT SEE THE PEER'S puts
+
+            # THE PEER'S puts PUT US OVER budget
+            db.budget = 10000
+            self.assertEqual(db.evict(), 1)
+            self.assertEqual((db.count, db.total_size), (3, 9000))
+
+            # A COUNTER THAT IS TOO HIGH DOES NOT EMPTY THE TABLE
+            peer.budget = 10000
+            peer.total_size = 1000000
+            self.assertEqual(peer.evict(), 0)
+            self.assertEqual(db.totals(), (3, 9000))
+        finally:
+            db.stop()
+            peer.stop()
+            shutil.rmtree(temp)
+
+    def test_cache_db_not_incremental(self):
+        temp = tempfile.mkdtemp()
+        filename = os.path.join(temp, "relay.db")
+        old = sqlite3.connect(filename)
+        old.execute("CREATE TABLE cache (path TEXT PRIMARY KEY, headers TEXT, response BLOB, file TEXT, size INTEGER, timestamp REAL, expires REAL)")
+        old.commit()
+        old.close()
+        db = CacheDB(filename=filename, daemons=False)
+        try:
+            # AN OLD DATABASE IS NOT REWRITTEN JUST BY OPENING IT
+            self.assertEqual((db.flusher, db.evicter), (None, None))
+            self.assertFalse(db.incremental)
+            db.put("a", "{}", os.urandom(3000), None, 3000, 1)
+            db.delete("a")
+            db.vacuum()  # NOTHING TO DO
+            self.assertEqual(db.query("PRAGMA auto_vacuum")[0][0], 0)
+
+            db.convert_to_incremental()
+            self.assertTrue(db.incremental)
+            self.assertEqual(db.query("PRAGMA auto_vacuum")[0][0], 2)
+        finally:
+            db.stop()
+            shutil.rmtree(temp)
+
+    def test_source_store(self):
+        temp = tempfile.mkdtemp()
+        branch = wrap({"name": "mozilla-central", "locale": DEFAULT_LOCALE, "url": "https://hg.mozilla.org/mozilla-central"})
+        a, b, c = "a" * 40, "b" * 40, "c" * 40
+        graph = CommitGraph("mozilla-central")
+        graph.add(b, [a])
+        graph.add(c, [b])
+        known_files = {b[:12]: ["other.py"], c[:12]: ["main.py"]}
+        requests = []
+
+        class Stub(object):
+            def get_graph(self, branch):
+                return graph
+
+            def get_known_files(self, branch, ids):
+                return {i[:12]: known_files[i[:12]] for i in ids if i[:12] in known_files}
+
+        def get(url, **kwargs):
+            requests.append(url)
+            if "/raw-file/" + c in url:
+                return Data(status_code=404, content=b"not found")
+            return Data(status_code=200, content=b"print('hello')")
+
+        original, http.get = http.get, get
+        try:
+            store = SourceStore(directory=os.path.join(temp, "not", "yet", "made"), hg=Stub())
+            self.assertEqual(store.get_source(Revision(branch=branch, changeset={"id": a}), "/main.py"), b"print('hello')")
+            self.assertEqual(len(requests), 1)
+
+            # b DID NOT CHANGE main.py, SO a's VERSION IS USED
+            self.assertEqual(store.get_source(Revision(branch=branch, changeset={"id": b}), "/main.py"), b"print('hello')")
+            self.assertEqual(len(requests), 1)
+            self.assertEqual(store._get_hash(branch.name, b, "/main.py"), store._get_hash(branch.name, a, "/main.py"))
+
+            # c CHANGED main.py; hg SAYS NO, AND NOTHING IS STORED
+            self.assertRaises("status 404", store.get_source, Revision(branch=branch, changeset={"id": c}), "/main.py")
+            self.assertEqual(len(requests), 2)
+            self.assertEqual(store._get_hash(branch.name, c, "/main.py"), None)
+        finally:
+            http.get = original
+            shutil.rmtree(temp)
+
+    def test_coalesced_in_flight(self):
+        temp = tempfile.mkdtemp()
+        relay = Cache(source={"url": "http://127.0.0.1:1/"}, database={"filename": os.path.join(temp, "relay.db")})
+        path = "mozilla-central/json-rev/" + "a" * 40
+        try:
+            ready = Signal(path)
+            ready.go()
+            in_flight = InFlight()
+            in_flight.add(_gzip(b"body"))
+            in_flight.finish()
+            with relay.cache_locker:
+                relay.cache[path] = (ready, "{}", in_flight, Date.now())
+            response = relay.request("get", path, {"Accept-Encoding": "gzip"})
+            self.assertEqual(b"".join(response.response), _gzip(b"body"))
+            self.assertEqual((relay.stats.coalesced, relay.stats.memory), (1, 0))
+        finally:
+            for t in relay.threads + [relay.cleaner]:
+                t.stop()
+            relay.db.stop()
+            shutil.rmtree(temp)
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()